@@ -0,0 +1,170 @@
+"""نقل مبيعات السنوات المغلقة من قاعدة المحل إلى ملفات أرشيف سنوية للقراءة فقط
+
+لكل سنة: ملف stores_data/archive/store_<id>_<year>.db فيه sales وsale_items بنفس الأرقام والأعمدة (المبالغ بالسنتيم)،
+مضغوط (VACUUM، صفحات 64KB، بدون WAL) ومحمي من الكتابة. التطبيق يرفقه عند الحاجة فقط ويقرأ الفواتير
+والتصدير عبر العرضين sales_all وsale_items_all، والإحصاءات من مجاميع السجل sales_archives.
+
+1. النسخ من لقطة قراءة دون حجز قفل الكتابة (البيع مستمر)
+2. في معاملة كتابة قصيرة: التحقق من أن بيانات السنة لم تتغير منذ النسخ، تسجيل تعديل مخزون يعادل
+   الكميات المؤرشفة (حتى يبقى فحص الاتساق صحيحاً)، حذف أسطر السنة وفواتيرها، وتسجيل الأرشيف
+الصفحات المحررة تعود للنظام عبر incremental_vacuum في الصيانة التلقائية.
+
+مثال:
+    python archive_sales.py --store-id 3              # كل السنوات المغلقة
+    python archive_sales.py --store-id 3 --year 2023
+"""
+import argparse
+import calendar
+import hashlib
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+ARCHIVE_PAGE_SIZE = 65536
+
+
+def year_range(year):
+    """[بداية السنة، بداية السنة التالية) بالثواني كعمود sales.date_ts"""
+    return calendar.timegm((year, 1, 1, 0, 0, 0)), calendar.timegm((year + 1, 1, 1, 0, 0, 0))
+
+
+def year_fingerprint(db, schema, year):
+    """بصمة بيانات السنة (العدد، المجاميع، SHA-256 للصفوف بترتيب الرقم) للمقارنة بين القاعدة والأرشيف"""
+    start, end = year_range(year)
+    digest = hashlib.sha256()
+    sales = lines = total = 0
+    for row in db.execute(f'SELECT id, customer_id, date, total FROM {schema}.sales WHERE date_ts >= ? AND date_ts < ? ORDER BY id',
+                          (start, end)):
+        digest.update(repr(row).encode('utf-8'))
+        sales += 1
+        total += row[3] or 0
+    for row in db.execute(f'''SELECT l.id, l.sale_id, l.item_id, l.qty, l.price FROM {schema}.sale_items l
+                              JOIN {schema}.sales s ON s.id = l.sale_id
+                              WHERE s.date_ts >= ? AND s.date_ts < ? ORDER BY l.id''', (start, end)):
+        digest.update(repr(row).encode('utf-8'))
+        lines += 1
+    return sales, lines, total, digest.hexdigest()
+
+
+def build_archive(db, path, year):
+    """نسخ مبيعات السنة إلى ملف أرشيف جديد (ملف مؤقت ثم إعادة تسمية)؛ ترجع بصمته"""
+    start, end = year_range(year)
+    tmp_path = f'{path}.tmp'
+    for candidate in (tmp_path, tmp_path + '-journal'):
+        if os.path.exists(candidate):
+            os.remove(candidate)
+    archive = sqlite3.connect(tmp_path)
+    archive.execute(f'PRAGMA page_size = {ARCHIVE_PAGE_SIZE}')
+    archive.execute('PRAGMA journal_mode = OFF')
+    for table in ('sales', 'sale_items'):
+        sql = db.execute("SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()[0]
+        archive.execute(sql)
+    archive.execute('CREATE INDEX idx_sales_date_ts ON sales (date_ts)')
+    archive.execute('CREATE INDEX idx_sale_items_sale ON sale_items (sale_id)')
+    archive.commit()
+    archive.close()
+
+    db.execute('ATTACH DATABASE ? AS archive', (tmp_path,))
+    try:
+        db.execute('BEGIN')  # لقطة واحدة للجدولين
+        db.execute('INSERT INTO archive.sales SELECT * FROM main.sales WHERE date_ts >= ? AND date_ts < ? ORDER BY id', (start, end))
+        db.execute('''INSERT INTO archive.sale_items SELECT l.* FROM main.sale_items l JOIN main.sales s ON s.id = l.sale_id
+                      WHERE s.date_ts >= ? AND s.date_ts < ? ORDER BY l.id''', (start, end))
+        db.execute('COMMIT')
+        fingerprint = year_fingerprint(db, 'archive', year)
+    finally:
+        if db.in_transaction:
+            db.execute('ROLLBACK')
+        db.execute('DETACH DATABASE archive')
+
+    archive = sqlite3.connect(tmp_path)
+    archive.execute('VACUUM')
+    archive.close()
+    if os.path.exists(path):  # بقايا محاولة سابقة لم تُسجَّل
+        os.chmod(path, 0o644)
+        os.remove(path)
+    os.replace(tmp_path, path)
+    os.chmod(path, 0o444)
+    return fingerprint
+
+
+def archive_year(lekhleftest, db, store_id, year):
+    """أرشفة سنة واحدة؛ ترجع بصمتها أو None إذا لم تكن فيها مبيعات"""
+    start, end = year_range(year)
+    if not db.execute('SELECT 1 FROM sales WHERE date_ts >= ? AND date_ts < ? LIMIT 1', (start, end)).fetchone():
+        return None
+    os.makedirs(lekhleftest.SALES_ARCHIVE_DIR, exist_ok=True)
+    path = lekhleftest.sales_archive_path(store_id, year)
+    fingerprint = build_archive(db, path, year)
+
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        if year_fingerprint(db, 'main', year) != fingerprint:
+            raise RuntimeError(f'{year}: sales changed while archiving; run again')
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        # الأسطر المؤرشفة تخرج من حساب الكمية المتوقعة، فيُسجَّل ما يعادلها كتعديل
+        db.execute('''INSERT INTO stock_adjustments (item_id, qty, reason, created_at)
+                      SELECT l.item_id, -SUM(l.qty), ?, ? FROM sale_items l JOIN sales s ON s.id = l.sale_id
+                      WHERE s.date_ts >= ? AND s.date_ts < ? GROUP BY l.item_id''', (f'archive {year}', now, start, end))
+        db.execute('DELETE FROM sale_items WHERE sale_id IN (SELECT id FROM sales WHERE date_ts >= ? AND date_ts < ?)', (start, end))
+        db.execute('DELETE FROM sales WHERE date_ts >= ? AND date_ts < ?', (start, end))
+        sales, lines, total, checksum = fingerprint
+        db.execute('''INSERT INTO sales_archives (year, filename, sales_count, sales_total, lines_count, checksum, archived_at)
+                      VALUES (?, ?, ?, ?, ?, ?, ?)''', (year, os.path.basename(path), sales, total, lines, checksum, now))
+        db.execute('COMMIT')
+    except BaseException:
+        db.execute('ROLLBACK')
+        raise
+    return fingerprint
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Move closed years of sales into read-only yearly archive databases')
+    parser.add_argument('--store-id', type=int, required=True)
+    parser.add_argument('--year', type=int, action='append', default=[],
+                        help='year to archive (repeatable; default: every closed year with sales)')
+    args = parser.parse_args()
+
+    sys.path.insert(0, APP_DIR)
+    import lekhleftest
+    path = lekhleftest.get_store_db_path(args.store_id)
+    if not os.path.exists(path):
+        raise SystemExit(f'Store {args.store_id} has no database at {path}')
+    lekhleftest.initialize_store_database(path)
+    db = sqlite3.connect(path, timeout=30, isolation_level=None)
+    current_year = datetime.now().year
+    archived = {row[0] for row in db.execute('SELECT year FROM sales_archives')}
+    years = args.year or [int(row[0]) for row in db.execute(
+        "SELECT DISTINCT strftime('%Y', date_ts, 'unixepoch') FROM sales WHERE date_ts < ? ORDER BY 1",
+        (year_range(current_year)[0],))]
+    limit = db.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+    started = time.perf_counter()
+    try:
+        for year in years:
+            if year >= current_year:
+                print(f'  {year}: skipped, the year is not closed')
+                continue
+            if year in archived:
+                print(f'  {year}: already archived')
+                continue
+            if len(archived) >= limit:
+                raise SystemExit(f'At most {limit} yearly archives can be attached to one connection')
+            year_started = time.perf_counter()
+            fingerprint = archive_year(lekhleftest, db, args.store_id, year)
+            if fingerprint is None:
+                print(f'  {year}: no sales')
+                continue
+            archived.add(year)
+            sales, lines, total, _checksum = fingerprint
+            print(f'  {year}: {sales} sales, {lines} lines, total {lekhleftest.format_money(total)} -> '
+                  f'{lekhleftest.sales_archive_path(args.store_id, year)} ({time.perf_counter() - year_started:.1f}s)')
+    finally:
+        db.close()
+    print(f'Done in {time.perf_counter() - started:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
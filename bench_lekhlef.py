@@ -0,0 +1,244 @@
+"""قياس أداء نقاط البيع والفواتير وصفحات القوائم
+
+يُنشئ مجلد بيانات مؤقتاً فيه قاعدة رئيسية ومحل تجريبي بحجم قابل للضبط (عبر generate_store_data)،
+ثم يشغّل التطبيق عبر عميل الاختبار في Flask و/أو عبر gunicorn حقيقي بعدة عمال متزامنين،
+ويطبع زمن الاستجابة p50/p95/p99 والإنتاجية لكل مسار مع حفظ النتائج بصيغة JSON.
+
+مثال:
+    python bench_lekhlef.py --items 2000 --sales 20000 --requests 300 --concurrency 8 --mode both
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+ADMIN_USERNAME = 'admin'
+ADMIN_PASSWORD = 'admin123'
+STORE_ID = 1  # المحل الافتراضي الذي تنشئه القاعدة الرئيسية للمدير
+
+
+def prepare_data_dir(args):
+    """إنشاء مجلد بيانات جديد بقاعدة رئيسية (المدير + محل) وقاعدة محل مملوءة"""
+    data_dir = tempfile.mkdtemp(prefix='lekhlef-bench-')
+    os.environ['LEKHLEF_DATA_DIR'] = data_dir
+    sys.path.insert(0, APP_DIR)
+    import lekhleftest  # ينشئ القاعدة الرئيسية داخل مجلد البيانات عند الاستيراد
+    from generate_store_data import generate_store
+    started = time.perf_counter()
+    path = lekhleftest.get_store_db_path(STORE_ID)
+    lekhleftest.ensure_stores_directory()
+    generate_store(path, items=args.items, customers=args.customers, suppliers=args.suppliers, sales=args.sales,
+                   lines=args.lines, purchases=args.purchases, debts=args.debts, seed=args.seed)
+    # مخزون كبير حتى لا تفشل عمليات البيع المقاسة بسبب نفاد الكمية
+    db = sqlite3.connect(path)
+    db.execute('UPDATE items SET qty = qty + 1000000')
+    db.commit()
+    db.close()
+    print(f'Synthetic store ready in {time.perf_counter() - started:.1f}s: {data_dir}')
+    return data_dir, lekhleftest
+
+
+# --------- Scenarios ---------
+def scenarios(args):
+    """قائمة (اسم، دالة تُرجع (method, path, form)) لكل مسار مقاس"""
+    def pos_checkout(rng):
+        lines = [(rng.randint(1, args.items), rng.randint(1, 3)) for _ in range(rng.randint(1, 4))]
+        return 'POST', '/pos', {'item_id': [str(i) for i, q in lines], 'qty': [str(q) for i, q in lines],
+                                'price': ['10' for _ in lines], 'customer_id': ''}
+    return [
+        ('pos_page', lambda rng: ('GET', '/pos', None)),
+        ('pos_checkout', pos_checkout),
+        ('invoice_view', lambda rng: ('GET', f'/invoice/{rng.randint(1, max(args.sales, 1))}', None)),
+        ('invoices_list', lambda rng: ('GET', '/invoices', None)),
+        ('items_list', lambda rng: ('GET', '/items', None)),
+        ('customers_list', lambda rng: ('GET', '/customers', None)),
+    ]
+
+
+def summarize(latencies, errors, wall):
+    """حساب المئينات والإنتاجية من أزمنة الطلبات بالثواني"""
+    ordered = sorted(latencies)
+
+    def percentile(p):
+        if not ordered:
+            return None
+        return round(ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))] * 1000, 2)
+    return {
+        'count': len(ordered),
+        'errors': errors,
+        'p50_ms': percentile(50),
+        'p95_ms': percentile(95),
+        'p99_ms': percentile(99),
+        'mean_ms': round(sum(ordered) / len(ordered) * 1000, 2) if ordered else None,
+        'throughput_rps': round(len(ordered) / wall, 1) if wall else None,
+    }
+
+
+def run_scenario(make_session, make_request, requests, concurrency, seed):
+    """تنفيذ طلبات مسار واحد بعدد عمال متزامنين؛ لكل عامل جلسة مسجلة الدخول خاصة به"""
+    local = threading.local()
+    latencies, errors = [], []
+    lock = threading.Lock()
+
+    def worker(n):
+        if not hasattr(local, 'send'):
+            local.send = make_session()
+            local.rng = random.Random(seed + n)
+        method, path, form = make_request(local.rng)
+        started = time.perf_counter()
+        try:
+            ok = local.send(method, path, form)
+        except Exception:
+            ok = False
+        elapsed = time.perf_counter() - started
+        with lock:
+            (latencies if ok else errors).append(elapsed)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(requests)))
+    return summarize(latencies, len(errors), time.perf_counter() - started)
+
+
+# --------- Drivers ---------
+def test_client_session(app):
+    """جلسة عبر عميل اختبار Flask (بدون شبكة)"""
+    def make_session():
+        client = app.test_client()
+        client.post('/login', data={'username': ADMIN_USERNAME, 'password': ADMIN_PASSWORD})
+        client.get(f'/switch_store/{STORE_ID}')
+
+        def send(method, path, form):
+            response = client.open(path, method=method, data=form)
+            return response.status_code < 400
+        return send
+    return make_session
+
+
+def http_session(base_url):
+    """جلسة HTTP حقيقية مع الاحتفاظ بالكوكيز (بدون اتباع إعادة التوجيه)"""
+    class NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args, **kwargs):
+            return None
+
+    def make_session():
+        jar = http.cookiejar.CookieJar()
+        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar), NoRedirect())
+
+        def send(method, path, form):
+            data = urllib.parse.urlencode(form, doseq=True).encode() if form is not None else None
+            try:
+                with opener.open(urllib.request.Request(base_url + path, data=data, method=method), timeout=60) as response:
+                    response.read()
+                    return response.status < 400
+            except urllib.error.HTTPError as e:
+                return e.code < 400  # 302 بعد POST تُعتبر نجاحاً
+        send('POST', '/login', {'username': ADMIN_USERNAME, 'password': ADMIN_PASSWORD})
+        send('GET', f'/switch_store/{STORE_ID}', None)
+        return send
+    return make_session
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(data_dir, workers, threads):
+    """تشغيل gunicorn على منفذ حر وانتظار جاهزيته"""
+    port = free_port()
+    env = dict(os.environ, LEKHLEF_DATA_DIR=data_dir)
+    process = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-w', str(workers), '--threads', str(threads),
+                                '-b', f'127.0.0.1:{port}', '--log-level', 'warning', 'lekhleftest:app'],
+                               cwd=APP_DIR, env=env)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/login', timeout=1).read()
+            return process, f'http://127.0.0.1:{port}'
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('gunicorn did not start')
+
+
+def run_mode(name, make_session, args):
+    print(f'\n== {name}')
+    print(f'{"endpoint":<16}{"count":>7}{"err":>5}{"p50":>9}{"p95":>9}{"p99":>9}{"rps":>9}')
+    results = {}
+    for endpoint, make_request in scenarios(args):
+        stats = run_scenario(make_session, make_request, args.requests, args.concurrency, args.seed)
+        results[endpoint] = stats
+        print(f'{endpoint:<16}{stats["count"]:>7}{stats["errors"]:>5}{stats["p50_ms"] or 0:>9}'
+              f'{stats["p95_ms"] or 0:>9}{stats["p99_ms"] or 0:>9}{stats["throughput_rps"] or 0:>9}')
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=APP_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Lekhlef load-testing benchmark')
+    parser.add_argument('--items', type=int, default=1000)
+    parser.add_argument('--customers', type=int, default=500)
+    parser.add_argument('--suppliers', type=int, default=30)
+    parser.add_argument('--sales', type=int, default=10000)
+    parser.add_argument('--lines', type=int, default=3, help='average lines per sale')
+    parser.add_argument('--purchases', type=int, default=500)
+    parser.add_argument('--debts', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=200, help='requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--mode', choices=['client', 'gunicorn', 'both'], default='client')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn worker processes')
+    parser.add_argument('--threads', type=int, default=1, help='gunicorn threads per worker')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default=None, help='JSON results file (default: bench_results/<timestamp>.json)')
+    args = parser.parse_args()
+
+    data_dir, lekhleftest = prepare_data_dir(args)
+    report = {
+        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'config': vars(args),
+        'results': {},
+    }
+    if args.mode in ('client', 'both'):
+        report['results']['test_client'] = run_mode('Flask test client', test_client_session(lekhleftest.app), args)
+    if args.mode in ('gunicorn', 'both'):
+        process, base_url = start_gunicorn(data_dir, args.workers, args.threads)
+        try:
+            report['results']['gunicorn'] = run_mode(f'gunicorn -w {args.workers} --threads {args.threads}',
+                                                     http_session(base_url), args)
+        finally:
+            process.terminate()
+            process.wait()
+
+    output = args.output or os.path.join(APP_DIR, 'bench_results', datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f'\nResults saved to {output}')
+
+
+if __name__ == '__main__':
+    main()
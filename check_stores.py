@@ -0,0 +1,258 @@
+"""فحص اتساق قواعد المحلات: المخزون والمبالغ والديون، لكل المحلات بالتوازي
+
+لكل محل، في لقطة قراءة واحدة:
+- PRAGMA quick_check (أو integrity_check الكامل مع --full)
+- الكمية المتوقعة لكل صنف = تعديلات المخزون + المشتريات - المبيعات، مقارنة بـ items.qty
+- مجموع كل فاتورة بيع وشراء مقارنة بمجموع أسطرها
+- الديون: المتبقي = الأصل - المسدد مع الحالة، أرصدة الأطراف مقابل الديون ودفتر القيود، ومجاميع أعمار الديون
+- أعمدة التاريخ بالثواني (date_ts، created_ts) مقارنة بالتاريخ النصي، والصفوف التي بقيت بلا ثوانٍ
+المبالغ أعداد صحيحة بالسنتيم، فكل المقارنات تامة بلا هامش تقريب.
+
+المحلات توزَّع على مجمع عمليات (عملية لكل نواة افتراضياً). مع --fix يُصحَّح كل محل فيه فروقات في
+معاملة واحدة بعد إعادة الفحص داخلها: الكميات والمجاميع من الأسطر، والديون والأرصدة والأعمار من جدول
+الديون، والثواني من التاريخ النصي (أو من صف مجاور إن لم يُفهم، مع تسجيله في date_fallbacks). لا يُصحَّح محل فشل فحص سلامة ملفه.
+
+مثال:
+    python check_stores.py
+    python check_stores.py --store-id 3 --store-id 7 --full --fix --json report.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+# نوع الفرق -> استعلام يُرجع الصفوف المختلفة فقط
+CHECKS = {
+    'stock': '''SELECT id, name, COALESCE(qty, 0) AS qty, expected FROM ({stock}) WHERE COALESCE(qty, 0) != expected''',
+    'sale_totals': '''SELECT s.id, s.total, COALESCE(l.total, 0) AS lines_total FROM sales s
+                      LEFT JOIN (SELECT sale_id, SUM(qty * price) AS total FROM sale_items GROUP BY sale_id) l ON l.sale_id = s.id
+                      WHERE COALESCE(s.total, 0) != COALESCE(l.total, 0)''',
+    'purchase_totals': '''SELECT p.id, p.total, COALESCE(l.total, 0) AS lines_total FROM purchases p
+                          LEFT JOIN (SELECT purchase_id, SUM(qty * price) AS total FROM purchase_items GROUP BY purchase_id) l
+                                 ON l.purchase_id = p.id
+                          WHERE COALESCE(p.total, 0) != COALESCE(l.total, 0)''',
+    'debts': '''SELECT id, entity_type, entity_id, original_amount, paid_amount, remaining_amount, status FROM debts
+                WHERE remaining_amount != original_amount - paid_amount
+                   OR (status = 'paid') != (original_amount - paid_amount <= 0)''',
+    'balances': '''SELECT * FROM (
+                       SELECT k.entity_type, k.entity_id, COALESCE(b.balance, 0) AS balance,
+                              COALESCE(d.amount, 0) AS debts, COALESCE(l.amount, 0) AS ledger
+                       FROM (SELECT entity_type, entity_id FROM entity_balances
+                             UNION SELECT entity_type, entity_id FROM debts
+                             UNION SELECT entity_type, entity_id FROM ledger_entries) k
+                       LEFT JOIN entity_balances b ON b.entity_type = k.entity_type AND b.entity_id = k.entity_id
+                       LEFT JOIN (SELECT entity_type, entity_id, SUM(original_amount - paid_amount) AS amount
+                                  FROM debts GROUP BY entity_type, entity_id) d
+                              ON d.entity_type = k.entity_type AND d.entity_id = k.entity_id
+                       LEFT JOIN (SELECT entity_type, entity_id, SUM(amount) AS amount
+                                  FROM ledger_entries GROUP BY entity_type, entity_id) l
+                              ON l.entity_type = k.entity_type AND l.entity_id = k.entity_id)
+                   WHERE balance != debts OR ledger != debts''',
+    'aging': '''SELECT entity_type, entity_id, bucket, SUM(aging_amount) AS aging_amount, SUM(aging_count) AS aging_count,
+                       SUM(debt_amount) AS debt_amount, SUM(debt_count) AS debt_count
+                FROM (SELECT entity_type, entity_id, bucket, amount AS aging_amount, debt_count AS aging_count,
+                             0 AS debt_amount, 0 AS debt_count FROM debt_aging
+                      UNION ALL
+                      SELECT entity_type, entity_id, aging_bucket, 0, 0, remaining_amount, 1 FROM debts WHERE status = 'open')
+                GROUP BY entity_type, entity_id, bucket
+                HAVING SUM(aging_amount) != SUM(debt_amount) OR SUM(aging_count) != SUM(debt_count)''',
+    # التواريخ غير المفهومة المسجلة في date_fallbacks (ونصها لم يتغير) أخذت ثواني صف مجاور عمداً
+    'dates': '''SELECT 'sales' AS source, id, date, date_ts AS timestamp FROM sales t
+                WHERE date_ts IS NOT CAST(strftime('%s', date) AS INTEGER)
+                  AND NOT EXISTS (SELECT 1 FROM date_fallbacks f WHERE f.table_name = 'sales' AND f.row_id = t.id
+                                                                 AND f.original IS t.date)
+                UNION ALL
+                SELECT 'purchases', id, date, date_ts FROM purchases t
+                WHERE date_ts IS NOT CAST(strftime('%s', date) AS INTEGER)
+                  AND NOT EXISTS (SELECT 1 FROM date_fallbacks f WHERE f.table_name = 'purchases' AND f.row_id = t.id
+                                                                 AND f.original IS t.date)
+                UNION ALL
+                SELECT 'debts', id, date_created, created_ts FROM debts t
+                WHERE created_ts IS NOT CAST(strftime('%s', date_created) AS INTEGER)
+                  AND NOT EXISTS (SELECT 1 FROM date_fallbacks f WHERE f.table_name = 'debts' AND f.row_id = t.id
+                                                                 AND f.original IS t.date_created)''',
+    # صفوف بلا ثوانٍ تخرج من كل بحث بفترة (التصدير، الأرشفة) وتنزل إلى آخر القوائم
+    'undated': '''SELECT 'sales' AS source, id, date FROM sales WHERE date_ts IS NULL
+                  UNION ALL
+                  SELECT 'purchases', id, date FROM purchases WHERE date_ts IS NULL
+                  UNION ALL
+                  SELECT 'debts', id, date_created FROM debts WHERE created_ts IS NULL''',
+}
+
+
+def app_module():
+    """lekhleftest (يُستورد داخل كل عملية من المجمع)"""
+    if APP_DIR not in sys.path:
+        sys.path.insert(0, APP_DIR)
+    import lekhleftest
+    return lekhleftest
+
+
+def check_sql(kind):
+    return CHECKS[kind].format(stock=app_module().STOCK_EXPECTED_SQL)
+
+
+def find_differences(db, examples):
+    """{نوع: {'count': عدد الصفوف المختلفة، 'examples': أول الصفوف}} للأنواع التي فيها فروقات فقط"""
+    issues = {}
+    for kind in CHECKS:
+        cursor = db.execute(check_sql(kind))
+        columns = [d[0] for d in cursor.description]
+        rows = cursor.fetchall()
+        if rows:
+            issues[kind] = {'count': len(rows), 'examples': [dict(zip(columns, row)) for row in rows[:examples]]}
+    return issues
+
+
+def integrity_errors(db, full):
+    """رسائل فحص السلامة (فارغة إذا كانت النتيجة ok)"""
+    rows = [row[0] for row in db.execute('PRAGMA integrity_check' if full else 'PRAGMA quick_check')]
+    return [] if rows == ['ok'] else rows
+
+
+def fix_store(db):
+    """تصحيح الفروقات في معاملة واحدة بعد إعادة الفحص داخلها؛ ترجع {نوع: عدد الصفوف المصححة}"""
+    lekhleftest = app_module()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        c = db.cursor()
+        issues = {kind: c.execute(check_sql(kind)).fetchall()
+                  for kind in ('stock', 'sale_totals', 'purchase_totals', 'debts', 'dates', 'undated')}
+        fixed = {kind: len(rows) for kind, rows in issues.items() if rows}
+        c.executemany('UPDATE items SET qty = ? WHERE id = ?', [(row[3], row[0]) for row in issues['stock']])
+        c.executemany('UPDATE sales SET total = ? WHERE id = ?', [(row[2], row[0]) for row in issues['sale_totals']])
+        c.executemany('UPDATE purchases SET total = ? WHERE id = ?', [(row[2], row[0]) for row in issues['purchase_totals']])
+        c.executemany('''UPDATE debts SET remaining_amount = original_amount - paid_amount,
+                                          status = CASE WHEN original_amount - paid_amount <= 0 THEN 'paid' ELSE 'open' END
+                          WHERE id = ?''', [(row[0],) for row in issues['debts']])
+        for source, row_id, _date, _timestamp in issues['dates']:
+            c.execute(f'UPDATE {source} SET {lekhleftest.STORE_DATE_COLUMNS[source][1]} = NULL WHERE id = ?', (row_id,))
+        if issues['dates'] or issues['undated']:
+            lekhleftest.backfill_date_timestamps(c)
+        # الأرصدة: من الدفتر إن كان يطابق الديون، وإلا يُعاد بناء الدفتر كله من الديون
+        balances = c.execute(check_sql('balances')).fetchall()
+        if balances:
+            fixed['balances'] = len(balances)
+            if any(row[4] != row[3] for row in balances):
+                lekhleftest.rebuild_ledger(c)
+            else:
+                now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                c.executemany('''INSERT INTO entity_balances (entity_type, entity_id, balance, updated_at) VALUES (?, ?, ?, ?)
+                                 ON CONFLICT (entity_type, entity_id) DO UPDATE SET balance = excluded.balance,
+                                                                                    updated_at = excluded.updated_at''',
+                              [(row[0], row[1], row[4], now) for row in balances])
+        aging = c.execute(check_sql('aging')).fetchall()
+        if aging:
+            fixed['aging'] = len(aging)
+            lekhleftest.rebuild_debt_aging(c, datetime.now().date())
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    return fixed
+
+
+def check_store(store_id, path, full=False, fix=False, examples=20):
+    """فحص محل واحد (يعمل داخل عملية من المجمع)؛ يرجع تقريراً قابلاً للتحويل إلى JSON"""
+    started = time.perf_counter()
+    report = {'store_id': store_id, 'path': path, 'integrity': [], 'issues': {}, 'fixed': {}}
+    if not os.path.exists(path):
+        report['error'] = 'database file is missing'
+        return report
+    try:
+        lekhleftest = app_module()
+        lekhleftest.initialize_store_database(path)  # نفس ترقية المخطط التي يجريها التطبيق عند أول دخول
+        db = sqlite3.connect(f'file:{path}?mode=ro', uri=True, timeout=lekhleftest.SQLITE_BUSY_TIMEOUT, isolation_level=None)
+        try:
+            db.execute('BEGIN')  # كل الفحوص على لقطة واحدة رغم استمرار البيع
+            report['integrity'] = integrity_errors(db, full)
+            report['issues'] = find_differences(db, examples)
+            db.execute('COMMIT')
+        finally:
+            db.close()
+        if fix and report['issues'] and not report['integrity']:
+            db = sqlite3.connect(path, timeout=lekhleftest.SQLITE_BUSY_TIMEOUT, isolation_level=None)
+            try:
+                report['fixed'] = fix_store(db)
+            finally:
+                db.close()
+    except Exception as e:
+        report['error'] = f'{type(e).__name__}: {e}'
+    report['seconds'] = round(time.perf_counter() - started, 3)
+    return report
+
+
+def list_stores(main_db_path, store_ids):
+    """[(store_id, store_name)] من القاعدة الرئيسية (كل المحلات أو المحددة فقط)"""
+    db = sqlite3.connect(f'file:{main_db_path}?mode=ro', uri=True)
+    try:
+        stores = db.execute('SELECT id, store_name FROM stores ORDER BY id').fetchall()
+    finally:
+        db.close()
+    if store_ids:
+        stores = [store for store in stores if store[0] in set(store_ids)]
+    return stores
+
+
+def print_report(report, names):
+    problems = report['integrity'] or report['issues'] or report.get('error')
+    if not problems:
+        return
+    print(f'store {report["store_id"]} ({names.get(report["store_id"], "")}): {report["path"]}')
+    if report.get('error'):
+        print(f'  error: {report["error"]}')
+    for message in report['integrity'][:10]:
+        print(f'  integrity: {message}')
+    for kind, issue in report['issues'].items():
+        fixed = report['fixed'].get(kind)
+        print(f'  {kind:<16}{issue["count"]:>8}' + (f'  fixed {fixed}' if fixed else ''))
+        for example in issue['examples'][:5]:
+            print(f'      {example}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check stock, totals and debts of every Lekhlef store database')
+    parser.add_argument('--store-id', type=int, action='append', default=[], help='check only this store (repeatable)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2, help='parallel processes (default: CPU count)')
+    parser.add_argument('--full', action='store_true', help='PRAGMA integrity_check instead of quick_check')
+    parser.add_argument('--fix', action='store_true', help='repair differences in one transaction per store')
+    parser.add_argument('--examples', type=int, default=20, help='rows kept per difference kind in the report')
+    parser.add_argument('--json', default=None, help='write the full report to this file')
+    args = parser.parse_args()
+
+    lekhleftest = app_module()
+    stores = list_stores(lekhleftest.MAIN_DB_PATH, args.store_id)
+    names = dict(stores)
+    started = time.perf_counter()
+    reports = []
+    # spawn: العمليات لا ترث خيوط التطبيق ولا اتصالاته المفتوحة
+    with ProcessPoolExecutor(max_workers=max(1, min(args.workers, len(stores) or 1)),
+                             mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = [pool.submit(check_store, store_id, lekhleftest.get_store_db_path(store_id), args.full, args.fix, args.examples)
+                   for store_id, _name in stores]
+        for future in as_completed(futures):
+            report = future.result()
+            reports.append(report)
+            print_report(report, names)
+    reports.sort(key=lambda report: report['store_id'])
+
+    failed = [r for r in reports if r.get('error') or r['integrity']]
+    unfixed = [r for r in reports if r['issues'] and not r['fixed']]
+    print(f'{len(reports)} stores checked in {time.perf_counter() - started:.1f}s: '
+          f'{sum(1 for r in reports if not r["issues"] and r not in failed)} consistent, '
+          f'{sum(1 for r in reports if r["issues"])} with differences, {len(failed)} failed')
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'checked_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'stores': reports}, f,
+                      ensure_ascii=False, indent=2)
+    sys.exit(1 if failed or unfixed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+"""مولّد قواعد بيانات محلات تجريبية كبيرة وواقعية
+
+يكتب ملفات بشكل store_<id>.db بنفس مخطط التطبيق (بعد تطبيق كل الترحيلات) ويملؤها
+بمئات الآلاف من المبيعات مع شعبية أصناف غير متساوية (توزيع Zipf)، وأسماء عربية،
+ومشتريات وديون. الكتابة سريعة: إدخال جماعي في معاملة واحدة مع synchronous=OFF
+وتأجيل إنشاء الفهارس الثانوية إلى ما بعد التحميل. النتيجة حتمية حسب البذرة.
+
+مثال:
+    python generate_store_data.py --store-id 7 --sales 300000 --seed 42 --register
+"""
+import argparse
+import itertools
+import os
+import random
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+FIRST_NAMES = ['محمد', 'أحمد', 'علي', 'يوسف', 'عمر', 'خالد', 'سعيد', 'عبد القادر', 'مصطفى', 'إبراهيم',
+               'فاطمة', 'خديجة', 'عائشة', 'مريم', 'أمينة', 'زينب', 'سارة', 'نور', 'هدى', 'ليلى']
+FAMILY_NAMES = ['بن علي', 'بوزيد', 'لخلف', 'بلقاسم', 'حمدي', 'مرابط', 'شريف', 'بن يوسف', 'قاسمي',
+                'زروقي', 'بوعلام', 'منصوري', 'سعداوي', 'بن عمر', 'حداد']
+PRODUCTS = ['قلم', 'كراس', 'دفتر', 'مسطرة', 'ممحاة', 'مقلمة', 'حقيبة', 'كتاب', 'قاموس', 'ألوان',
+            'مبراة', 'لاصق', 'مقص', 'ورق', 'ملف', 'آلة حاسبة', 'بركار', 'طباشير', 'سبورة', 'قصة']
+VARIANTS = ['أزرق', 'أحمر', 'أسود', 'أخضر', '96 صفحة', '200 صفحة', 'A4', 'A5', 'صغير', 'كبير',
+            'مدرسي', 'فاخر', 'للأطفال', 'علمي', 'أدبي']
+SUPPLIER_KINDS = ['مؤسسة', 'شركة', 'مكتبة الجملة', 'دار نشر', 'موزع']
+CITIES = ['الجزائر', 'وهران', 'قسنطينة', 'سطيف', 'باتنة', 'البليدة', 'تلمسان', 'بسكرة']
+
+
+def person_name(rng):
+    return f'{rng.choice(FIRST_NAMES)} {rng.choice(FAMILY_NAMES)}'
+
+
+def zipf_cum_weights(n, skew):
+    """أوزان تراكمية لشعبية الأصناف: الصنف رقم k يُباع بنسبة 1/k^skew"""
+    return list(itertools.accumulate(1.0 / (rank ** skew) for rank in range(1, n + 1)))
+
+
+def spread_dates(rng, count, days, end):
+    """تواريخ تصاعدية موزعة على الأيام السابقة لتاريخ النهاية بصيغة التطبيق النصية"""
+    start = end - timedelta(days=days)
+    seconds = sorted(rng.randrange(days * 86400) for _ in range(count))
+    return [(start + timedelta(seconds=s)).strftime('%Y-%m-%d %H:%M:%S') for s in seconds]
+
+
+def create_schema(path):
+    """إنشاء قاعدة المحل بمخطط التطبيق الحالي ثم إسقاط الفهارس الثانوية لإعادة بنائها بعد التحميل"""
+    sys.path.insert(0, APP_DIR)
+    import lekhleftest
+    lekhleftest.initialize_store_database(path)
+    db = sqlite3.connect(path)
+    indexes = db.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL").fetchall()
+    for name, _sql in indexes:
+        db.execute(f'DROP INDEX {name}')
+    db.commit()
+    return db, [sql for _name, sql in indexes]
+
+
+def generate_store(path, items=2000, customers=1500, suppliers=60, sales=200000, lines=3,
+                   purchases=4000, debts=8000, days=730, skew=1.1, seed=1, end=None):
+    """توليد قاعدة محل كاملة في path (يُستبدل الملف إن وُجد)؛ ترجع عدد الصفوف لكل جدول.
+    الناتج متطابق لنفس البذرة وتاريخ النهاية (افتراضياً بداية اليوم الحالي)."""
+    end = end or datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    rng = random.Random(seed)
+    db, deferred_indexes = create_schema(path)
+    db.execute('PRAGMA synchronous = OFF')
+    db.execute('PRAGMA journal_mode = OFF')
+    db.execute('PRAGMA cache_size = -200000')
+    c = db.cursor()
+
+    # الأصناف (المبالغ بالسنتيم كما في التطبيق)
+    buy_prices = [round(rng.lognormvariate(3.5, 1.0) * 100) for _ in range(items)]
+    sell_prices = [round(p * rng.uniform(1.15, 1.6)) for p in buy_prices]
+    names = [f'{PRODUCTS[i % len(PRODUCTS)]} {rng.choice(VARIANTS)} {i // len(PRODUCTS) + 1}' for i in range(items)]
+    popularity = list(range(1, items + 1))
+    rng.shuffle(popularity)  # الأصناف الأكثر مبيعاً ليست أول المعرفات بالضرورة
+    item_weights = zipf_cum_weights(items, skew)
+
+    # الزبائن والموردون
+    c.executemany('INSERT INTO customers (id, name, phone, note) VALUES (?, ?, ?, ?)',
+                  ((i, person_name(rng), f'0{rng.choice("567")}{rng.randrange(10 ** 8):08d}', None)
+                   for i in range(1, customers + 1)))
+    c.executemany('INSERT INTO suppliers (id, name, phone, note) VALUES (?, ?, ?, ?)',
+                  ((i, f'{rng.choice(SUPPLIER_KINDS)} {rng.choice(FAMILY_NAMES)} - {rng.choice(CITIES)}',
+                    f'0{rng.choice("23")}{rng.randrange(10 ** 7):07d}', None)
+                   for i in range(1, suppliers + 1)))
+
+    # المبيعات: الزبائن الدائمون أقلية والبقية "عميل عام"
+    sold = [0] * (items + 1)
+    sale_rows, line_rows = [], []
+    for sale_id, date in enumerate(spread_dates(rng, sales, days, end), start=1):
+        picks = rng.choices(popularity, cum_weights=item_weights, k=rng.randint(1, max(1, 2 * lines - 1)))
+        total = 0
+        for item_id in picks:
+            qty = 1 if rng.random() < 0.7 else rng.randint(2, 10)
+            price = sell_prices[item_id - 1]
+            total += qty * price
+            sold[item_id] += qty
+            line_rows.append((sale_id, item_id, qty, price))
+        customer_id = rng.randint(1, customers) if customers and rng.random() < 0.35 else None
+        sale_rows.append((sale_id, customer_id, date, total))
+        if len(line_rows) >= 50000:
+            c.executemany('INSERT INTO sale_items (sale_id, item_id, qty, price) VALUES (?, ?, ?, ?)', line_rows)
+            line_rows = []
+    c.executemany('INSERT INTO sales (id, customer_id, date, total) VALUES (?, ?, ?, ?)', sale_rows)
+    c.executemany('INSERT INTO sale_items (sale_id, item_id, qty, price) VALUES (?, ?, ?, ?)', line_rows)
+    sale_rows = line_rows = None
+
+    # المشتريات: كميات كبيرة من الأصناف الأكثر مبيعاً
+    purchased = [0] * (items + 1)
+    purchase_rows, purchase_lines = [], []
+    for purchase_id, date in enumerate(spread_dates(rng, purchases, days, end), start=1):
+        total = 0
+        for item_id in set(rng.choices(popularity, cum_weights=item_weights, k=rng.randint(1, 8))):
+            qty = rng.randint(10, 200)
+            total += qty * buy_prices[item_id - 1]
+            purchased[item_id] += qty
+            purchase_lines.append((purchase_id, item_id, qty, buy_prices[item_id - 1]))
+        purchase_rows.append((purchase_id, rng.randint(1, suppliers) if suppliers else None, date, total))
+    c.executemany('INSERT INTO purchases (id, supplier_id, date, total) VALUES (?, ?, ?, ?)', purchase_rows)
+    c.executemany('INSERT INTO purchase_items (purchase_id, item_id, qty, price) VALUES (?, ?, ?, ?)', purchase_lines)
+
+    # الكمية الحالية = رصيد افتتاحي + المشتريات - المبيعات (بدون مخزون سالب)
+    item_rows = []
+    for item_id in range(1, items + 1):
+        opening = max(rng.randint(0, 50), sold[item_id] - purchased[item_id])
+        item_rows.append((item_id, f'{6130000000000 + item_id}', names[item_id - 1], buy_prices[item_id - 1],
+                          sell_prices[item_id - 1], opening + purchased[item_id] - sold[item_id]))
+    c.executemany('INSERT INTO items (id, code, name, buy_price, sell_price, qty) VALUES (?, ?, ?, ?, ?, ?)', item_rows)
+    # الرصيد الافتتاحي كتعديل مخزون في بداية التاريخ حتى يطابق فحص الاتساق الكميات
+    opening_date = (end - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+    c.executemany("INSERT INTO stock_adjustments (item_id, qty, reason, created_at) VALUES (?, ?, 'opening', ?)",
+                  [(row[0], row[5] - purchased[row[0]] + sold[row[0]], opening_date) for row in item_rows])
+
+    # الديون: معظمها على الزبائن، بعضها مسدد جزئياً أو كلياً
+    debt_rows = []
+    for date in spread_dates(rng, debts, days, end):
+        entity_type = 'customer' if rng.random() < 0.8 or not suppliers else 'supplier'
+        entity_id = rng.randint(1, customers if entity_type == 'customer' else suppliers)
+        original = round(rng.uniform(200, 20000 if entity_type == 'customer' else 200000) * 100)
+        roll = rng.random()
+        paid = 0 if roll < 0.5 else (original if roll < 0.8 else round(original * rng.uniform(0.1, 0.9)))
+        debt_rows.append((entity_type, entity_id, original, paid, original - paid, date,
+                          f'فاتورة رقم {rng.randint(1, max(sales, 1))}' if rng.random() < 0.3 else None,
+                          'paid' if paid >= original else 'open'))
+    c.executemany('''INSERT INTO debts (entity_type, entity_id, original_amount, paid_amount, remaining_amount, date_created, notes, status)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', debt_rows)
+    # القيود والأرصدة وأعمدة التاريخ بالثواني تُشتق بنفس منطق ترحيل التطبيق
+    import lekhleftest
+    lekhleftest.rebuild_ledger(c, end)
+    lekhleftest.rebuild_debt_aging(c, end.date())
+    lekhleftest.backfill_date_timestamps(c)
+
+    db.commit()
+    for sql in deferred_indexes:
+        db.execute(sql)
+    db.execute('ANALYZE')
+    db.commit()
+    counts = {table: db.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+              for table in ('items', 'customers', 'suppliers', 'sales', 'sale_items', 'purchases', 'purchase_items', 'debts',
+                            'ledger_entries', 'stock_adjustments')}
+    db.close()
+    return counts
+
+
+def register_store(main_db_path, store_id, store_name):
+    """تسجيل المحل في القاعدة الرئيسية باسم المدير ليظهر في صفحة اختيار المحل"""
+    db = sqlite3.connect(main_db_path)
+    admin = db.execute("SELECT id FROM users WHERE username = 'admin'").fetchone()
+    if admin and not db.execute('SELECT 1 FROM stores WHERE id = ?', (store_id,)).fetchone():
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        db.execute('INSERT INTO stores (id, store_name, owner_id, store_type, created_at) VALUES (?, ?, ?, ?, ?)',
+                   (store_id, store_name, admin[0], 'library', now))
+        db.execute('''INSERT OR IGNORE INTO store_permissions (user_id, store_id, permission_level, granted_at)
+                      VALUES (?, ?, 'owner', ?)''', (admin[0], store_id, now))
+        db.commit()
+    db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a large synthetic Lekhlef store database')
+    parser.add_argument('--store-id', type=int, required=True)
+    parser.add_argument('--output-dir', default=None, help='default: the app stores_data directory')
+    parser.add_argument('--items', type=int, default=2000)
+    parser.add_argument('--customers', type=int, default=1500)
+    parser.add_argument('--suppliers', type=int, default=60)
+    parser.add_argument('--sales', type=int, default=200000)
+    parser.add_argument('--lines', type=int, default=3, help='average lines per sale')
+    parser.add_argument('--purchases', type=int, default=4000)
+    parser.add_argument('--debts', type=int, default=8000)
+    parser.add_argument('--days', type=int, default=730, help='history length in days')
+    parser.add_argument('--end-date', default=None, help='YYYY-MM-DD, last day of history (default: today)')
+    parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent of item popularity')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--register', action='store_true', help='add the store to main_system.db for the admin user')
+    args = parser.parse_args()
+
+    sys.path.insert(0, APP_DIR)
+    import lekhleftest
+    output_dir = args.output_dir or lekhleftest.STORES_DIR
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, f'store_{args.store_id}.db')
+
+    started = time.perf_counter()
+    counts = generate_store(path, items=args.items, customers=args.customers, suppliers=args.suppliers,
+                            sales=args.sales, lines=args.lines, purchases=args.purchases, debts=args.debts,
+                            days=args.days, skew=args.skew, seed=args.seed,
+                            end=datetime.strptime(args.end_date, '%Y-%m-%d') if args.end_date else None)
+    print(f'{path} written in {time.perf_counter() - started:.1f}s')
+    for table, count in counts.items():
+        print(f'  {table:<15}{count:>10}')
+    if args.register:
+        register_store(lekhleftest.MAIN_DB_PATH, args.store_id, f'محل تجريبي {args.store_id}')
+        print(f'Registered store {args.store_id} in {lekhleftest.MAIN_DB_PATH}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+"""نقطة دخول ASGI اختيارية لتطبيق مكتبة لخلف
+
+تخدم نفس مسارات lekhleftest:app لكن داخل حلقة asyncio واحدة: الاتصالات الخاملة (نقاط البيع
+المفتوحة، الانتظار الطويل) لا تحجز عاملاً، وكل عمل متزامن (Flask + SQLite) يُنفَّذ في مجمع خيوط
+محدود خاص بكل محل. محل قاعدته مقفلة أو صفحة فواتير بطيئة لا تستهلك إلا خيوط ذلك المحل.
+
+يُحدَّد المحل من كوكي الجلسة الموقعة (session['store_id'])؛ الطلبات بدون محل (الدخول، المدير،
+الملفات الثابتة) تذهب إلى مجمع مشترك. يمكن تسجيل معالجات async أصلية لمسارات محددة عبر
+@async_route لتجاوز الجسر كلياً.
+
+التشغيل (uvicorn ليس ضمن المتطلبات الأساسية):
+    pip install uvicorn
+    uvicorn lekhlef_asgi:app --host 0.0.0.0 --port 8000
+"""
+import asyncio
+import functools
+import io
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import SimpleCookie
+
+# البث هنا معالج async أصلي لا يحجز خيطاً، فاللوحات المباشرة تستخدمه افتراضياً
+os.environ.setdefault('LEKHLEF_LIVE_UPDATES', 'stream')
+from lekhleftest import SSE_KEEPALIVE_SECONDS, app as flask_app, format_sse, open_event_subscription
+
+STORE_THREADS = int(os.environ.get('LEKHLEF_ASGI_STORE_THREADS', 4))  # خيوط كل محل
+SHARED_THREADS = int(os.environ.get('LEKHLEF_ASGI_THREADS', 16))  # خيوط الطلبات بدون محل
+MAX_BODY_BYTES = int(os.environ.get('LEKHLEF_ASGI_MAX_BODY', 16 * 1024 * 1024))
+
+_END = object()
+_async_routes = {}  # المسار -> معالج async(scope, receive, send)
+
+
+def async_route(path):
+    """تسجيل معالج ASGI أصلي لمسار بدلاً من تمريره إلى Flask"""
+    def decorator(handler):
+        _async_routes[path] = handler
+        return handler
+    return decorator
+
+
+# --------- Executors ---------
+_executors_lock = threading.Lock()
+_executors = {}  # store_id (أو None للمشترك) -> ThreadPoolExecutor
+
+
+def executor_for(store_id):
+    """مجمع الخيوط الخاص بالمحل (يُنشأ عند أول طلب)"""
+    with _executors_lock:
+        executor = _executors.get(store_id)
+        if executor is None:
+            workers = SHARED_THREADS if store_id is None else STORE_THREADS
+            prefix = 'lekhlef-shared' if store_id is None else f'lekhlef-store-{store_id}'
+            executor = _executors[store_id] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=prefix)
+        return executor
+
+
+def shutdown_executors():
+    with _executors_lock:
+        executors = list(_executors.values())
+        _executors.clear()
+    for executor in executors:
+        executor.shutdown(wait=True)
+
+
+def session_from_scope(scope):
+    """قراءة كوكي جلسة Flask الموقعة كقاموس (فارغ إذا لم توجد أو كانت غير صالحة)"""
+    cookie_header = b'; '.join(value for name, value in scope.get('headers', []) if name == b'cookie')
+    if not cookie_header:
+        return {}
+    cookies = SimpleCookie()
+    try:
+        cookies.load(cookie_header.decode('latin-1'))
+    except Exception:
+        return {}
+    morsel = cookies.get(flask_app.config['SESSION_COOKIE_NAME'])
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    if morsel is None or serializer is None:
+        return {}
+    try:
+        return serializer.loads(morsel.value, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+    except Exception:
+        return {}
+
+
+def store_id_from_scope(scope):
+    """store_id من الجلسة (None إذا لم يُختر محل)"""
+    store_id = session_from_scope(scope).get('store_id')
+    return store_id if isinstance(store_id, int) else None
+
+
+# --------- WSGI bridge ---------
+def build_environ(scope, body):
+    """تحويل نطاق ASGI إلى بيئة WSGI"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = 'HTTP_' + name
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+async def read_body(receive):
+    """قراءة جسم الطلب كاملاً (None إذا تجاوز الحد)"""
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ClientDisconnected()
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > MAX_BODY_BYTES:
+            return None
+        chunks.append(chunk)
+        if not message.get('more_body', False):
+            return b''.join(chunks)
+
+
+async def call_wsgi(wsgi_app, scope, body, send, executor):
+    """تشغيل تطبيق WSGI في مجمع الخيوط وبث استجابته قطعة قطعة"""
+    loop = asyncio.get_running_loop()
+    state = {'status': None, 'headers': None, 'started': False}
+
+    def start_response(status, headers, exc_info=None):
+        if exc_info and state['started']:
+            raise exc_info[1].with_traceback(exc_info[2])
+        state['status'], state['headers'] = status, headers
+        return lambda data: None  # write() القديمة غير مستخدمة في Flask
+
+    async def send_start():
+        if not state['started']:
+            state['started'] = True
+            await send({
+                'type': 'http.response.start',
+                'status': int(state['status'].split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in state['headers']],
+            })
+
+    result = await loop.run_in_executor(executor, wsgi_app, build_environ(scope, body), start_response)
+    try:
+        iterator = iter(result)
+        while True:
+            chunk = await loop.run_in_executor(executor, next, iterator, _END)
+            if chunk is _END:
+                break
+            await send_start()
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send_start()
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    finally:
+        close = getattr(result, 'close', None)
+        if close is not None:
+            await loop.run_in_executor(executor, close)
+
+
+class LekhlefASGI:
+    """تطبيق ASGI يوجّه كل طلب إلى مجمع خيوط محله"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        handler = _async_routes.get(scope['path'])
+        if handler is not None:
+            await handler(scope, receive, send)
+            return
+        try:
+            body = await read_body(receive)
+        except ClientDisconnected:
+            return
+        if body is None:
+            await send({'type': 'http.response.start', 'status': 413, 'headers': [(b'content-type', b'text/plain')]})
+            await send({'type': 'http.response.body', 'body': b'request body too large'})
+            return
+        await call_wsgi(self.wsgi_app, scope, body, send, executor_for(store_id_from_scope(scope)))
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await asyncio.get_running_loop().run_in_executor(None, shutdown_executors)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+@async_route('/events/stream')
+async def events_stream(scope, receive, send):
+    """بث أحداث المحل دون حجز خيط: الانتظار في حلقة asyncio والأحداث تصل من خيط المتابعة"""
+    data = session_from_scope(scope)
+    store_id = data.get('store_id')
+    if 'user_id' not in data or not isinstance(store_id, int):
+        await send({'type': 'http.response.start', 'status': 401, 'headers': [(b'content-type', b'text/plain')]})
+        await send({'type': 'http.response.body', 'body': b'login required'})
+        return
+    last_event_id = None
+    for name, value in scope.get('headers', []):
+        if name == b'last-event-id' and value.isdigit():
+            last_event_id = int(value)
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def deliver(event):
+        loop.call_soon_threadsafe(events.put_nowait, event)
+
+    backlog, unsubscribe = await run_sync(store_id, open_event_subscription, store_id, deliver, last_event_id)
+    disconnected = asyncio.ensure_future(wait_disconnect(receive))
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'), (b'cache-control', b'no-cache'), (b'x-accel-buffering', b'no')]})
+        sent_id = last_event_id or 0
+        chunks = ['retry: 3000\n\n'] + [format_sse(event) for event in backlog]
+        if backlog:
+            sent_id = backlog[-1]['id']
+        while not disconnected.done():
+            if chunks:
+                await send({'type': 'http.response.body', 'body': ''.join(chunks).encode('utf-8'), 'more_body': True})
+                chunks = []
+            next_event = asyncio.ensure_future(events.get())
+            done, _pending = await asyncio.wait({next_event, disconnected}, timeout=SSE_KEEPALIVE_SECONDS,
+                                                return_when=asyncio.FIRST_COMPLETED)
+            if next_event in done:
+                event = next_event.result()
+                if event['id'] > sent_id:
+                    sent_id = event['id']
+                    chunks.append(format_sse(event))
+            else:
+                next_event.cancel()
+                if not done:
+                    chunks.append(': keepalive\n\n')
+    finally:
+        disconnected.cancel()
+        unsubscribe()
+
+
+async def wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+def run_sync(store_id, func, *args, **kwargs):
+    """تنفيذ دالة متزامنة (مثل استعلام SQLite) من معالج async في مجمع خيوط المحل"""
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(executor_for(store_id), functools.partial(func, *args, **kwargs))
+
+
+app = LekhlefASGI(flask_app)
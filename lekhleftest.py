@@ -1,12 +1,28 @@
+import atexit
+import calendar
+import collections
+import hashlib
+import hmac
+import multiprocessing
 import os
 import sys
-from flask import Flask, g, render_template_string, request, redirect, url_for, flash, session
+from flask import Flask, Response, g, request, redirect, url_for, flash, session, has_request_context, stream_with_context
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
+from concurrent.futures import ProcessPoolExecutor
 import json
+import logging
+import logging.handlers
+import queue
+import re
+import shutil
+import threading
+import time
+import zipfile
 
 # --------- Configuration for EXE conversion ---------
 def get_application_path():
@@ -19,8 +35,30 @@ def get_application_path():
         return os.path.dirname(os.path.abspath(__file__))
 
 APP_DIR = get_application_path()
-MAIN_DB_PATH = os.path.join(APP_DIR, 'main_system.db')  # قاعدة البيانات الرئيسية للمستخدمين والمحلات
-STORES_DIR = os.path.join(APP_DIR, 'stores_data')  # مجلد قواعد بيانات المحلات
+DATA_DIR = os.environ.get('LEKHLEF_DATA_DIR', APP_DIR)  # يمكن توجيه البيانات إلى مجلد آخر (قياس الأداء، الاختبار)
+MAIN_DB_PATH = os.path.join(DATA_DIR, 'main_system.db')  # قاعدة البيانات الرئيسية للمستخدمين والمحلات
+STORES_DIR = os.path.join(DATA_DIR, 'stores_data')  # مجلد قواعد بيانات المحلات
+SALES_ARCHIVE_DIR = os.path.join(STORES_DIR, 'archive')  # أرشيف مبيعات السنوات المغلقة (ملف لكل محل وسنة)
+SQLITE_BUSY_TIMEOUT = 10  # ثواني انتظار القفل قبل إرجاع "database is locked"
+STOCK_RESERVATION_SECONDS = int(os.environ.get('LEKHLEF_RESERVATION_SECONDS', 120))  # 0 لتعطيل حجز السلة
+PROFILE_ENABLED = os.environ.get('LEKHLEF_PROFILE') == '1'  # قياس زمن الاستعلامات والقوالب لكل طلب
+SLOW_QUERY_MS = float(os.environ.get('LEKHLEF_SLOW_QUERY_MS', 0))  # عتبة سجل الاستعلامات البطيئة (0 = معطل)
+SLOW_QUERY_LOG = os.environ.get('LEKHLEF_SLOW_QUERY_LOG', os.path.join(DATA_DIR, 'logs', 'slow_queries.log'))
+WRITE_BATCH_MAX = int(os.environ.get('LEKHLEF_WRITE_BATCH_MAX', 32))  # أقصى عدد عمليات كتابة في معاملة واحدة
+WRITE_BATCH_WAIT = float(os.environ.get('LEKHLEF_WRITE_BATCH_WAIT_MS', 2)) / 1000  # انتظار عمليات إضافية قبل الحفظ
+WRITE_WAIT_SECONDS = float(os.environ.get('LEKHLEF_WRITE_WAIT_SECONDS', 45))  # أقصى انتظار لحفظ عملية كتابة قبل الخطأ
+METRICS_DIR = os.environ.get('LEKHLEF_METRICS_DIR')  # مجلد مشترك لتجميع مقاييس عمال gunicorn
+LIVE_UPDATES = os.environ.get('LEKHLEF_LIVE_UPDATES', 'poll')  # لوحات مباشرة: stream (SSE، يتطلب خيوطاً أو ASGI)، poll، off
+SSE_MAX_STREAMS = int(os.environ.get('LEKHLEF_SSE_MAX_STREAMS', 2))  # أقصى بث SSE متزامن في كل عملية WSGI؛ الزائد ينتقل إلى poll
+METRICS_TOKEN = os.environ.get('LEKHLEF_METRICS_TOKEN')  # يُطلب في ترويسة Authorization: Bearer؛ بدونه /metrics للجهاز المحلي فقط
+READER_POOL_SIZE = int(os.environ.get('LEKHLEF_READER_POOL_SIZE', 8))  # اتصالات القراءة المحفوظة لكل محل
+QUERY_CACHE_BYTES = int(float(os.environ.get('LEKHLEF_QUERY_CACHE_MB', 32)) * 1024 * 1024)  # 0 لتعطيل ذاكرة الاستعلامات
+PDF_CACHE_DIR = os.environ.get('LEKHLEF_PDF_CACHE_DIR', os.path.join(DATA_DIR, 'pdf_cache'))  # ملفات PDF المولّدة
+PDF_WORKERS = int(os.environ.get('LEKHLEF_PDF_WORKERS', 2))  # عمليات توليد PDF في الخلفية
+PDF_TIMEOUT = 60  # ثواني انتظار توليد ملف PDF داخل الطلب
+MAINTENANCE_ENABLED = os.environ.get('LEKHLEF_MAINTENANCE', '1') != '0'  # مجدول صيانة القواعد في الخلفية
+MAINTENANCE_IO_BYTES = int(float(os.environ.get('LEKHLEF_MAINTENANCE_IO_MB', 256)) * 1024 * 1024)  # ميزانية IO للصيانة في الساعة
+MAINTENANCE_QUIET_HOURS = os.environ.get('LEKHLEF_MAINTENANCE_QUIET_HOURS', '1-6')  # ساعات الهدوء للأعمال الثقيلة (فارغ = كل اليوم)
 
 # إعداد Flask مع مسارات صحيحة للتحويل
 app = Flask(__name__, 
@@ -28,6 +66,140 @@ app = Flask(__name__,
            template_folder=os.path.join(APP_DIR, 'templates'))
 app.secret_key = 'change_this_to_random_secret'
 
+# --------- Money (centimes) ---------
+# كل المبالغ تُحفظ وتُحسب أعداداً صحيحة بالسنتيم (12.50 د.ج = 1250): المجاميع في SQL وPython دقيقة
+# وسريعة بلا بقايا كسور عائمة. التحويل يتم عند الحدود فقط: parse_money لقيم النماذج وJSON،
+# وformat_money (الفلتر money في القوالب) للعرض وللمبالغ في ردود JSON.
+MONEY_SCALE = 100
+STORE_MONEY_COLUMNS = {
+    'items': ('buy_price', 'sell_price'),
+    'sales': ('total',),
+    'sale_items': ('price',),
+    'purchases': ('total',),
+    'purchase_items': ('price',),
+    'debts': ('original_amount', 'paid_amount', 'remaining_amount'),
+    'ledger_entries': ('amount', 'balance'),
+    'entity_balances': ('balance',),
+    'debt_aging': ('amount',),
+    'sales_archives': ('sales_total',),
+}
+
+def parse_money(value):
+    """مبلغ من نموذج أو JSON ("12.5"، "12,50"، 12.5) بالسنتيم؛ ValueError إذا لم يكن رقماً"""
+    text = str(value if value is not None else '').strip().replace(',', '.')
+    if not text:
+        return 0
+    try:
+        amount = Decimal(text)
+    except InvalidOperation:
+        raise ValueError(f'invalid amount: {value!r}') from None
+    if not amount.is_finite():
+        raise ValueError(f'invalid amount: {value!r}')
+    return int((amount * MONEY_SCALE).to_integral_value(rounding=ROUND_HALF_UP))
+
+@app.template_filter('money')
+def format_money(centimes):
+    """سنتيم -> نص بمنزلتين عشريتين (1250 -> "12.50")"""
+    centimes = int(centimes or 0)
+    units, cents = divmod(abs(centimes), MONEY_SCALE)
+    return f'{"-" if centimes < 0 else ""}{units}.{cents:02d}'
+
+def centimes_sql(column):
+    """تعبير SQL يحوّل مبلغاً بالدينار (أعمدة REAL القديمة) إلى سنتيم صحيح"""
+    return f'CAST(ROUND({column} * {MONEY_SCALE}) AS INTEGER)'
+
+# --------- Dates (timestamps) ---------
+# التواريخ تبقى نصاً '%Y-%m-%d %H:%M:%S' للعرض، ومعها عمود عدد صحيح مفهرس (sales.date_ts، purchases.date_ts،
+# debts.created_ts) بالثواني منذ 1970 بالتوقيت المحلي كما هو، أي نفس قيمة strftime('%s', date) في SQLite.
+# الترتيب والبحث بفترة يتمان على العمود الصحيح: بحث بنطاق في الفهرس بدل مقارنة نصوص قد تختلف صيغتها.
+STORE_DATE_COLUMNS = {
+    'sales': ('date', 'date_ts'),
+    'purchases': ('date', 'date_ts'),
+    'debts': ('date_created', 'created_ts'),
+}
+
+def date_ts(value):
+    """datetime أو نص تاريخ ISO ('2024-05-01'، '2024-05-01 10:30:00'، '2024-05-01T10:30') -> ثواني؛ ValueError إذا لم يكن تاريخاً"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.strip())
+    return calendar.timegm(value.timetuple())
+
+def date_ts_sql(column):
+    """تعبير SQL يحسب عمود الثواني من عمود تاريخ نصي (NULL إذا لم يكن تاريخاً)"""
+    return f"CAST(strftime('%s', {column}) AS INTEGER)"
+
+def parse_form_date(value):
+    """تاريخ من نموذج (حقل datetime-local أو نص ISO) -> (نص بالصيغة الموحدة، ثواني)؛ ValueError إذا لم يكن تاريخاً"""
+    moment = datetime.fromisoformat((value or '').strip()).replace(tzinfo=None)
+    return moment.strftime('%Y-%m-%d %H:%M:%S'), date_ts(moment)
+
+# صيغ التواريخ الحرة في القواعد القديمة (غير ISO) التي يحوّلها الترحيل إلى الصيغة الموحدة
+LEGACY_DATE_FORMATS = tuple(day + time for day in ('%Y-%m-%d', '%Y/%m/%d', '%d/%m/%Y', '%d-%m-%Y')
+                            for time in (' %H:%M:%S', ' %H:%M', ''))
+
+def parse_legacy_date(text):
+    """تاريخ نصي بصيغة ISO أو إحدى LEGACY_DATE_FORMATS -> datetime؛ None إذا لم يُفهم"""
+    text = (text or '').strip()
+    try:
+        return datetime.fromisoformat(text).replace(tzinfo=None)
+    except ValueError:
+        pass
+    for fmt in LEGACY_DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+    return None
+
+def day_range_ts(date_from, date_to):
+    """فترة أيام كاملة ('2024-01-01'، '2024-01-31') -> [بداية اليوم الأول، بداية اليوم التالي للأخير) بالثواني"""
+    return date_ts(date_from[:10]), date_ts(date_to[:10]) + 86400
+
+def backfill_date_timestamps(c):
+    """توحيد صيغة التواريخ النصية وملء أعمدة الثواني الفارغة (الترحيل، أو بعد إدخال جماعي)؛ ترجع عدد التواريخ غير المفهومة.
+    صيغ ISO في SQL دفعة واحدة، ثم الصيغ القديمة الأخرى في Python. ما لا يُفهم يبقى نصه كما هو ويأخذ ثواني
+    أقرب صف قبله (أو بعده) بالرقم حتى يبقى داخل الفترات والترتيب، ويُسجَّل في date_fallbacks للمراجعة."""
+    ensure_date_fallbacks(c)
+    now = datetime.now()
+    fallbacks = 0
+    for table, (column, ts_column) in STORE_DATE_COLUMNS.items():
+        c.execute(f'''UPDATE {table} SET {column} = COALESCE(strftime('%Y-%m-%d %H:%M:%S', {column}), {column}),
+                                         {ts_column} = {date_ts_sql(column)}
+                      WHERE {ts_column} IS NULL''')
+        c.execute(f'SELECT id, {column} FROM {table} WHERE {ts_column} IS NULL ORDER BY id')
+        for row_id, text in c.fetchall():
+            moment = parse_legacy_date(text)
+            if moment is not None:
+                c.execute(f'UPDATE {table} SET {column} = ?, {ts_column} = ? WHERE id = ?',
+                          (moment.strftime('%Y-%m-%d %H:%M:%S'), date_ts(moment), row_id))
+                continue
+            c.execute(f'SELECT {ts_column} FROM {table} WHERE id < ? AND {ts_column} IS NOT NULL ORDER BY id DESC LIMIT 1',
+                      (row_id,))
+            neighbour = c.fetchone() or c.execute(f'''SELECT {ts_column} FROM {table} WHERE id > ? AND {ts_column} IS NOT NULL
+                                                       ORDER BY id LIMIT 1''', (row_id,)).fetchone()
+            timestamp = neighbour[0] if neighbour else date_ts(now)
+            c.execute(f'UPDATE {table} SET {ts_column} = ? WHERE id = ?', (timestamp, row_id))
+            record_date_fallback(c, table, row_id, text, timestamp)
+            fallbacks += 1
+    return fallbacks
+
+def ensure_date_fallbacks(c):
+    """جدول التواريخ غير المفهومة: موجود في كل محل بعد الترحيل حتى لو كان فارغاً (يقرؤه فحص الاتساق)"""
+    c.execute('''CREATE TABLE IF NOT EXISTS date_fallbacks (
+                    table_name TEXT NOT NULL,
+                    row_id INTEGER NOT NULL,
+                    original TEXT,
+                    assigned_ts INTEGER NOT NULL,
+                    recorded_at TEXT NOT NULL,
+                    PRIMARY KEY (table_name, row_id)
+                )''')
+
+def record_date_fallback(c, table, row_id, original, assigned_ts):
+    """تسجيل تاريخ غير مفهوم أُعطي قيمة بديلة (للمراجعة، ويتجاهله فحص الاتساق ما دام نصه لم يتغير)"""
+    ensure_date_fallbacks(c)
+    c.execute('INSERT OR REPLACE INTO date_fallbacks VALUES (?, ?, ?, ?, ?)',
+              (table, row_id, original, assigned_ts, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+
 # --------- Authentication helpers ---------
 def login_required(f):
     """ديكوراتور لحماية الصفحات التي تتطلب تسجيل دخول"""
@@ -123,9 +295,12 @@ def get_main_db():
     """الحصول على اتصال قاعدة البيانات الرئيسية"""
     db = getattr(g, '_main_database', None)
     if db is None:
+        started = time.perf_counter()
         ensure_main_database_exists()
-        db = g._main_database = sqlite3.connect(MAIN_DB_PATH)
+        db = g._main_database = sqlite3.connect(MAIN_DB_PATH, timeout=SQLITE_BUSY_TIMEOUT, factory=connection_factory())
         db.row_factory = sqlite3.Row
+        metric_inc('lekhlef_db_connections_opened_total', {'db': 'main'})
+        profile_add('connect', time.perf_counter() - started)
     return db
 
 def get_store_db():
@@ -135,12 +310,76 @@ def get_store_db():
     
     store_db = getattr(g, '_store_database', None)
     if store_db is None:
-        store_db_path = get_store_db_path(session['store_id'])
-        ensure_store_database_exists(session['store_id'])
-        store_db = g._store_database = sqlite3.connect(store_db_path)
-        store_db.row_factory = sqlite3.Row
+        started = time.perf_counter()
+        store_id = session['store_id']
+        ensure_store_database_exists(store_id)
+        if request.method in ('GET', 'HEAD') and not g.get('_store_writes'):
+            store_db = acquire_store_reader(store_id)
+            g._store_database_readonly = True
+        else:
+            store_db = open_store_connection(store_id)
+        g._store_database = store_db
+        g._store_database_id = store_id
+        profile_add('connect', time.perf_counter() - started)
     return store_db
 
+def open_store_connection(store_id, readonly=False):
+    """اتصال جديد بقاعدة المحل؛ للقراءة فقط: mode=ro مع query_only فلا يأخذ أي قفل كتابة"""
+    path = get_store_db_path(store_id)
+    if readonly:
+        db = sqlite3.connect(f'file:{path}?mode=ro', uri=True, timeout=SQLITE_BUSY_TIMEOUT,
+                             factory=connection_factory(), check_same_thread=False)
+        db.execute('PRAGMA query_only = ON')
+    else:
+        # uri=True حتى يمكن إرفاق أرشيفات المبيعات بصيغة file:...?mode=ro
+        db = sqlite3.connect(f'file:{path}', uri=True, timeout=SQLITE_BUSY_TIMEOUT, factory=connection_factory())
+    db.row_factory = sqlite3.Row
+    metric_inc('lekhlef_db_connections_opened_total', {'db': 'store_ro' if readonly else 'store'})
+    metric_gauge_add('lekhlef_store_db_open_handles', 1)
+    return db
+
+def close_store_connection(db, readonly=False):
+    db.close()
+    metric_inc('lekhlef_db_connections_closed_total', {'db': 'store_ro' if readonly else 'store'})
+    metric_gauge_add('lekhlef_store_db_open_handles', -1)
+
+# مجمع اتصالات القراءة لكل محل: طلبات GET تستعير اتصالاً جاهزاً وتعيده، منفصلة عن اتصالات الكتابة
+_store_readers = {}  # store_id -> LifoQueue
+_store_readers_lock = threading.Lock()
+
+def acquire_store_reader(store_id):
+    with _store_readers_lock:
+        readers = _store_readers.setdefault(store_id, queue.LifoQueue())
+    try:
+        return readers.get_nowait()
+    except queue.Empty:
+        return open_store_connection(store_id, readonly=True)
+
+def release_store_reader(store_id, db):
+    if db.in_transaction:
+        db.rollback()
+    with _store_readers_lock:
+        readers = _store_readers.get(store_id)
+        if readers is not None and readers.qsize() < READER_POOL_SIZE:
+            readers.put(db)
+            return
+    close_store_connection(db, readonly=True)
+
+def drop_store_readers(store_id):
+    """إغلاق اتصالات القراءة المحفوظة لمحل (قبل حذف قاعدته)"""
+    with _store_readers_lock:
+        readers = _store_readers.pop(store_id, None)
+    while readers is not None and not readers.empty():
+        close_store_connection(readers.get_nowait(), readonly=True)
+
+def store_writes(f):
+    """ديكوراتور لمسارات GET التي تكتب في قاعدة المحل (تحصل على اتصال قراءة وكتابة بدل اتصال القراءة فقط)"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        g._store_writes = True
+        return f(*args, **kwargs)
+    return decorated_function
+
 # --------- DB helpers ---------
 def ensure_main_database_exists():
     """التأكد من وجود قاعدة البيانات الرئيسية وإنشاؤها إذا لم تكن موجودة"""
@@ -226,35 +465,940 @@ def ensure_store_database_exists(store_id):
     ensure_stores_directory()
     store_db_path = get_store_db_path(store_id)
     
+    if store_id not in _migrated_stores:
+        initialize_store_database(store_db_path)
+        _migrated_stores.add(store_id)
+
+def initialize_store_database(store_db_path):
+    """إنشاء قاعدة بيانات محل في المسار المحدد (نسخة من القاعدة النموذجية إن لم تكن موجودة) وترقيتها إلى آخر مخطط"""
     if not os.path.exists(store_db_path):
-        # إنشاء قاعدة بيانات المحل الجديدة
-        db = sqlite3.connect(store_db_path)
-        db.row_factory = sqlite3.Row
-        c = db.cursor()
-        
-        # إنشاء جداول المحل
-        c.execute('''CREATE TABLE IF NOT EXISTS items (id INTEGER PRIMARY KEY AUTOINCREMENT, code TEXT UNIQUE, name TEXT, buy_price REAL DEFAULT 0, sell_price REAL DEFAULT 0, qty INTEGER DEFAULT 0)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS customers (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, phone TEXT, note TEXT)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS suppliers (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, phone TEXT, note TEXT)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS sales (id INTEGER PRIMARY KEY AUTOINCREMENT, customer_id INTEGER, date TEXT, total REAL)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS sale_items (id INTEGER PRIMARY KEY AUTOINCREMENT, sale_id INTEGER, item_id INTEGER, qty INTEGER, price REAL)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS purchases (id INTEGER PRIMARY KEY AUTOINCREMENT, supplier_id INTEGER, date TEXT, total REAL)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS purchase_items (id INTEGER PRIMARY KEY AUTOINCREMENT, purchase_id INTEGER, item_id INTEGER, qty INTEGER, price REAL)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS debts (
+        clone_store_template(store_db_path)
+    
+    db = sqlite3.connect(store_db_path, timeout=SQLITE_BUSY_TIMEOUT)
+    try:
+        # WAL: القراءات تستمر بالتوازي مع الكاتب بدلاً من انتظار قفل القاعدة
+        db.execute('PRAGMA journal_mode = WAL')
+        migrate_store_database(db)
+    finally:
+        db.close()
+
+def create_store_schema(c):
+    """جداول المحل الأساسية (المخطط قبل الترحيلات)"""
+    c.execute('''CREATE TABLE IF NOT EXISTS items (id INTEGER PRIMARY KEY AUTOINCREMENT, code TEXT UNIQUE, name TEXT, buy_price REAL DEFAULT 0, sell_price REAL DEFAULT 0, qty INTEGER DEFAULT 0)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS customers (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, phone TEXT, note TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS suppliers (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, phone TEXT, note TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS sales (id INTEGER PRIMARY KEY AUTOINCREMENT, customer_id INTEGER, date TEXT, total REAL)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS sale_items (id INTEGER PRIMARY KEY AUTOINCREMENT, sale_id INTEGER, item_id INTEGER, qty INTEGER, price REAL)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS purchases (id INTEGER PRIMARY KEY AUTOINCREMENT, supplier_id INTEGER, date TEXT, total REAL)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS purchase_items (id INTEGER PRIMARY KEY AUTOINCREMENT, purchase_id INTEGER, item_id INTEGER, qty INTEGER, price REAL)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS debts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                entity_type TEXT NOT NULL,
+                entity_id INTEGER NOT NULL,
+                original_amount REAL NOT NULL,
+                paid_amount REAL DEFAULT 0,
+                remaining_amount REAL NOT NULL,
+                date_created TEXT NOT NULL,
+                date_updated TEXT,
+                note TEXT
+            )''')
+
+# --------- Store template ---------
+# المحلات الجديدة تُنسخ من قاعدة نموذجية جاهزة (الجداول، كل الترحيلات والفهارس، حجم صفحة ثابت) بدل تنفيذ
+# المخطط لكل محل. النموذج يُبنى مرة لكل إصدار مخطط داخل STORES_DIR ويُعاد بناؤه تلقائياً عند إضافة ترحيل.
+STORE_PAGE_SIZE = 4096
+FICLONE = 0x40049409  # ioctl نسخ الملف بالإشارة (btrfs، xfs) على لينكس
+_store_template_lock = threading.Lock()
+
+def store_template_path():
+    return os.path.join(STORES_DIR, f'_template_v{len(STORE_SCHEMA_MIGRATIONS)}.db')
+
+def build_store_template():
+    """بناء القاعدة النموذجية للإصدار الحالي من المخطط وحذف نماذج الإصدارات السابقة"""
+    ensure_stores_directory()
+    path = store_template_path()
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    db = sqlite3.connect(tmp_path)
+    try:
+        db.execute(f'PRAGMA page_size = {STORE_PAGE_SIZE}')
+        db.execute('PRAGMA auto_vacuum = INCREMENTAL')  # الصفحات الفارغة تُعاد بالصيانة دون VACUUM كامل
+        create_store_schema(db.cursor())
+        db.commit()
+        migrate_store_database(db)
+        db.execute('VACUUM')
+        db.execute('PRAGMA journal_mode = WAL')
+    finally:
+        db.close()
+    os.replace(tmp_path, path)
+    for filename in os.listdir(STORES_DIR):
+        if filename.startswith('_template_v') and filename.endswith('.db') and filename != os.path.basename(path):
+            os.remove(os.path.join(STORES_DIR, filename))
+    return path
+
+def copy_file_fast(src, dst):
+    """نسخ ملف بالإشارة (reflink) إن دعمه نظام الملفات، وإلا نسخ عادي"""
+    try:
+        import fcntl
+        with open(src, 'rb') as source, open(dst, 'wb') as target:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        return
+    except (ImportError, OSError):
+        pass
+    shutil.copyfile(src, dst)
+
+def clone_store_template(store_db_path):
+    """إنشاء قاعدة محل جديدة بنسخ القاعدة النموذجية (لا تستبدل قاعدة موجودة)"""
+    template = store_template_path()
+    with _store_template_lock:
+        if not os.path.exists(template):
+            build_store_template()
+    tmp_path = f'{store_db_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    copy_file_fast(template, tmp_path)
+    try:
+        os.link(tmp_path, store_db_path)  # يفشل إن أنشأت عملية أخرى القاعدة في نفس اللحظة
+    except FileExistsError:
+        pass
+    except OSError:
+        if not os.path.exists(store_db_path):
+            os.replace(tmp_path, store_db_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+# --------- Ledger (customer / supplier balances) ---------
+# كل دين يُسجَّل كقيد مدين (charge) وكل تسديد كقيد دائن (payment) في ledger_entries مع الرصيد الجاري بعده،
+# والرصيد الحالي لكل طرف محفوظ في entity_balances: فحص رصيد الزبون عند الصندوق استعلام واحد بالمفتاح.
+# الرصيد موجب = مبلغ مستحق لنا على الزبون، أو مستحق علينا للمورد.
+def post_ledger_entry(c, entity_type, entity_id, kind, amount, entry_date, debt_id=None, note=None):
+    """تسجيل قيد وتحديث رصيد الطرف داخل المعاملة الحالية؛ amount موجب للدين وسالب للتسديد. ترجع الرصيد الجديد"""
+    c.execute('''INSERT INTO entity_balances (entity_type, entity_id, balance, updated_at) VALUES (?, ?, ?, ?)
+                 ON CONFLICT (entity_type, entity_id) DO UPDATE SET balance = balance + excluded.balance,
+                                                                    updated_at = excluded.updated_at''',
+              (entity_type, entity_id, amount, entry_date))
+    c.execute('SELECT balance FROM entity_balances WHERE entity_type = ? AND entity_id = ?', (entity_type, entity_id))
+    balance = c.fetchone()[0]
+    c.execute('''INSERT INTO ledger_entries (entity_type, entity_id, entry_date, kind, amount, balance, debt_id, note)
+                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', (entity_type, entity_id, entry_date, kind, amount, balance, debt_id, note))
+    return balance
+
+def entity_balance(c, entity_type, entity_id):
+    """الرصيد الحالي لزبون أو مورد (0 إذا لم تكن له قيود)"""
+    c.execute('SELECT balance FROM entity_balances WHERE entity_type = ? AND entity_id = ?', (entity_type, entity_id))
+    row = c.fetchone()
+    return row[0] if row else 0
+
+def rebuild_ledger(c, now=None):
+    """إعادة بناء القيود والأرصدة من جدول الديون (الترحيل الأول، أو بعد إدخال ديون جماعي)؛
+    now وقت تحديث الأرصدة (افتراضياً الآن، والمولّد يمرر تاريخ نهايته حتى يبقى ناتجه حتمياً)"""
+    c.execute('DELETE FROM ledger_entries')
+    c.execute('DELETE FROM entity_balances')
+    c.execute('''SELECT id, entity_type, entity_id, original_amount, paid_amount, date_created,
+                        COALESCE(date_updated, date_created), COALESCE(notes, note) FROM debts''')
+    movements = []
+    for debt_id, entity_type, entity_id, original, paid, created, updated, note in c.fetchall():
+        movements.append((created, debt_id, 0, entity_type, entity_id, 'charge', original, note))
+        if paid:
+            movements.append((updated, debt_id, 1, entity_type, entity_id, 'payment', -paid, None))
+    movements.sort(key=lambda movement: movement[:3])
+    balances, entries = {}, []
+    for entry_date, debt_id, _order, entity_type, entity_id, kind, amount, note in movements:
+        key = (entity_type, entity_id)
+        balances[key] = balances.get(key, 0) + amount
+        entries.append((entity_type, entity_id, entry_date, kind, amount, balances[key], debt_id, note))
+    c.executemany('''INSERT INTO ledger_entries (entity_type, entity_id, entry_date, kind, amount, balance, debt_id, note)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', entries)
+    updated_at = (now or datetime.now()).strftime('%Y-%m-%d %H:%M:%S')
+    c.executemany('INSERT INTO entity_balances (entity_type, entity_id, balance, updated_at) VALUES (?, ?, ?, ?)',
+                  [(entity_type, entity_id, balance, updated_at) for (entity_type, entity_id), balance in balances.items()])
+
+def _migrate_debts_ledger(c):
+    # أعمدة يستعملها الكود منذ زمن ولم تكن في المخطط الأصلي
+    columns = {row[1] for row in c.execute('PRAGMA table_info(debts)').fetchall()}
+    if 'status' not in columns:
+        c.execute("ALTER TABLE debts ADD COLUMN status TEXT NOT NULL DEFAULT 'open'")
+    if 'notes' not in columns:
+        c.execute('ALTER TABLE debts ADD COLUMN notes TEXT')
+        c.execute('UPDATE debts SET notes = note')
+    c.execute('''UPDATE debts SET remaining_amount = original_amount - paid_amount,
+                 status = CASE WHEN paid_amount >= original_amount THEN 'paid' ELSE 'open' END''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_debts_entity ON debts (entity_type, status, entity_id)')
+    c.execute('''CREATE TABLE IF NOT EXISTS ledger_entries (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     entity_type TEXT NOT NULL,
                     entity_id INTEGER NOT NULL,
-                    original_amount REAL NOT NULL,
-                    paid_amount REAL DEFAULT 0,
-                    remaining_amount REAL NOT NULL,
-                    date_created TEXT NOT NULL,
-                    date_updated TEXT,
+                    entry_date TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    amount REAL NOT NULL,
+                    balance REAL NOT NULL,
+                    debt_id INTEGER,
                     note TEXT
                 )''')
-        
+    c.execute('CREATE INDEX IF NOT EXISTS idx_ledger_entity_date ON ledger_entries (entity_type, entity_id, entry_date)')
+    c.execute('''CREATE TABLE IF NOT EXISTS entity_balances (
+                    entity_type TEXT NOT NULL,
+                    entity_id INTEGER NOT NULL,
+                    balance REAL NOT NULL DEFAULT 0,
+                    updated_at TEXT,
+                    PRIMARY KEY (entity_type, entity_id)
+                ) WITHOUT ROWID''')
+    rebuild_ledger(c)
+
+# --------- Debt payments ---------
+def apply_debt_payment(c, debt_id, amount, payment_date):
+    """تسديد مشروط لدين واحد مع قيده في الدفتر وتحديث فئة عمره، داخل معاملة الكاتب.
+    التعديل لا يتم إلا إذا كان الدين مفتوحاً ومتبقيه يغطي المبلغ (لا تسديد مزدوج ولا تحديثات ضائعة)."""
+    c.execute('SELECT entity_type, entity_id, remaining_amount, aging_bucket FROM debts WHERE id = ?', (debt_id,))
+    debt = c.fetchone()
+    if not debt:
+        raise WriteRejected([f'❌ خطأ: الدين رقم {debt_id} غير موجود.'])
+    c.execute('''UPDATE debts SET paid_amount = paid_amount + ?, remaining_amount = remaining_amount - ?,
+                        status = CASE WHEN remaining_amount - ? <= 0 THEN 'paid' ELSE 'open' END, date_updated = ?
+                 WHERE id = ? AND status = 'open' AND remaining_amount >= ?''',
+              (amount, amount, amount, payment_date, debt_id, amount))
+    if c.rowcount == 0:
+        raise WriteRejected([f'❌ خطأ: لا يمكن تسديد مبلغ أكبر من المتبقي. المبلغ المتبقي هو: {format_money(max(debt["remaining_amount"], 0))} د.ج'])
+    remaining = debt['remaining_amount'] - amount
+    status = 'paid' if remaining <= 0 else 'open'
+    post_ledger_entry(c, debt['entity_type'], debt['entity_id'], 'payment', -amount, payment_date, debt_id=debt_id)
+    if debt['aging_bucket'] is not None:
+        adjust_debt_aging(c, debt['entity_type'], debt['entity_id'], debt['aging_bucket'], -amount, -1 if status == 'paid' else 0)
+    return {'debt_id': debt_id, 'entity_type': debt['entity_type'], 'paid': amount, 'remaining': remaining, 'status': status}
+
+def allocate_debt_payment(c, entity_type, entity_id, amount, debt_ids, payment_date):
+    """توزيع مبلغ على ديون طرف مفتوحة: حسب debt_ids بالترتيب إن وُجدت، وإلا الأقدم أولاً"""
+    c.execute('''SELECT id, remaining_amount FROM debts WHERE entity_type = ? AND entity_id = ? AND status = 'open'
+                 ORDER BY created_ts, id''', (entity_type, entity_id))
+    open_debts = {row['id']: row['remaining_amount'] for row in c.fetchall()}
+    if debt_ids:
+        unknown = [debt_id for debt_id in debt_ids if debt_id not in open_debts]
+        if unknown:
+            raise WriteRejected([f'❌ خطأ: الديون {", ".join(map(str, unknown))} غير مفتوحة لهذا الطرف.'])
+        order = list(dict.fromkeys(debt_ids))
+    else:
+        order = list(open_debts)
+    total_open = sum(open_debts[debt_id] for debt_id in order)
+    if amount > total_open:
+        raise WriteRejected([f'❌ خطأ: المبلغ أكبر من مجموع الديون المفتوحة ({format_money(total_open)} د.ج).'])
+    
+    allocations, left = [], amount
+    for debt_id in order:
+        if left <= 0:
+            break
+        share = open_debts[debt_id] if open_debts[debt_id] <= left else left
+        allocation = apply_debt_payment(c, debt_id, share, payment_date)
+        del allocation['entity_type']
+        allocations.append(allocation)
+        left -= share
+    return allocations
+
+# --------- Debt aging ---------
+# كل دين مفتوح يحمل رقم فئة عمره (aging_bucket) والمجاميع لكل طرف وفئة محفوظة في debt_aging.
+# الإضافة والتسديد يعدّلان المجاميع مباشرة، ومرة في اليوم تُنقل الديون التي عبرت حدود الفئات فقط
+# (بحث بالفهرس على status, aging_bucket, created_ts) بدلاً من إعادة حساب كل الديون.
+AGING_BUCKETS = ('0-30', '31-60', '61-90', '90+')
+AGING_LIMITS = (30, 60, 90)  # آخر يوم عمر في كل فئة قبل الأخيرة
+
+def aging_bucket_for(created, today):
+    """فئة عمر دين من ثواني إنشائه (created_ts) أو من تاريخه النصي؛ None إذا لم يُفهم التاريخ"""
+    if isinstance(created, int):
+        created_on = (datetime(1970, 1, 1) + timedelta(seconds=created)).date()
+    else:
+        moment = parse_legacy_date(created)
+        if moment is None:
+            return None
+        created_on = moment.date()
+    age = (today - created_on).days
+    for bucket, limit in enumerate(AGING_LIMITS):
+        if age <= limit:
+            return bucket
+    return len(AGING_LIMITS)
+
+def debt_aging_bucket(c, debt_id, date_created, created_ts, today):
+    """فئة عمر الدين من created_ts إن وُجد وإلا من النص (الترحيلات قبل عمود الثواني)؛
+    التاريخ غير المفهوم يُعدّ ديناً جديداً (الفئة 0) ويُسجَّل في date_fallbacks بدل إيقاف الترحيل"""
+    bucket = aging_bucket_for(created_ts if created_ts is not None else date_created, today)
+    if bucket is None:
+        record_date_fallback(c, 'debts', debt_id, date_created, date_ts(today.isoformat()))
+        bucket = 0
+    return bucket
+
+def adjust_debt_aging(c, entity_type, entity_id, bucket, amount, count=0):
+    """تعديل مجموع فئة عمر لطرف (amount وcount فروقات موجبة أو سالبة)"""
+    c.execute('''INSERT INTO debt_aging (entity_type, entity_id, bucket, amount, debt_count) VALUES (?, ?, ?, ?, ?)
+                 ON CONFLICT (entity_type, entity_id, bucket) DO UPDATE SET amount = amount + excluded.amount,
+                                                                            debt_count = debt_count + excluded.debt_count''',
+              (entity_type, entity_id, bucket, amount, count))
+
+def rebucket_debts(c, today):
+    """نقل الديون المفتوحة التي تجاوزت حد فئتها منذ آخر تشغيل، وتحديث المجاميع؛ ترجع عدد الديون المنقولة"""
+    moved = []
+    for bucket, limit in enumerate(AGING_LIMITS):
+        cutoff = date_ts((today - timedelta(days=limit)).isoformat())
+        c.execute('''SELECT id, entity_type, entity_id, remaining_amount, date_created, created_ts FROM debts
+                     WHERE status = 'open' AND aging_bucket = ? AND created_ts < ?''', (bucket, cutoff))
+        for debt_id, entity_type, entity_id, remaining, date_created, created_ts in c.fetchall():
+            new_bucket = debt_aging_bucket(c, debt_id, date_created, created_ts, today)
+            moved.append((debt_id, entity_type, entity_id, remaining, bucket, new_bucket))
+    for debt_id, entity_type, entity_id, remaining, old_bucket, new_bucket in moved:
+        adjust_debt_aging(c, entity_type, entity_id, old_bucket, -remaining, -1)
+        adjust_debt_aging(c, entity_type, entity_id, new_bucket, remaining, 1)
+    c.executemany('UPDATE debts SET aging_bucket = ? WHERE id = ?', [(row[5], row[0]) for row in moved])
+    c.execute('DELETE FROM debt_aging WHERE debt_count <= 0')
+    c.execute("INSERT OR REPLACE INTO store_meta (key, value) VALUES ('aging_date', ?)", (today.isoformat(),))
+    return len(moved)
+
+_aging_checked = {}  # store_id -> آخر تاريخ تم فيه التحقق داخل هذه العملية
+
+def ensure_debt_aging_current(store_id):
+    """تشغيل إعادة التصنيف اليومية لمحل إن لم تُشغَّل اليوم (أول طلب يحتاج الفئات في اليوم)"""
+    today = datetime.now().date()
+    if _aging_checked.get(store_id) == today:
+        return
+    
+    def refresh(c):
+        c.execute("SELECT value FROM store_meta WHERE key = 'aging_date'")
+        row = c.fetchone()
+        if row is None or row[0] != today.isoformat():
+            rebucket_debts(c, today)
+    
+    run_store_write(refresh, store_id)
+    _aging_checked[store_id] = today
+
+def rebuild_debt_aging(c, today):
+    """حساب الفئات والمجاميع من الصفر (الترحيل أو بعد إدخال ديون جماعي)"""
+    c.execute('DELETE FROM debt_aging')
+    has_ts = any(row[1] == 'created_ts' for row in c.execute('PRAGMA table_info(debts)').fetchall())
+    ts_column = 'created_ts' if has_ts else 'NULL'
+    c.execute(f"""SELECT id, entity_type, entity_id, remaining_amount, date_created, {ts_column}
+                   FROM debts WHERE status = 'open'""")
+    totals, updates = {}, []
+    for debt_id, entity_type, entity_id, remaining, date_created, created_ts in c.fetchall():
+        bucket = debt_aging_bucket(c, debt_id, date_created, created_ts, today)
+        updates.append((bucket, debt_id))
+        amount, count = totals.get((entity_type, entity_id, bucket), (0, 0))
+        totals[(entity_type, entity_id, bucket)] = (amount + remaining, count + 1)
+    c.execute('UPDATE debts SET aging_bucket = NULL')
+    c.executemany('UPDATE debts SET aging_bucket = ? WHERE id = ?', updates)
+    c.executemany('INSERT INTO debt_aging (entity_type, entity_id, bucket, amount, debt_count) VALUES (?, ?, ?, ?, ?)',
+                  [key + value for key, value in totals.items()])
+    c.execute("INSERT OR REPLACE INTO store_meta (key, value) VALUES ('aging_date', ?)", (today.isoformat(),))
+
+def _migrate_debt_aging(c):
+    c.execute('ALTER TABLE debts ADD COLUMN aging_bucket INTEGER')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_debts_aging ON debts (status, aging_bucket, date_created)')
+    c.execute('''CREATE TABLE IF NOT EXISTS debt_aging (
+                    entity_type TEXT NOT NULL,
+                    entity_id INTEGER NOT NULL,
+                    bucket INTEGER NOT NULL,
+                    amount REAL NOT NULL DEFAULT 0,
+                    debt_count INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (entity_type, entity_id, bucket)
+                ) WITHOUT ROWID''')
+    c.execute('CREATE TABLE IF NOT EXISTS store_meta (key TEXT PRIMARY KEY, value TEXT)')
+    rebuild_debt_aging(c, datetime.now().date())
+
+# --------- Sales archives ---------
+# مبيعات كل سنة مغلقة تُنقل (archive_sales.py) إلى ملف مستقل للقراءة فقط، وتُسجَّل في sales_archives
+# مع مجاميعها. التقارير التي تحتاج التاريخ الكامل ترفق الأرشيفات عند الحاجة وتقرأ من العرضين المؤقتين
+# sales_all وsale_items_all (الجداول الحالية UNION ALL كل الأرشيفات) بنفس أعمدة الجداول الحالية.
+def sales_archive_path(store_id, year):
+    return os.path.join(SALES_ARCHIVE_DIR, f'store_{store_id}_{year}.db')
+
+def sales_archive_files(store_id):
+    """ملفات أرشيف المحل الموجودة على القرص (لحذف المحل)"""
+    if not os.path.isdir(SALES_ARCHIVE_DIR):
+        return []
+    prefix = f'store_{store_id}_'
+    return [os.path.join(SALES_ARCHIVE_DIR, name) for name in os.listdir(SALES_ARCHIVE_DIR)
+            if name.startswith(prefix) and name[len(prefix):].split('.')[0].isdigit()]
+
+def attach_sales_archives(db, store_id=None):
+    """إرفاق أرشيفات المحل بالاتصال (للقراءة فقط، مرة لكل اتصال) وإنشاء sales_all وsale_items_all؛
+    ترجع سنوات الأرشيف (قائمة فارغة = لا أرشيف والجداول الحالية تكفي). لا تُستدعى داخل معاملة."""
+    archives = db.execute('SELECT year, centimes FROM sales_archives ORDER BY year').fetchall()
+    years = [row[0] for row in archives]
+    attached = {row[1] for row in db.execute('PRAGMA database_list')}
+    has_views = db.execute("SELECT 1 FROM temp.sqlite_master WHERE name = 'sales_all'").fetchone() is not None
+    if has_views and all(f'sales_{year}' in attached for year in years):
+        return years
+    query_only = db.execute('PRAGMA query_only').fetchone()[0]
+    if query_only:
+        db.execute('PRAGMA query_only = OFF')  # الإرفاق والعروض المؤقتة لا تكتب في قاعدة المحل (mode=ro)
+    try:
+        store_id = store_id if store_id is not None else session['store_id']
+        for year in years:
+            if f'sales_{year}' not in attached:
+                # immutable: الملف لا يتغير بعد إنشائه فلا أقفال ولا ملف -shm
+                db.execute(f'ATTACH DATABASE ? AS sales_{year}', (f'file:{sales_archive_path(store_id, year)}?mode=ro&immutable=1',))
+        for table in ('sales', 'sale_items'):
+            columns = [row[1] for row in db.execute(f'PRAGMA main.table_info({table})')]
+            selects = [f'SELECT {", ".join(columns)} FROM main.{table}']
+            for year, centimes in archives:
+                archived = {row[1] for row in db.execute(f'PRAGMA sales_{year}.table_info({table})')}
+                converted = () if centimes else STORE_MONEY_COLUMNS[table]  # أرشيف من قبل السنتيم: مبالغه بالدينار
+                sources = []
+                for column in columns:
+                    if column == 'date_ts' and column not in archived:  # أرشيف من قبل عمود الثواني
+                        sources.append(f'{date_ts_sql("date")} AS {column}')
+                    elif column not in archived:
+                        sources.append(f'NULL AS {column}')
+                    elif column in converted:
+                        sources.append(f'{centimes_sql(column)} AS {column}')
+                    else:
+                        sources.append(column)
+                selects.append(f'SELECT {", ".join(sources)} FROM sales_{year}.{table}')
+            db.execute(f'DROP VIEW IF EXISTS temp.{table}_all')
+            db.execute(f'CREATE TEMP VIEW {table}_all AS ' + ' UNION ALL '.join(selects))
+    finally:
+        if query_only:
+            db.execute('PRAGMA query_only = ON')
+    return years
+
+def archived_sales_totals():
+    """(عدد، مجموع) مبيعات الأرشيف من السجل دون فتح ملفاته"""
+    return tuple(cached_query('SELECT COALESCE(SUM(sales_count), 0), COALESCE(SUM(sales_total), 0) FROM sales_archives')[0])
+
+# --------- Stock adjustments ---------
+# الكمية المتوقعة لكل صنف = تعديلاته (الرصيد الافتتاحي، الجرد اليدوي) + المشتريات - المبيعات.
+# كل تغيير للكمية خارج البيع والتوريد يُسجَّل في stock_adjustments حتى يمكن كشف انحراف items.qty.
+STOCK_EXPECTED_SQL = '''SELECT i.id, i.name, i.qty,
+                              COALESCE(a.qty, 0) + COALESCE(p.qty, 0) - COALESCE(s.qty, 0) AS expected
+                       FROM items i
+                       LEFT JOIN (SELECT item_id, SUM(qty) AS qty FROM stock_adjustments GROUP BY item_id) a ON a.item_id = i.id
+                       LEFT JOIN (SELECT item_id, SUM(qty) AS qty FROM purchase_items GROUP BY item_id) p ON p.item_id = i.id
+                       LEFT JOIN (SELECT item_id, SUM(qty) AS qty FROM sale_items GROUP BY item_id) s ON s.item_id = i.id'''
+
+def record_stock_adjustment(c, item_id, qty, reason):
+    """تسجيل تغيير يدوي للكمية (qty فرق موجب أو سالب) داخل المعاملة الحالية"""
+    if qty:
+        c.execute('INSERT INTO stock_adjustments (item_id, qty, reason, created_at) VALUES (?, ?, ?, ?)',
+                  (item_id, qty, reason, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+
+def baseline_stock_adjustments(c, reason='opening'):
+    """تسجيل فرق كل صنف بين كميته الحالية والمتوقعة كتعديل، فتصبح الكميات الحالية نقطة البداية؛ ترجع عدد الأصناف"""
+    c.execute(f'SELECT id, qty, expected FROM ({STOCK_EXPECTED_SQL}) WHERE qty != expected')
+    rows = c.fetchall()
+    for item_id, qty, expected in rows:
+        record_stock_adjustment(c, item_id, qty - expected, reason)
+    return len(rows)
+
+def _migrate_stock_adjustments(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS stock_adjustments (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    item_id INTEGER NOT NULL,
+                    qty INTEGER NOT NULL,
+                    reason TEXT NOT NULL,
+                    created_at TEXT NOT NULL
+                )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_stock_adjustments_item ON stock_adjustments (item_id)')
+    # لا تاريخ قبل هذا الترحيل: الكميات الحالية هي الرصيد الافتتاحي
+    baseline_stock_adjustments(c)
+
+# --------- Money columns (REAL -> centimes) ---------
+def _rebuild_money_table(c, table, columns):
+    """إعادة بناء جدول بأعمدة مبالغ INTEGER مع تحويل قيمها إلى سنتيم (عمود REAL يحوّل أي عدد صحيح إلى عائم)،
+    مع الإبقاء على فهارسه وtriggers وعدّاد AUTOINCREMENT"""
+    c.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    row = c.fetchone()
+    if row is None:
+        return
+    sql = re.sub(rf'^CREATE TABLE\s+(IF NOT EXISTS\s+)?"?{table}"?', f'CREATE TABLE {table}_centimes', row[0])
+    for column in columns:
+        sql = re.sub(rf'\b{column}\s+REAL\b', f'{column} INTEGER', sql)
+    c.execute("SELECT sql FROM sqlite_master WHERE tbl_name = ? AND type IN ('index', 'trigger') AND sql IS NOT NULL", (table,))
+    dependents = [row[0] for row in c.fetchall()]
+    c.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_sequence'")
+    sequence = c.fetchone() and c.execute('SELECT seq FROM sqlite_sequence WHERE name = ?', (table,)).fetchone()
+    names = [row[1] for row in c.execute(f'PRAGMA table_info({table})').fetchall()]
+    c.execute(sql)
+    c.execute(f'INSERT INTO {table}_centimes ({", ".join(names)}) '
+              f'SELECT {", ".join(centimes_sql(name) if name in columns else name for name in names)} FROM {table}')
+    c.execute(f'DROP TABLE {table}')
+    c.execute(f'ALTER TABLE {table}_centimes RENAME TO {table}')
+    for statement in dependents:
+        c.execute(statement)
+    if sequence:
+        c.execute('UPDATE sqlite_sequence SET seq = ? WHERE name = ?', (sequence[0], table))
+        if c.rowcount == 0:
+            c.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)', (table, sequence[0]))
+
+def _migrate_money_centimes(c):
+    for table, columns in STORE_MONEY_COLUMNS.items():
+        _rebuild_money_table(c, table, columns)
+    # ما يُشتق من المبالغ يُعاد حسابه من القيم المقرّبة حتى تبقى المطابقة تامة (ولا يبقى دين مفتوح بـ 0.0000001)
+    c.execute('''UPDATE debts SET remaining_amount = original_amount - paid_amount,
+                 status = CASE WHEN paid_amount >= original_amount THEN 'paid' ELSE 'open' END''')
+    c.execute('''UPDATE ledger_entries SET balance = running.balance
+                 FROM (SELECT id, SUM(amount) OVER (PARTITION BY entity_type, entity_id ORDER BY id) AS balance
+                       FROM ledger_entries) AS running
+                 WHERE running.id = ledger_entries.id''')
+    c.execute('''UPDATE entity_balances SET balance = COALESCE((SELECT SUM(l.amount) FROM ledger_entries l
+                                                              WHERE l.entity_type = entity_balances.entity_type
+                                                                AND l.entity_id = entity_balances.entity_id), 0)''')
+    rebuild_debt_aging(c, datetime.now().date())
+    # ملفات الأرشيف للقراءة فقط: ما أُرشف قبل هذا الترحيل يبقى بالدينار ويُحوَّل في sales_all عند القراءة
+    c.execute('ALTER TABLE sales_archives ADD COLUMN centimes INTEGER NOT NULL DEFAULT 1')
+    c.execute('UPDATE sales_archives SET centimes = 0')
+
+def _migrate_date_timestamps(c):
+    for table, (_column, ts_column) in STORE_DATE_COLUMNS.items():
+        c.execute(f'ALTER TABLE {table} ADD COLUMN {ts_column} INTEGER')
+    backfill_date_timestamps(c)
+    c.execute('CREATE INDEX IF NOT EXISTS idx_sales_date_ts ON sales (date_ts)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_purchases_date_ts ON purchases (date_ts)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_debts_created ON debts (entity_type, status, created_ts)')
+    c.execute('DROP INDEX IF EXISTS idx_debts_aging')
+    c.execute('CREATE INDEX idx_debts_aging ON debts (status, aging_bucket, created_ts)')
+    # سطور فترة المستندات (والمستند الواحد) تُقرأ برقم الرأس: بحث بالفهرس بدل مسح جدول السطور
+    c.execute('CREATE INDEX IF NOT EXISTS idx_sale_items_sale ON sale_items (sale_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_purchase_items_purchase ON purchase_items (purchase_id)')
+
+# --------- Store schema migrations ---------
+# كل عنصر ترحيل واحد يرفع PRAGMA user_version بمقدار 1؛ الخطوة إما نص SQL أو دالة تستقبل المؤشر
+STORE_SCHEMA_MIGRATIONS = [
+    # 1: حجز مؤقت للكميات عند إضافة صنف إلى سلة نقطة البيع
+    [
+        '''CREATE TABLE IF NOT EXISTS stock_reservations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                cart_token TEXT NOT NULL,
+                item_id INTEGER NOT NULL,
+                qty INTEGER NOT NULL,
+                expires_at INTEGER NOT NULL,
+                UNIQUE(cart_token, item_id)
+            )''',
+        'CREATE INDEX IF NOT EXISTS idx_stock_reservations_item ON stock_reservations (item_id, expires_at)',
+    ],
+    # 2: أحداث المحل (فروقات لوحات المتابعة) لنشرها بين عمال gunicorn
+    [
+        '''CREATE TABLE IF NOT EXISTS store_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_at INTEGER NOT NULL
+            )''',
+    ],
+    # 3: إصلاح أعمدة الديون (status, notes) ودفتر القيود مع أرصدة الزبائن والموردين
+    [_migrate_debts_ledger],
+    # 4: فئات أعمار الديون ومجاميعها لكل طرف
+    [_migrate_debt_aging],
+    # 5: رقم إصدار الكتالوج (الرمز، الاسم، سعر البيع) لفهرس الباركود؛ تغيّر الكمية وحدها لا يزيده
+    [
+        "INSERT OR IGNORE INTO store_meta (key, value) VALUES ('catalog_version', 0)",
+        '''CREATE TRIGGER IF NOT EXISTS items_catalog_insert AFTER INSERT ON items BEGIN
+               UPDATE store_meta SET value = value + 1 WHERE key = 'catalog_version'; END''',
+        '''CREATE TRIGGER IF NOT EXISTS items_catalog_delete AFTER DELETE ON items BEGIN
+               UPDATE store_meta SET value = value + 1 WHERE key = 'catalog_version'; END''',
+        '''CREATE TRIGGER IF NOT EXISTS items_catalog_update AFTER UPDATE OF code, name, sell_price ON items BEGIN
+               UPDATE store_meta SET value = value + 1 WHERE key = 'catalog_version'; END''',
+    ],
+    # 6: تعديلات المخزون اليدوية (الرصيد الافتتاحي، تعديل الكمية) لفحص تطابق الكميات مع الحركات
+    [_migrate_stock_adjustments],
+    # 7: سجل أرشيفات المبيعات السنوية مع مجاميعها (الإحصاءات لا تحتاج فتح الأرشيف)
+    [
+        '''CREATE TABLE IF NOT EXISTS sales_archives (
+                year INTEGER PRIMARY KEY,
+                filename TEXT NOT NULL,
+                sales_count INTEGER NOT NULL,
+                sales_total REAL NOT NULL,
+                lines_count INTEGER NOT NULL,
+                checksum TEXT NOT NULL,
+                archived_at TEXT NOT NULL
+            )''',
+    ],
+    # 8: المبالغ أعداد صحيحة بالسنتيم بدل REAL (مجاميع دقيقة، لا بقايا كسور في الديون)
+    [_migrate_money_centimes],
+    # 9: أعمدة تاريخ بالثواني مفهرسة للترتيب والبحث بفترة (مع توحيد صيغة التواريخ النصية القديمة)
+    [_migrate_date_timestamps],
+    # 10: التواريخ القديمة بغير صيغة ISO ('2025/02/03'، '03/02/2025') التي بقيت بلا ثوانٍ بعد الترحيل 9
+    [backfill_date_timestamps],
+]
+
+_migrated_stores = set()  # المحلات التي تمت ترقيتها في هذه العملية
+
+def migrate_store_database(db):
+    """ترقية مخطط قاعدة بيانات المحل إلى آخر إصدار داخل معاملة واحدة لكل ترحيل"""
+    while True:
+        db.execute('BEGIN IMMEDIATE')
+        version = db.execute('PRAGMA user_version').fetchone()[0]
+        if version >= len(STORE_SCHEMA_MIGRATIONS):
+            db.rollback()
+            return
+        c = db.cursor()
+        try:
+            for step in STORE_SCHEMA_MIGRATIONS[version]:
+                if callable(step):
+                    step(c)
+                else:
+                    c.execute(step)
+            c.execute(f'PRAGMA user_version = {version + 1}')
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+# --------- Stock helpers ---------
+def begin_immediate(db, retries=2):
+    """بدء معاملة كتابة تحجز قفل الكتابة فوراً بدلاً من ترقيته لاحقاً (يمنع الجمود بين البائعين).
+    إذا انتهت مهلة الانتظار والقاعدة ما زالت مقفلة تُعاد المحاولة بعد توقف قصير."""
+    if db.in_transaction:
         db.commit()
+    for attempt in range(retries + 1):
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            return
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e) and 'busy' not in str(e):
+                raise
+            metric_inc('lekhlef_sqlite_busy_retries_total')
+            if attempt == retries:
+                raise
+            time.sleep(0.05 * (attempt + 1))
+
+def deduct_stock(c, lines, cart_token=None):
+    """خصم مشروط للكميات: لا يُخصم السطر إلا إذا كانت الكمية المتاحة (بعد حجوزات السلال الأخرى) كافية.
+    يجب استدعاؤها داخل معاملة؛ ترجع قائمة الأسطر الفاشلة (فارغة عند النجاح)."""
+    now = int(time.time())
+    failures = []
+    for item_id, qty in lines:
+        c.execute('''UPDATE items SET qty = qty - ?
+                     WHERE id = ? AND qty - (SELECT COALESCE(SUM(r.qty), 0) FROM stock_reservations r
+                                             WHERE r.item_id = items.id AND r.expires_at > ? AND r.cart_token != ?) >= ?''',
+                  (qty, item_id, now, cart_token or '', qty))
+        if c.rowcount == 0:
+            c.execute('''SELECT name, qty - (SELECT COALESCE(SUM(r.qty), 0) FROM stock_reservations r
+                                             WHERE r.item_id = items.id AND r.expires_at > ? AND r.cart_token != ?) AS available
+                         FROM items WHERE id = ?''', (now, cart_token or '', item_id))
+            row = c.fetchone()
+            failures.append({'item_id': item_id, 'name': row['name'] if row else None,
+                             'requested': qty, 'available': max(row['available'], 0) if row else 0})
+    return failures
+
+def restore_stock(c, lines):
+    """إرجاع كميات إلى المخزون (حذف أو تعديل فاتورة)"""
+    c.executemany('UPDATE items SET qty = qty + ? WHERE id = ?', [(qty, item_id) for item_id, qty in lines])
+
+def release_reservations(c, cart_token):
+    """تحرير حجوزات سلة بعد إتمام البيع أو إفراغها"""
+    if cart_token:
+        c.execute('DELETE FROM stock_reservations WHERE cart_token = ?', (cart_token,))
+
+# --------- Store writer (single writer per store) ---------
+# كل عمليات الكتابة الكثيفة (البيع، التوريد، تسديد الديون) لمحل ما تمر عبر خيط كاتب واحد في العملية.
+# الكاتب يجمع العمليات المنتظرة في معاملة واحدة (حفظ جماعي) مع SAVEPOINT لكل عملية، فلا يُفسد فشل
+# عملية بقية الدفعة. بين عمال gunicorn يبقى التنسيق عبر WAL ومهلة الانتظار وإعادة محاولة BEGIN IMMEDIATE.
+# إذا توقف الكاتب لخطأ غير متوقع تفشل كل عملياته المنتظرة ويُزال من السجل، فيبدأ الطلب التالي كاتباً جديداً.
+writer_logger = logging.getLogger('lekhlef.writer')
+
+class WriteRejected(Exception):
+    """رفض عملية كتابة لسبب متوقع (نقص مخزون، مبلغ غير صالح)؛ الرسائل تُعرض للمستخدم"""
+    def __init__(self, messages):
+        super().__init__(messages)
+        self.messages = messages
+
+class StoreWriter(threading.Thread):
+    """خيط يملك اتصال الكتابة لمحل واحد وينفذ العمليات المرسلة إليه على دفعات"""
+    idle_timeout = 60
+    
+    def __init__(self, store_id):
+        super().__init__(name=f'lekhlef-writer-{store_id}', daemon=True)
+        self.store_id = store_id
+        self.jobs = queue.Queue()
+    
+    def run(self):
+        db, batch = None, []
+        try:
+            db = sqlite3.connect(get_store_db_path(self.store_id), timeout=SQLITE_BUSY_TIMEOUT, factory=connection_factory())
+            db.row_factory = sqlite3.Row
+            stopping = False
+            while not stopping:
+                try:
+                    job = self.jobs.get(timeout=self.idle_timeout)
+                except queue.Empty:
+                    with _store_writers_lock:
+                        if self.jobs.empty():
+                            _store_writers.pop(self.store_id, None)
+                            return
+                    continue
+                if job is None:  # stop_store_writer: لا عمليات بعد هذه العلامة
+                    return
+                batch = [job]
+                deadline = time.monotonic() + WRITE_BATCH_WAIT
+                while len(batch) < WRITE_BATCH_MAX:
+                    try:
+                        job = self.jobs.get(timeout=max(deadline - time.monotonic(), 0))
+                    except queue.Empty:
+                        break
+                    if job is None:
+                        stopping = True
+                        break
+                    batch.append(job)
+                self.run_batch(db, batch)
+                batch = []
+        except BaseException as e:
+            writer_logger.exception('store %s writer stopped', self.store_id)
+            self.abandon(batch, e)
+        finally:
+            if db is not None:
+                db.close()
+    
+    def abandon(self, batch, error):
+        """إزالة الكاتب من السجل وإفشال دفعته الحالية وكل ما ينتظر في طابوره (حتى لا ينتظر أحد للأبد)"""
+        with _store_writers_lock:
+            if _store_writers.get(self.store_id) is self:
+                _store_writers.pop(self.store_id)
+            pending = list(batch)
+            while True:
+                try:
+                    pending.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+        for _job, done in filter(None, pending):
+            done(None, error)
+    
+    def run_batch(self, db, batch):
+        results = []
+        try:
+            begin_immediate(db)
+            c = db.cursor()
+            for job, _done in batch:
+                c.execute('SAVEPOINT write_job')
+                try:
+                    results.append((job(c), None))
+                    c.execute('RELEASE write_job')
+                except Exception as e:
+                    c.execute('ROLLBACK TO write_job')
+                    c.execute('RELEASE write_job')
+                    results.append((None, e))
+            db.commit()
+        except Exception as e:
+            if db.in_transaction:
+                db.rollback()
+            results = [(None, e)] * len(batch)
+        try:
+            query_cache.bump(self.store_id)
+            store_events.notify(self.store_id)
+            metric_inc('lekhlef_write_batches_total')
+            metric_inc('lekhlef_write_jobs_total', amount=len(batch))
+        except Exception:  # الدفعة محفوظة: لا يُبلَّغ أصحابها بفشل ما بعد الحفظ
+            writer_logger.exception('store %s post-commit hooks failed', self.store_id)
+        for (_job, done), result in zip(batch, results):
+            done(*result)
+
+_store_writers_lock = threading.Lock()
+_store_writers = {}  # store_id -> StoreWriter (لكل عملية)
+
+def stop_store_writer(store_id, timeout=5):
+    """إيقاف كاتب المحل بعد إنهاء ما في طابوره وإغلاق اتصاله (قبل حذف قاعدته)"""
+    with _store_writers_lock:
+        writer = _store_writers.pop(store_id, None)
+        if writer is not None:
+            writer.jobs.put(None)
+    if writer is not None:
+        writer.join(timeout)
+
+def run_store_write(job, store_id=None):
+    """تنفيذ job(cursor) عبر كاتب المحل وانتظار حفظ معاملته؛ يُعيد قيمة job أو يرفع استثناءها.
+    بعد WRITE_WAIT_SECONDS ترفع TimeoutError، وتُلغى العملية إن لم يكن الكاتب قد بدأها بعد."""
+    store_id = store_id if store_id is not None else session['store_id']
+    ensure_store_database_exists(store_id)
+    outcome = {}
+    finished = threading.Event()
+    cancelled = threading.Event()
+    
+    def guarded(c):
+        if cancelled.is_set():
+            raise TimeoutError('write cancelled after timeout')
+        return job(c)
+    
+    def done(result, error):
+        outcome['result'], outcome['error'] = result, error
+        finished.set()
+    
+    with _store_writers_lock:
+        writer = _store_writers.get(store_id)
+        if writer is None:
+            writer = _store_writers[store_id] = StoreWriter(store_id)
+            writer.start()
+        writer.jobs.put((guarded, done))
+    if not finished.wait(WRITE_WAIT_SECONDS):
+        cancelled.set()
+        metric_inc('lekhlef_write_timeouts_total')
+        raise TimeoutError(f'store {store_id} writer did not answer within {WRITE_WAIT_SECONDS:g}s')
+    if outcome['error'] is not None:
+        raise outcome['error']
+    return outcome['result']
+
+# --------- Store events (live dashboards) ---------
+# كل عملية كتابة تسجل فروقاتها (عدد المبيعات، المجاميع، المخزون، الديون) في store_events داخل نفس
+# المعاملة. في كل عملية خيط متابع واحد لكل محل يقرأ الأحداث الجديدة ويوزعها على المشتركين:
+# فوراً عند الكتابة من نفس العملية، وخلال EVENTS_POLL_SECONDS عند الكتابة من عامل آخر.
+EVENTS_POLL_SECONDS = 1.0
+EVENTS_RETENTION_SECONDS = 86400
+SSE_KEEPALIVE_SECONDS = 15
+SSE_MAX_SECONDS = 25  # أقل من مهلة عامل gunicorn الافتراضية (30 ثانية)؛ EventSource يعيد الاتصال ويكمل من Last-Event-ID
+LIVE_POLL_SECONDS = 10  # فترة الاستطلاع في وضع poll
+
+def publish_event(c, kind, deltas, **extra):
+    """تسجيل حدث داخل معاملة الكتابة الحالية (يظهر للمشتركين بعد الحفظ فقط)"""
+    now = int(time.time())
+    payload = dict(extra, deltas={key: value for key, value in deltas.items() if value})
+    c.execute('INSERT INTO store_events (kind, payload, created_at) VALUES (?, ?, ?)',
+              (kind, json.dumps(payload, ensure_ascii=False), now))
+    if c.lastrowid % 1000 == 0:
+        c.execute('DELETE FROM store_events WHERE created_at < ?', (now - EVENTS_RETENTION_SECONDS,))
+
+def stock_cost(c, lines):
+    """قيمة كميات (item_id, qty) بسعر الشراء، لتحديث قيمة المخزون في اللوحات"""
+    lines = [(item_id, qty) for item_id, qty in lines if qty]
+    if not lines:
+        return 0
+    placeholders = ','.join('?' * len(lines))
+    c.execute(f'SELECT id, buy_price FROM items WHERE id IN ({placeholders})', [item_id for item_id, _qty in lines])
+    prices = {row['id']: row['buy_price'] or 0 for row in c.fetchall()}
+    return sum(qty * prices.get(item_id, 0) for item_id, qty in lines)
+
+def debt_deltas(entity_type, amount):
+    """فروقات لوحة الديون عند زيادة أو نقصان دين زبون (لك) أو مورد (عليك)"""
+    if entity_type == 'supplier':
+        return {'payables': amount, 'net_debts': -amount}
+    return {'receivables': amount, 'net_debts': amount}
+
+class StoreEventBus:
+    """توزيع أحداث store_events على المشتركين داخل العملية (خيط متابعة واحد لكل محل له مشتركون)"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stores = {}  # store_id -> {'subscribers': set, 'wake': Event, 'last_id': int}
+    
+    def subscribe(self, store_id, callback):
+        """تسجيل دالة تستقبل كل حدث جديد كقاموس {id, kind, payload}"""
+        with self.lock:
+            state = self.stores.get(store_id)
+            if state is None:
+                state = self.stores[store_id] = {'subscribers': set(), 'wake': threading.Event(),
+                                                 'last_id': latest_event_id(store_id)}
+                threading.Thread(target=self._follow, args=(store_id, state), daemon=True,
+                                 name=f'lekhlef-events-{store_id}').start()
+            state['subscribers'].add(callback)
+            return state['last_id']
+    
+    def unsubscribe(self, store_id, callback):
+        with self.lock:
+            state = self.stores.get(store_id)
+            if state is not None:
+                state['subscribers'].discard(callback)
+                state['wake'].set()
+    
+    def notify(self, store_id):
+        """إيقاظ متابع المحل بعد حفظ كتابة في هذه العملية"""
+        state = self.stores.get(store_id)
+        if state is not None:
+            state['wake'].set()
+    
+    def _follow(self, store_id, state):
+        db = sqlite3.connect(get_store_db_path(store_id), timeout=SQLITE_BUSY_TIMEOUT)
+        try:
+            while True:
+                state['wake'].wait(EVENTS_POLL_SECONDS)
+                state['wake'].clear()
+                with self.lock:
+                    if not state['subscribers']:
+                        del self.stores[store_id]
+                        return
+                events = read_events(db, state['last_id'])
+                if not events:
+                    continue
+                with self.lock:
+                    state['last_id'] = events[-1]['id']
+                    subscribers = list(state['subscribers'])
+                for event in events:
+                    for callback in subscribers:
+                        callback(event)
+        finally:
+            db.close()
+
+store_events = StoreEventBus()
+
+def read_events(db, after_id, limit=500):
+    rows = db.execute('SELECT id, kind, payload FROM store_events WHERE id > ? ORDER BY id LIMIT ?',
+                      (after_id, limit)).fetchall()
+    return [{'id': row[0], 'kind': row[1], 'payload': json.loads(row[2])} for row in rows]
+
+def latest_event_id(store_id):
+    ensure_store_database_exists(store_id)
+    db = sqlite3.connect(get_store_db_path(store_id), timeout=SQLITE_BUSY_TIMEOUT)
+    try:
+        return db.execute('SELECT COALESCE(MAX(id), 0) FROM store_events').fetchone()[0]
+    finally:
         db.close()
 
+def open_event_subscription(store_id, callback, last_event_id=None):
+    """الاشتراك في أحداث محل؛ ترجع (الأحداث الفائتة منذ last_event_id، دالة إلغاء الاشتراك).
+    قد يصل الحدث نفسه من الفائت ومن المتابع، لذا يتجاهل المستهلك أي id سبق أن أرسله."""
+    current_id = store_events.subscribe(store_id, callback)
+    backlog = []
+    if last_event_id is not None and last_event_id < current_id:
+        db = sqlite3.connect(get_store_db_path(store_id), timeout=SQLITE_BUSY_TIMEOUT)
+        try:
+            backlog = read_events(db, last_event_id)
+        finally:
+            db.close()
+    return backlog, lambda: store_events.unsubscribe(store_id, callback)
+
+def format_sse(event):
+    data = dict(event['payload'], kind=event['kind'])
+    return f"id: {event['id']}\nevent: delta\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def diff_sale_lines(old_rows, new_lines):
+    """مقارنة أسطر الفاتورة القديمة (id, item_id, qty, price) بالجديدة (item_id, qty, price).
+    تُطابق الأسطر حسب الصنف بالترتيب، وترجع (إضافات، تعديلات، حذف، صافي تغير الكمية لكل صنف)
+    حيث القيمة الموجبة في صافي التغير تعني كمية إضافية يجب خصمها من المخزون."""
+    unmatched = {}
+    for row in old_rows:
+        unmatched.setdefault(row['item_id'], []).append(row)
+    
+    inserts, updates, stock_deltas = [], [], {}
+    for item_id, qty, price in new_lines:
+        stock_deltas[item_id] = stock_deltas.get(item_id, 0) + qty
+        candidates = unmatched.get(item_id)
+        if candidates:
+            row = candidates.pop(0)
+            if row['qty'] != qty or row['price'] != price:
+                updates.append((row['id'], qty, price))
+        else:
+            inserts.append((item_id, qty, price))
+    
+    deletes = []
+    for row in old_rows:
+        stock_deltas[row['item_id']] = stock_deltas.get(row['item_id'], 0) - row['qty']
+    for rows in unmatched.values():
+        deletes.extend(row['id'] for row in rows)
+    
+    stock_deltas = {item_id: delta for item_id, delta in stock_deltas.items() if delta}
+    return inserts, updates, deletes, stock_deltas
+
+def invalid_line_failures(c, lines):
+    """الأسطر ذات الكمية غير الموجبة أو السعر السالب، بصيغة إخفاقات المخزون نفسها (تُرفض قبل أي كتابة)"""
+    bad = [(item_id, qty, price) for item_id, qty, price in lines if qty <= 0 or price < 0]
+    if not bad:
+        return []
+    c.execute(f'SELECT id, name FROM items WHERE id IN ({",".join("?" * len(bad))})', [item_id for item_id, _, _ in bad])
+    names = dict(c.fetchall())
+    return [{'item_id': item_id, 'name': names.get(item_id), 'requested': qty, 'available': None,
+             'price': price, 'reason': 'invalid'} for item_id, qty, price in bad]
+
+def stock_failure_messages(failures):
+    """رسائل واضحة لكل سطر رُفض بسبب نقص المخزون أو لكونه غير صالح"""
+    messages = []
+    for f in failures:
+        name = f['name'] or f['item_id']
+        if f.get('reason') == 'invalid':
+            messages.append(f'❌ سطر غير صالح للصنف "{name}": الكمية {f["requested"]} والسعر {format_money(f["price"])}؛ '
+                            'يجب أن تكون الكمية أكبر من صفر والسعر غير سالب.')
+        else:
+            messages.append(f'❌ الكمية غير كافية للصنف "{name}": المطلوب {f["requested"]}، المتاح {f["available"]}.')
+    return messages
+
 def get_db():
     """دالة للحصول على قاعدة بيانات المحل الحالي (للتوافق مع الكود القديم)"""
     return get_store_db()
@@ -265,11 +1409,716 @@ def close_connection(exception):
     main_db = getattr(g, '_main_database', None)
     if main_db is not None:
         main_db.close()
+        metric_inc('lekhlef_db_connections_closed_total', {'db': 'main'})
     
     # إغلاق قاعدة بيانات المحل
     store_db = getattr(g, '_store_database', None)
     if store_db is not None:
-        store_db.close()
+        if g.get('_store_database_readonly'):
+            release_store_reader(g._store_database_id, store_db)
+        else:
+            if store_db.total_changes:
+                query_cache.bump(g._store_database_id)
+            close_store_connection(store_db)
+
+# --------- Query cache ---------
+# نتائج استعلامات القراءة المتكررة (قوائم الأصناف والزبائن، العدادات) لكل محل في ذاكرة العملية بمفتاح
+# (store_id, SQL, params). كل نتيجة محفوظة مع رمز الإصدار وقت تنفيذها: PRAGMA data_version من اتصال مراقبة
+# دائم (يتغير بأي حفظ من اتصال آخر، في أي عملية) ورقم جيل يزيده هذا العامل بعد كل كتابة. حجمها محدود
+# بـ QUERY_CACHE_BYTES مع حذف الأقدم استعمالاً.
+class QueryCache:
+    """ذاكرة LRU لنتائج الاستعلامات مع إحصاءات الإصابة"""
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # key -> (token, rows, size)
+        self.size = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self.generations = {}  # store_id -> عدد الكتابات من هذا العامل
+        self.watchers = {}  # store_id -> (Lock, اتصال) لقراءة data_version
+    
+    def bump(self, store_id):
+        """تسجيل كتابة من هذا العامل (تُبطل نتائج المحل)"""
+        with self.lock:
+            self.generations[store_id] = self.generations.get(store_id, 0) + 1
+    
+    def token(self, store_id):
+        with self.lock:
+            watcher = self.watchers.get(store_id)
+            if watcher is None:
+                watcher = self.watchers[store_id] = (threading.Lock(), sqlite3.connect(
+                    get_store_db_path(store_id), timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False))
+            generation = self.generations.get(store_id, 0)
+        with watcher[0]:
+            return watcher[1].execute('PRAGMA data_version').fetchone()[0], generation
+    
+    def get(self, key, token):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == token:
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[1]
+            self.stats['misses'] += 1
+            return None
+    
+    def put(self, key, token, rows):
+        size = sys.getsizeof(rows) + sum(56 + sum(sys.getsizeof(value) for value in row) for row in rows)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[2]
+            self.entries[key] = (token, rows, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _key, (_token, _rows, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+                self.stats['evictions'] += 1
+    
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, entries=len(self.entries), bytes=self.size, max_bytes=self.max_bytes)
+    
+    def drop(self, store_id):
+        """نسيان محل (قبل حذف قاعدته): إغلاق اتصال data_version وحذف نتائجه المحفوظة"""
+        with self.lock:
+            watcher = self.watchers.pop(store_id, None)
+            self.generations.pop(store_id, None)
+            for key in [key for key in self.entries if key[0] == store_id]:
+                self.size -= self.entries.pop(key)[2]
+        if watcher is not None:
+            with watcher[0]:
+                watcher[1].close()
+
+query_cache = QueryCache(QUERY_CACHE_BYTES)
+
+def cached_query(sql, params=()):
+    """صفوف استعلام قراءة على محل الجلسة: من الذاكرة إن لم تتغير قاعدة المحل منذ حفظها، وإلا من SQLite"""
+    store_id = session['store_id']
+    db = getattr(g, '_store_database', None)
+    if QUERY_CACHE_BYTES <= 0 or (db is not None and db.in_transaction):
+        return get_db().execute(sql, params).fetchall()
+    ensure_store_database_exists(store_id)
+    key = (store_id, sql, tuple(params))
+    token = query_cache.token(store_id)  # قبل التنفيذ: أي حفظ لاحق يغيّر الرمز فلا تُستعمل النتيجة
+    rows = query_cache.get(key, token)
+    metric_inc('lekhlef_query_cache_total', {'result': 'miss' if rows is None else 'hit'})
+    if rows is None:
+        rows = get_db().execute(sql, params).fetchall()
+        query_cache.put(key, token, rows)
+    return rows
+
+# --------- Metrics (/metrics) ---------
+# مقاييس بصيغة Prometheus النصية. كل عملية تحتفظ بمقاييسها في الذاكرة، ومع LEKHLEF_METRICS_DIR
+# تكتب لقطة منها في ملف metrics_<pid>.json حتى يجمع /metrics كل عمال gunicorn (المجلد يُفرَّغ عند النشر).
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRIC_TYPES = {
+    'lekhlef_requests_total': ('counter', 'HTTP requests by route, method and status'),
+    'lekhlef_request_duration_seconds': ('histogram', 'HTTP request latency by route'),
+    'lekhlef_template_render_seconds': ('histogram', 'Template compile and render time'),
+    'lekhlef_db_connections_opened_total': ('counter', 'SQLite connections opened'),
+    'lekhlef_db_connections_closed_total': ('counter', 'SQLite connections closed'),
+    'lekhlef_store_db_open_handles': ('gauge', 'Store database handles currently open'),
+    'lekhlef_sqlite_busy_retries_total': ('counter', 'Write transactions retried because the database was locked'),
+    'lekhlef_sales_total': ('counter', 'Completed checkouts per store (use rate() for sales per minute)'),
+    'lekhlef_sales_amount_total': ('counter', 'Checkout revenue per store'),
+    'lekhlef_write_batches_total': ('counter', 'Store writer transactions (group commits)'),
+    'lekhlef_write_jobs_total': ('counter', 'Write operations committed through store writers'),
+    'lekhlef_write_timeouts_total': ('counter', 'Writes that gave up waiting for the store writer'),
+    'lekhlef_pdf_rendered_total': ('counter', 'Invoice/purchase PDFs rendered by the PDF pool'),
+    'lekhlef_pdf_cache_total': ('counter', 'PDF requests served from cache (hit) or rendered (miss)'),
+    'lekhlef_item_index_rebuilds_total': ('counter', 'Barcode index rebuilds after catalog changes'),
+    'lekhlef_query_cache_total': ('counter', 'Cached read queries served from memory (hit) or SQLite (miss)'),
+    'lekhlef_maintenance_runs_total': ('counter', 'Background maintenance jobs run per job type'),
+    'lekhlef_maintenance_io_bytes_total': ('counter', 'Estimated IO spent by background maintenance'),
+}
+_metrics_lock = threading.Lock()
+_metrics = {}  # (name, labels) -> قيمة أو [عدادات الحاويات..., المجموع, العدد]
+_metrics_flushed_at = 0
+
+def _metric_key(name, labels):
+    return name, tuple(sorted((labels or {}).items()))
+
+def metric_inc(name, labels=None, amount=1):
+    """زيادة عداد"""
+    key = _metric_key(name, labels)
+    with _metrics_lock:
+        _metrics[key] = _metrics.get(key, 0) + amount
+
+def metric_gauge_add(name, amount, labels=None):
+    """تعديل مقياس لحظي (يُجمع بين العمليات الحية فقط)"""
+    metric_inc(name, labels, amount)
+
+def metric_observe(name, seconds, labels=None):
+    """تسجيل قيمة في مدرج تكراري"""
+    key = _metric_key(name, labels)
+    with _metrics_lock:
+        histogram = _metrics.get(key)
+        if histogram is None:
+            histogram = _metrics[key] = [0] * (len(METRIC_BUCKETS) + 2)
+        for i, bound in enumerate(METRIC_BUCKETS):
+            if seconds <= bound:
+                histogram[i] += 1
+        histogram[-2] += seconds
+        histogram[-1] += 1
+
+def _metrics_snapshot():
+    with _metrics_lock:
+        return [[name, dict(labels), value if not isinstance(value, list) else list(value)]
+                for (name, labels), value in _metrics.items()]
+
+def flush_metrics(force=False):
+    """كتابة لقطة مقاييس هذه العملية في المجلد المشترك (مرة كل ثانية على الأكثر)"""
+    global _metrics_flushed_at
+    if not METRICS_DIR or (not force and time.time() - _metrics_flushed_at < 1):
+        return
+    _metrics_flushed_at = time.time()
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f'metrics_{os.getpid()}.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(_metrics_snapshot(), f)
+    os.replace(path + '.tmp', path)
+
+atexit.register(flush_metrics, force=True)
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def collect_metrics():
+    """دمج مقاييس هذه العملية مع لقطات بقية العمال؛ المقاييس اللحظية للعمليات المنتهية تُهمل"""
+    snapshots = [(os.getpid(), _metrics_snapshot())]
+    if METRICS_DIR and os.path.isdir(METRICS_DIR):
+        for filename in os.listdir(METRICS_DIR):
+            match = re.fullmatch(r'metrics_(\d+)\.json', filename)
+            if not match or int(match.group(1)) == os.getpid():
+                continue
+            try:
+                with open(os.path.join(METRICS_DIR, filename)) as f:
+                    snapshots.append((int(match.group(1)), json.load(f)))
+            except (OSError, ValueError):
+                continue
+    merged = {}
+    for pid, snapshot in snapshots:
+        alive = pid == os.getpid() or _process_alive(pid)
+        for name, labels, value in snapshot:
+            if METRIC_TYPES.get(name, ('counter',))[0] == 'gauge' and not alive:
+                continue
+            key = _metric_key(name, labels)
+            if isinstance(value, list):
+                current = merged.setdefault(key, [0] * len(value))
+                merged[key] = [a + b for a, b in zip(current, value)]
+            else:
+                merged[key] = merged.get(key, 0) + value
+    return merged
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs]
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+def render_metrics(merged):
+    """تحويل المقاييس المدمجة إلى صيغة Prometheus النصية"""
+    lines = []
+    for name in sorted({name for name, _labels in merged}):
+        kind, help_text = METRIC_TYPES.get(name, ('untyped', name))
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for (metric, labels), value in sorted(merged.items()):
+            if metric != name:
+                continue
+            if kind == 'histogram':
+                for bound, count in zip(METRIC_BUCKETS, value):
+                    lines.append(f'{name}_bucket{_format_labels(labels, [("le", bound)])} {count}')
+                lines.append(f'{name}_bucket{_format_labels(labels, [("le", "+Inf")])} {value[-1]}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {value[-2]}')
+                lines.append(f'{name}_count{_format_labels(labels)} {value[-1]}')
+            else:
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+@app.before_request
+def metrics_start_request():
+    g._metrics_started = time.perf_counter()
+
+@app.after_request
+def metrics_finish_request(response):
+    started = g.pop('_metrics_started', None)
+    if started is not None and request.endpoint != 'metrics':
+        route = request.endpoint or 'unknown'
+        metric_observe('lekhlef_request_duration_seconds', time.perf_counter() - started, {'route': route})
+        metric_inc('lekhlef_requests_total', {'route': route, 'method': request.method, 'status': str(response.status_code)})
+        flush_metrics()
+    return response
+
+@app.route('/metrics')
+def metrics():
+    """نقطة جمع المقاييس لـ Prometheus (فيها إيرادات كل محل): بالرمز إن وُجد، وإلا من الجهاز المحلي فقط"""
+    if METRICS_TOKEN:
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}'):
+            return 'unauthorized', 401
+    elif request.remote_addr not in ('127.0.0.1', '::1'):
+        return 'forbidden: set LEKHLEF_METRICS_TOKEN to scrape remotely', 403
+    return render_metrics(collect_metrics()), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+# --------- Profiling (LEKHLEF_PROFILE=1) ---------
+# لكل طلب: زمن فتح الاتصالات، كل استعلام مع عدد صفوفه، وزمن ترجمة القالب مقابل عرضه.
+# التجميع داخل العملية فقط (لكل عامل gunicorn جدوله الخاص).
+profile_logger = logging.getLogger('lekhlef.profile')
+_profile_lock = threading.Lock()
+_profile_statements = {}  # نص الاستعلام -> {'count', 'total_ms', 'max_ms', 'rows', 'plan'}
+_profile_routes = {}  # endpoint -> {'count', 'total_ms', 'max_ms', 'sql_ms', 'template_ms'}
+
+def connection_factory():
+    """صنف الاتصال المستخدم لقواعد البيانات: مع القياس أو بدونه"""
+    return ProfiledConnection if PROFILE_ENABLED or SLOW_QUERY_MS > 0 else sqlite3.Connection
+
+def profile_add(key, seconds):
+    """إضافة زمن إلى عداد من عدادات الطلب الحالي"""
+    if PROFILE_ENABLED and has_request_context():
+        timings = g.setdefault('_profile', {})
+        timings[key] = timings.get(key, 0) + seconds
+
+def _normalize_sql(sql):
+    return re.sub(r'\s+', ' ', sql).strip()
+
+class ProfiledCursor(sqlite3.Cursor):
+    """مؤشر يسجل زمن تنفيذ وجلب كل استعلام وعدد الصفوف المقروءة أو المعدلة"""
+    _record = None
+    
+    def _start(self, sql, parameters, run):
+        started = time.perf_counter()
+        try:
+            return run()
+        finally:
+            elapsed = time.perf_counter() - started
+            record = {'sql': _normalize_sql(sql), 'seconds': elapsed, 'rows': max(self.rowcount, 0),
+                      'params': parameters, 'db': self.connection}
+            if has_request_context():
+                # يكتمل زمن الجلب لاحقاً؛ فحص العتبة يتم عند نهاية الطلب
+                self._record = record
+                g.setdefault('_profile_sql', []).append(record)
+            else:
+                log_if_slow(record)
+    
+    def _fetched(self, started, rows):
+        if self._record is not None:
+            self._record['seconds'] += time.perf_counter() - started
+            self._record['rows'] += rows
+    
+    def execute(self, sql, parameters=()):
+        return self._start(sql, parameters, lambda: super(ProfiledCursor, self).execute(sql, parameters))
+    
+    def executemany(self, sql, seq_of_parameters):
+        return self._start(sql, (), lambda: super(ProfiledCursor, self).executemany(sql, seq_of_parameters))
+    
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(started, 1 if row is not None else 0)
+        return row
+    
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(size if size is not None else self.arraysize)
+        self._fetched(started, len(rows))
+        return rows
+    
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(started, len(rows))
+        return rows
+    
+    def __next__(self):
+        started = time.perf_counter()
+        row = super().__next__()
+        self._fetched(started, 1)
+        return row
+
+class ProfiledConnection(sqlite3.Connection):
+    """اتصال تمر كل استعلاماته عبر ProfiledCursor"""
+    def cursor(self, factory=None):
+        return super().cursor(factory or ProfiledCursor)
+    
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+def explain_query_plan(db, sql, parameters):
+    """خطة تنفيذ استعلام قراءة كنص من سطر لكل خطوة (فارغ لغير SELECT)"""
+    if not sql.lstrip().upper().startswith(('SELECT', 'WITH')):
+        return ''
+    try:
+        rows = db.cursor(sqlite3.Cursor).execute('EXPLAIN QUERY PLAN ' + sql, parameters).fetchall()
+    except sqlite3.Error:
+        return ''
+    return '\n'.join(row[3] for row in rows)
+
+@app.before_request
+def profile_start_request():
+    if PROFILE_ENABLED:
+        g._profile_started = time.perf_counter()
+
+@app.after_request
+def profile_finish_request(response):
+    """إضافة Server-Timing وسطر سجل JSON وتحديث الإحصاءات التجميعية"""
+    if not PROFILE_ENABLED or not hasattr(g, '_profile_started'):
+        return response
+    total = time.perf_counter() - g._profile_started
+    timings = g.get('_profile', {})
+    statements = g.get('_profile_sql', [])
+    sql_seconds = sum(record['seconds'] for record in statements)
+    
+    # خطط التنفيذ تُلتقط مرة واحدة لكل نص استعلام
+    plans = {}
+    for record in statements:
+        if record['sql'] not in _profile_statements and record['sql'] not in plans:
+            plans[record['sql']] = explain_query_plan(record['db'], record['sql'], record['params'])
+    
+    endpoint = request.endpoint or request.path
+    with _profile_lock:
+        for record in statements:
+            stat = _profile_statements.setdefault(record['sql'], {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'rows': 0,
+                                                                  'plan': plans.get(record['sql'], '')})
+            ms = record['seconds'] * 1000
+            stat['count'] += 1; stat['total_ms'] += ms; stat['max_ms'] = max(stat['max_ms'], ms); stat['rows'] += record['rows']
+        route = _profile_routes.setdefault(endpoint, {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'sql_ms': 0.0, 'template_ms': 0.0})
+        route['count'] += 1; route['total_ms'] += total * 1000; route['max_ms'] = max(route['max_ms'], total * 1000)
+        route['sql_ms'] += sql_seconds * 1000
+        route['template_ms'] += (timings.get('template_compile', 0) + timings.get('template_render', 0)) * 1000
+    
+    response.headers['Server-Timing'] = ', '.join([
+        f'db-connect;dur={timings.get("connect", 0) * 1000:.2f}',
+        f'sql;dur={sql_seconds * 1000:.2f};desc="{len(statements)} queries"',
+        f'tpl-compile;dur={timings.get("template_compile", 0) * 1000:.2f}',
+        f'tpl-render;dur={timings.get("template_render", 0) * 1000:.2f}',
+        f'total;dur={total * 1000:.2f}',
+    ])
+    profile_logger.info(json.dumps({
+        'method': request.method, 'path': request.path, 'endpoint': endpoint, 'status': response.status_code,
+        'store_id': session.get('store_id'), 'total_ms': round(total * 1000, 2),
+        'connect_ms': round(timings.get('connect', 0) * 1000, 2), 'sql_ms': round(sql_seconds * 1000, 2),
+        'sql_count': len(statements), 'template_compile_ms': round(timings.get('template_compile', 0) * 1000, 2),
+        'template_render_ms': round(timings.get('template_render', 0) * 1000, 2),
+    }, ensure_ascii=False))
+    return response
+
+if PROFILE_ENABLED and not profile_logger.handlers:
+    profile_logger.addHandler(logging.StreamHandler())
+    profile_logger.setLevel(logging.INFO)
+
+# --------- Slow query log (LEKHLEF_SLOW_QUERY_MS) ---------
+# كل استعلام يتجاوز العتبة (تنفيذ + جلب) يُكتب كسطر JSON في ملف دوار مع خطة تنفيذه،
+# حتى يظهر تحول استعلام إلى مسح كامل للجدول قبل أن يلاحظه أصحاب المحلات.
+slow_query_logger = logging.getLogger('lekhlef.slow_query')
+
+def redact_params(parameters):
+    """إخفاء النصوص (أسماء، هواتف، كلمات مرور) مع إبقاء الأرقام المفيدة لإعادة إنتاج الخطة"""
+    def redact(value):
+        if value is None or isinstance(value, (int, float)):
+            return value
+        return f'<{type(value).__name__}:{len(value) if hasattr(value, "__len__") else "?"}>'
+    if isinstance(parameters, dict):
+        return {key: redact(value) for key, value in parameters.items()}
+    return [redact(value) for value in parameters or ()]
+
+def log_if_slow(record):
+    """كتابة الاستعلام في سجل الاستعلامات البطيئة إذا تجاوز العتبة"""
+    if SLOW_QUERY_MS <= 0 or record['seconds'] * 1000 < SLOW_QUERY_MS:
+        return
+    entry = {
+        'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'duration_ms': round(record['seconds'] * 1000, 2),
+        'rows': record['rows'],
+        'sql': record['sql'],
+        'params': redact_params(record['params']),
+        'plan': explain_query_plan(record['db'], record['sql'], record['params']),
+    }
+    if has_request_context():
+        entry.update(store_id=session.get('store_id'), endpoint=request.endpoint, path=request.path)
+    slow_query_logger.warning(json.dumps(entry, ensure_ascii=False))
+
+@app.teardown_request
+def slow_query_finish_request(exception):
+    if SLOW_QUERY_MS > 0:
+        for record in g.get('_profile_sql', []):
+            log_if_slow(record)
+
+if SLOW_QUERY_MS > 0 and not slow_query_logger.handlers:
+    os.makedirs(os.path.dirname(os.path.abspath(SLOW_QUERY_LOG)), exist_ok=True)
+    slow_query_handler = logging.handlers.RotatingFileHandler(SLOW_QUERY_LOG, maxBytes=5 * 1024 * 1024, backupCount=5, encoding='utf-8')
+    slow_query_handler.setFormatter(logging.Formatter('%(message)s'))
+    slow_query_logger.addHandler(slow_query_handler)
+    slow_query_logger.setLevel(logging.WARNING)
+    slow_query_logger.propagate = False
+
+# --------- Maintenance scheduler ---------
+# خيط في الخلفية (واحد لكل عملية، يبدأ مع أول طلب) يختار كل دقيقة أعمال صيانة قواعد المحلات:
+# نقطة تفتيش WAL عندما يكبر ملف السجل، ANALYZE محدود (analysis_limit) إن لم توجد إحصاءات أو بعد إضافات
+# كثيرة، وincremental_vacuum عند كثرة الصفحات الفارغة. الأعمال تُرتَّب حسب نشاط المحل وتجزؤ ملفه، والثقيلة
+# منها في ساعات الهدوء فقط، وكلها تُخصم من ميزانية IO في الساعة. حالة الأعمال وسجلها في main_system.db
+# مشتركان بين عمال gunicorn: كل عمل يُحجز بمهلة فلا ينفذه عاملان معاً، والميزانية تُحسب من سجل الساعة الأخيرة.
+MAINTENANCE_TICK_SECONDS = 60
+MAINTENANCE_LEASE_SECONDS = 900
+MAINTENANCE_HISTORY_DAYS = 7
+ANALYSIS_LIMIT = 1000  # صفوف يقرأها ANALYZE من كل فهرس (إحصاءات تقريبية بكلفة ثابتة)
+ANALYZE_MIN_INSERTS = 1000  # إعادة ANALYZE بعد هذا العدد من الصفوف الجديدة (أو 10% مما كان)
+ANALYZE_MIN_INTERVAL = 3600
+CHECKPOINT_MIN_BYTES = 4 * 1024 * 1024
+VACUUM_MIN_FREE = 0.10  # نسبة الصفحات الفارغة التي تستدعي incremental_vacuum
+REBUILD_MIN_FREE = 0.25  # قاعدة قديمة بدون auto_vacuum: VACUUM كامل مرة واحدة لتفعيله
+maintenance_logger = logging.getLogger('lekhlef.maintenance')
+
+def parse_quiet_hours(text):
+    """"1-6" -> الساعات من 1:00 إلى 5:59؛ "22-5" يلتف بعد منتصف الليل؛ نص فارغ = كل الساعات"""
+    if not text.strip():
+        return set(range(24))
+    start, _, end = text.partition('-')
+    start = int(start) % 24
+    end = int(end) % 24 if end.strip() else (start + 1) % 24
+    hours, hour = set(), start
+    while True:
+        hours.add(hour)
+        hour = (hour + 1) % 24
+        if hour == end:
+            return hours
+
+MAINTENANCE_QUIET_SET = parse_quiet_hours(MAINTENANCE_QUIET_HOURS)
+
+def ensure_maintenance_tables(db):
+    db.execute('''CREATE TABLE IF NOT EXISTS maintenance_jobs (
+                    store_id INTEGER NOT NULL,
+                    job TEXT NOT NULL,
+                    last_run_at INTEGER,
+                    last_marker INTEGER,
+                    last_result TEXT,
+                    runs INTEGER NOT NULL DEFAULT 0,
+                    lease_until INTEGER,
+                    PRIMARY KEY (store_id, job)
+                ) WITHOUT ROWID''')
+    db.execute('''CREATE TABLE IF NOT EXISTS maintenance_runs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    store_id INTEGER NOT NULL,
+                    job TEXT NOT NULL,
+                    started_at INTEGER NOT NULL,
+                    seconds REAL NOT NULL,
+                    io_bytes INTEGER NOT NULL,
+                    result TEXT
+                )''')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_maintenance_runs_started ON maintenance_runs (started_at)')
+    db.commit()
+
+def store_maintenance_stats(path):
+    """حالة ملف المحل: حجم WAL، الصفحات والفارغة منها، وجود الإحصاءات، وعدد الصفوف المضافة منذ الإنشاء"""
+    wal_path = path + '-wal'
+    db = sqlite3.connect(f'file:{path}?mode=ro', uri=True, timeout=SQLITE_BUSY_TIMEOUT)
+    try:
+        page_size, page_count, freelist, auto_vacuum = (db.execute(f'PRAGMA {name}').fetchone()[0]
+                                                        for name in ('page_size', 'page_count', 'freelist_count', 'auto_vacuum'))
+        analyzed = db.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone() is not None
+        inserted = db.execute('SELECT COALESCE(SUM(seq), 0) FROM sqlite_sequence').fetchone()[0]
+        objects = db.execute("SELECT COUNT(*) FROM sqlite_master WHERE type IN ('table', 'index')").fetchone()[0]
+        aging_date = db.execute("SELECT value FROM store_meta WHERE key = 'aging_date'").fetchone()
+    finally:
+        db.close()
+    return {'page_size': page_size, 'page_count': page_count, 'freelist': freelist, 'auto_vacuum': auto_vacuum,
+            'analyzed': analyzed, 'inserted': inserted, 'objects': objects,
+            'aging_date': aging_date[0] if aging_date else None,
+            'wal_bytes': os.path.getsize(wal_path) if os.path.exists(wal_path) else 0}
+
+def maintenance_candidates(stats, state, quiet, now, today):
+    """[(الأولوية، العمل، كلفة IO المقدرة بالبايت)] للأعمال المستحقة لمحل.
+    الأولوية بالبايت أيضاً: حجم WAL، حجم الصفحات الفارغة، أو حجم الصفوف الجديدة منذ آخر ANALYZE"""
+    page = stats['page_size']
+    jobs = []
+    if stats['wal_bytes'] >= CHECKPOINT_MIN_BYTES:
+        jobs.append((stats['wal_bytes'], 'checkpoint', stats['wal_bytes'] * 2))
+    analyze = state.get('analyze', {})
+    new_rows = stats['inserted'] - (analyze.get('last_marker') or 0)
+    analyze_cost = min(stats['page_count'], stats['objects'] * ANALYSIS_LIMIT // 20 + 1) * page
+    if not stats['analyzed']:
+        jobs.append((stats['page_count'] * page, 'analyze', analyze_cost))
+    elif (now - (analyze.get('last_run_at') or 0) >= ANALYZE_MIN_INTERVAL
+          and new_rows >= max(ANALYZE_MIN_INSERTS, (analyze.get('last_marker') or 0) // 10)):
+        jobs.append((new_rows * 64, 'analyze', analyze_cost))
+    if quiet:
+        free_ratio = stats['freelist'] / max(stats['page_count'], 1)
+        if stats['auto_vacuum'] == 2 and free_ratio >= VACUUM_MIN_FREE:
+            jobs.append((stats['freelist'] * page, 'vacuum', min(stats['freelist'], 256) * page * 2))
+        elif stats['auto_vacuum'] != 2 and free_ratio >= REBUILD_MIN_FREE:
+            jobs.append((stats['freelist'] * page, 'vacuum', stats['page_count'] * page * 2))
+        if stats['aging_date'] != today.isoformat():
+            jobs.append((page, 'aging', page))
+    return jobs
+
+def run_maintenance_job(store_id, job, stats, budget, quiet):
+    """تنفيذ عمل صيانة على اتصال خاص؛ ترجع (كلفة IO بالبايت، النتيجة، العلامة المحفوظة للعمل)"""
+    page = stats['page_size']
+    if job == 'aging':
+        ensure_debt_aging_current(store_id)
+        return page, 'rebucketed', None
+    db = sqlite3.connect(get_store_db_path(store_id), timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None)
+    try:
+        if job == 'checkpoint':
+            # TRUNCATE ينتظر القراء ويعيد ملف WAL إلى الصفر؛ خارج ساعات الهدوء نكتفي بما لا يعطل أحداً
+            busy, frames, done = db.execute(f'PRAGMA wal_checkpoint({"TRUNCATE" if quiet else "PASSIVE"})').fetchone()
+            return max(done, 0) * page * 2, f'{max(done, 0)}/{frames} frames{" (busy)" if busy else ""}', None
+        if job == 'analyze':
+            db.execute(f'PRAGMA analysis_limit = {ANALYSIS_LIMIT}')
+            db.execute('ANALYZE')
+            db.execute('PRAGMA optimize')
+            return min(stats['page_count'], stats['objects'] * ANALYSIS_LIMIT // 20 + 1) * page, 'analyzed', stats['inserted']
+        if job == 'vacuum':
+            if stats['auto_vacuum'] == 2:
+                pages = max(1, min(stats['freelist'], budget // (page * 2)))
+                before = db.execute('PRAGMA freelist_count').fetchone()[0]
+                # executescript يكمل التنفيذ حتى النهاية؛ execute يتوقف بعد أول خطوة (صفحة واحدة)
+                db.executescript(f'PRAGMA incremental_vacuum({pages});')
+                freed = before - db.execute('PRAGMA freelist_count').fetchone()[0]
+                return freed * page * 2, f'{freed} free pages released', None
+            db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            db.execute('VACUUM')
+            return stats['page_count'] * page * 2, 'rebuilt with auto_vacuum=incremental', None
+        raise ValueError(f'unknown maintenance job {job}')
+    finally:
+        db.close()
+
+class MaintenanceScheduler(threading.Thread):
+    """خيط الصيانة في الخلفية (واحد لكل عملية)"""
+    
+    def __init__(self):
+        super().__init__(name='lekhlef-maintenance', daemon=True)
+        self.wake = threading.Event()
+        self.idle = {}  # store_id -> بصمة الملف عند آخر فحص لم يُستحق فيه أي عمل
+    
+    def run(self):
+        while True:
+            self.wake.wait(MAINTENANCE_TICK_SECONDS)
+            self.wake.clear()
+            try:
+                self.tick()
+            except Exception:
+                maintenance_logger.exception('maintenance tick failed')
+    
+    def inspect(self, store_id, path, quiet, now):
+        """حالة المحل، أو None إذا لم يتغير ملفه منذ آخر فحص لم يُستحق فيه شيء"""
+        wal_path = path + '-wal'
+        signature = (os.stat(path).st_mtime_ns, os.path.getsize(wal_path) if os.path.exists(wal_path) else 0,
+                     quiet, now // ANALYZE_MIN_INTERVAL)
+        if self.idle.get(store_id) == signature:
+            return None, signature
+        return store_maintenance_stats(path), signature
+    
+    def tick(self):
+        """جولة واحدة: اختيار الأعمال المستحقة لكل المحلات وتنفيذ أهمها في حدود الميزانية؛ ترجع ما نُفذ"""
+        now = int(time.time())
+        quiet = datetime.now().hour in MAINTENANCE_QUIET_SET
+        db = sqlite3.connect(MAIN_DB_PATH, timeout=SQLITE_BUSY_TIMEOUT)
+        try:
+            ensure_maintenance_tables(db)
+            db.execute('DELETE FROM maintenance_runs WHERE started_at < ?', (now - MAINTENANCE_HISTORY_DAYS * 86400,))
+            db.commit()
+            spent = db.execute('SELECT COALESCE(SUM(io_bytes), 0) FROM maintenance_runs WHERE started_at > ?',
+                               (now - 3600,)).fetchone()[0]
+            budget = MAINTENANCE_IO_BYTES - spent
+            if budget <= 0:
+                return []
+            state = {}
+            for store_id, job, last_run_at, last_marker in db.execute(
+                    'SELECT store_id, job, last_run_at, last_marker FROM maintenance_jobs'):
+                state.setdefault(store_id, {})[job] = {'last_run_at': last_run_at, 'last_marker': last_marker}
+            
+            candidates = []
+            for (store_id,) in db.execute('SELECT id FROM stores ORDER BY id').fetchall():
+                path = get_store_db_path(store_id)
+                if not os.path.exists(path):
+                    continue
+                try:
+                    stats, signature = self.inspect(store_id, path, quiet, now)
+                except sqlite3.Error as e:
+                    maintenance_logger.warning('store %s: cannot inspect database: %s', store_id, e)
+                    continue
+                if stats is None:
+                    continue
+                jobs = maintenance_candidates(stats, state.get(store_id, {}), quiet, now, datetime.now().date())
+                if not jobs:
+                    self.idle[store_id] = signature
+                for priority, job, cost in jobs:
+                    candidates.append((priority, store_id, job, cost, stats))
+            candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+            
+            done = []
+            for _priority, store_id, job, cost, stats in candidates:
+                # عمل أكبر من ميزانية الساعة كلها لا يُنفذ إلا في ساعة لم يُصرف فيها شيء
+                if cost > budget and budget < MAINTENANCE_IO_BYTES:
+                    continue
+                cursor = db.execute('''INSERT INTO maintenance_jobs (store_id, job, lease_until) VALUES (?, ?, ?)
+                                       ON CONFLICT (store_id, job) DO UPDATE SET lease_until = excluded.lease_until
+                                       WHERE lease_until IS NULL OR lease_until < ?''',
+                                    (store_id, job, now + MAINTENANCE_LEASE_SECONDS, now))
+                db.commit()
+                if cursor.rowcount != 1:
+                    continue  # عامل آخر ينفذه الآن
+                started, started_at = time.perf_counter(), int(time.time())
+                try:
+                    io_bytes, result, marker = run_maintenance_job(store_id, job, stats, budget, quiet)
+                except Exception as e:
+                    io_bytes, result, marker = 0, f'error: {e}', None
+                    maintenance_logger.warning('store %s: %s failed: %s', store_id, job, e)
+                seconds = time.perf_counter() - started
+                db.execute('''UPDATE maintenance_jobs SET last_run_at = ?, last_marker = COALESCE(?, last_marker),
+                                                        last_result = ?, runs = runs + 1, lease_until = NULL
+                              WHERE store_id = ? AND job = ?''', (started_at, marker, result, store_id, job))
+                db.execute('''INSERT INTO maintenance_runs (store_id, job, started_at, seconds, io_bytes, result)
+                              VALUES (?, ?, ?, ?, ?, ?)''', (store_id, job, started_at, seconds, io_bytes, result))
+                db.commit()
+                self.idle.pop(store_id, None)
+                metric_inc('lekhlef_maintenance_runs_total', {'job': job})
+                metric_inc('lekhlef_maintenance_io_bytes_total', amount=io_bytes)
+                done.append({'store_id': store_id, 'job': job, 'result': result, 'io_bytes': io_bytes, 'seconds': seconds})
+                budget -= io_bytes
+                if budget <= 0:
+                    break
+            return done
+        finally:
+            db.close()
+
+maintenance_scheduler = None
+_maintenance_lock = threading.Lock()
+
+@app.before_request
+def start_maintenance_scheduler():
+    """تشغيل خيط الصيانة مع أول طلب في كل عملية (بعد تفرع عمال gunicorn، ولا يبدأ في السكربتات)"""
+    global maintenance_scheduler
+    if MAINTENANCE_ENABLED and maintenance_scheduler is None:
+        with _maintenance_lock:
+            if maintenance_scheduler is None:
+                maintenance_scheduler = MaintenanceScheduler()
+                maintenance_scheduler.start()
+
+def recent_maintenance_runs(limit=30):
+    """آخر أعمال الصيانة وما صُرف من الميزانية في الساعة الأخيرة"""
+    db = get_main_db()
+    ensure_maintenance_tables(db)
+    runs = db.execute('SELECT * FROM maintenance_runs ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+    spent = db.execute('SELECT COALESCE(SUM(io_bytes), 0) FROM maintenance_runs WHERE started_at > ?',
+                       (int(time.time()) - 3600,)).fetchone()[0]
+    return {'runs': [dict(run, started=datetime.fromtimestamp(run['started_at']).strftime('%Y-%m-%d %H:%M:%S')) for run in runs],
+            'spent_bytes': spent, 'budget_bytes': MAINTENANCE_IO_BYTES,
+            'quiet_hours': MAINTENANCE_QUIET_HOURS, 'enabled': MAINTENANCE_ENABLED}
 
 def init_db():
     """تهيئة قواعد البيانات"""
@@ -400,6 +2249,7 @@ base_html = """
                     {% if session.user_id and session.username == 'admin' %}
                     <li><hr style="border-color: rgba(255,255,255,0.2); margin: 10px 0;"></li>
                     <li><a href="/admin/users" style="color: #ffd700; font-weight: bold;">👑 إدارة المستخدمين</a></li>
+                    <li><a href="/admin/profiling" style="color: #ffd700;">⏱️ قياس الأداء</a></li>
                     {% endif %}
                 </ul>
             </nav>
@@ -450,6 +2300,18 @@ base_html = """
 </html>
 """
 
+def render_page(page, **context):
+    """عرض محتوى الصفحة داخل القالب الأساسي مع قياس زمن الترجمة والعرض كلٍ على حدة"""
+    started = time.perf_counter()
+    template = app.jinja_env.from_string(base_html.replace('%%CONTENT%%', page))
+    compiled = time.perf_counter()
+    app.update_template_context(context)
+    html = template.render(context)
+    profile_add('template_compile', compiled - started)
+    profile_add('template_render', time.perf_counter() - compiled)
+    metric_observe('lekhlef_template_render_seconds', time.perf_counter() - started)
+    return html
+
 # --------- Authentication Routes ---------
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -537,7 +2399,7 @@ def login():
         </div>
     </section>
     '''
-    return render_template_string(base_html.replace('%%CONTENT%%', page))
+    return render_page(page)
 
 @app.route('/register', methods=['GET', 'POST'])
 def register_disabled():
@@ -569,7 +2431,7 @@ def register_disabled():
         </div>
     </section>
     '''
-    return render_template_string(base_html.replace('%%CONTENT%%', page))
+    return render_page(page)
 
 @app.route('/logout')
 def logout():
@@ -617,7 +2479,7 @@ def profile():
         </div>
     </section>
     '''
-    return render_template_string(base_html.replace('%%CONTENT%%', page))
+    return render_page(page)
 
 @app.route('/edit_profile', methods=['GET', 'POST'])
 @login_required
@@ -690,7 +2552,7 @@ def edit_profile():
         </div>
     </section>
     '''
-    return render_template_string(base_html.replace('%%CONTENT%%', page))
+    return render_page(page)
 
 @app.route('/change_password', methods=['GET', 'POST'])
 @login_required
@@ -765,7 +2627,7 @@ def change_password():
         </div>
     </section>
     '''
-    return render_template_string(base_html.replace('%%CONTENT%%', page))
+    return render_page(page)
 
 @app.route('/select_store')
 @login_required
@@ -853,7 +2715,7 @@ def select_store():
         </div>
     </section>
     '''
-    return render_template_string(base_html.replace('%%CONTENT%%', page), stores=stores, user=user)
+    return render_page(page, stores=stores, user=user)
 
 @app.route('/create_store', methods=['GET', 'POST'])
 @login_required
@@ -962,7 +2824,7 @@ def create_store():
         </div>
     </section>
     '''
-    return render_template_string(base_html.replace('%%CONTENT%%', page))
+    return render_page(page)
 
 @app.route('/test_store')
 @login_required
@@ -1058,14 +2920,22 @@ def delete_store(store_id):
         return redirect(url_for('select_store'))
     
     try:
+        ensure_maintenance_tables(db)
         # حذف المحل من قاعدة البيانات الرئيسية
         c.execute('DELETE FROM stores WHERE id = ?', (store_id,))
         c.execute('DELETE FROM store_permissions WHERE store_id = ?', (store_id,))
+        c.execute('DELETE FROM maintenance_jobs WHERE store_id = ?', (store_id,))
         
-        # حذف قاعدة بيانات المحل
+        # إغلاق كل ما يفتح قاعدة المحل في هذه العملية، ثم حذفها مع ملفي WAL والذاكرة المشتركة
         store_db_path = get_store_db_path(store_id)
-        if os.path.exists(store_db_path):
-            os.remove(store_db_path)
+        stop_store_writer(store_id)
+        drop_store_readers(store_id)
+        query_cache.drop(store_id)
+        drop_item_index(store_id)
+        for path in [store_db_path, store_db_path + '-wal', store_db_path + '-shm'] + sales_archive_files(store_id):
+            if os.path.exists(path):
+                os.chmod(path, 0o644)  # ملفات الأرشيف للقراءة فقط
+                os.remove(path)
         
         db.commit()
         
@@ -1190,9 +3060,130 @@ def store_settings():
         </div>
     </section>
     '''
-    return render_template_string(base_html.replace('%%CONTENT%%', page))
+    return render_page(page)
 
 # --------- Home: now serves only stats (no CMS check) ---------
+# --------- Live dashboard (SSE / polling) ---------
+# عناصر data-live في الرئيسية والإحصائيات تُحدَّث بإضافة فروقات الأحداث بدلاً من إعادة تحميل الصفحة.
+# LIVE_UPDATES=stream: بث SSE يحجز خيطاً طوال الاتصال، فالوضع المعتمد له هو ASGI (lekhlef_asgi)؛ في WSGI لا يُقبل
+# أكثر من SSE_MAX_STREAMS بثاً في العملية، والزائد يأخذ 204 فتنتقل لوحته إلى الاستطلاع ويبقى باقي الخيوط للطلبات.
+# poll (الافتراضي): طلب قصير كل LIVE_POLL_SECONDS لا يحجز العامل المتزامن؛ off: بلا تحديث مباشر.
+LIVE_APPLY_SCRIPT = """
+  function applyDeltas(deltas) {
+    Object.keys(deltas).forEach(function(key) {
+      document.querySelectorAll('[data-live="' + key + '"]').forEach(function(el) {
+        var value = parseInt(el.dataset.value || 0, 10) + deltas[key];  // المبالغ بالسنتيم
+        el.dataset.value = value;
+        el.textContent = el.dataset.money ? (value / 100).toFixed(2) : value;
+      });
+    });
+  }
+"""
+LIVE_POLL_LOOP = """
+  function startPolling() {
+    setTimeout(poll, %(interval)d);
+  }
+  function poll() {
+    fetch('/events/poll?after=' + lastId, {credentials: 'same-origin'})
+      .then(function(response) { return response.ok ? response.json() : null; })
+      .then(function(data) {
+        if (!data) return;
+        data.events.forEach(function(event) { applyDeltas(event.deltas || {}); });
+        lastId = data.last_id;
+      })
+      .catch(function() {})
+      .then(startPolling);
+  }
+"""
+LIVE_STREAM_SCRIPT = """
+<script>
+(function() {""" + LIVE_APPLY_SCRIPT + LIVE_POLL_LOOP + """
+  var lastId = %(last_id)d;
+  if (!window.EventSource) return startPolling();
+  var source = new EventSource('/events/stream');
+  source.addEventListener('delta', function(e) {
+    lastId = parseInt(e.lastEventId, 10) || lastId;
+    applyDeltas(JSON.parse(e.data).deltas || {});
+  });
+  source.onerror = function() {
+    // 204 (البث غير متاح أو بلغ الحد) يغلق EventSource نهائياً: نكمل بالاستطلاع من آخر حدث
+    if (source.readyState === EventSource.CLOSED) startPolling();
+  };
+})();
+</script>
+"""
+LIVE_POLL_SCRIPT = """
+<script>
+(function() {""" + LIVE_APPLY_SCRIPT + LIVE_POLL_LOOP + """
+  var lastId = %(last_id)d;
+  startPolling();
+})();
+</script>
+"""
+
+def live_dashboard_script():
+    """سكربت التحديث المباشر للوحة حسب LIVE_UPDATES (فارغ إذا كان معطلاً)"""
+    if LIVE_UPDATES == 'off':
+        return ''
+    last_id = get_db().execute('SELECT COALESCE(MAX(id), 0) FROM store_events').fetchone()[0]
+    script = LIVE_STREAM_SCRIPT if LIVE_UPDATES == 'stream' else LIVE_POLL_SCRIPT
+    return script % {'last_id': last_id, 'interval': LIVE_POLL_SECONDS * 1000}
+
+# مقاعد البث في هذه العملية: كل بث يحجز خيطاً من خيوط العامل، فلا يُترك للوحات إلا SSE_MAX_STREAMS منها
+_sse_slots = threading.BoundedSemaphore(max(SSE_MAX_STREAMS, 1))
+
+def stream_store_events(store_id, last_event_id=None):
+    """مولد بث SSE لأحداث محل حتى انقطاع الاتصال أو انتهاء SSE_MAX_SECONDS"""
+    events = queue.Queue()
+    backlog, unsubscribe = open_event_subscription(store_id, events.put, last_event_id)
+    sent_id = last_event_id or 0
+    deadline = time.monotonic() + SSE_MAX_SECONDS
+    try:
+        yield 'retry: 3000\n\n'
+        for event in backlog:
+            sent_id = event['id']
+            yield format_sse(event)
+        while time.monotonic() < deadline:
+            try:
+                event = events.get(timeout=max(min(SSE_KEEPALIVE_SECONDS, deadline - time.monotonic()), 0))
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            if event['id'] > sent_id:
+                sent_id = event['id']
+                yield format_sse(event)
+    finally:
+        unsubscribe()
+
+@app.route('/events/stream')
+@login_required
+@store_required
+def events_stream():
+    """بث أحداث المحل الحالي (Server-Sent Events)؛ 204 إن لم يكن البث مفعلاً فيتوقف EventSource عن إعادة الاتصال"""
+    if LIVE_UPDATES != 'stream' or SSE_MAX_STREAMS <= 0 or not _sse_slots.acquire(blocking=False):
+        return Response(status=204)
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    response = Response(stream_store_events(session['store_id'], last_event_id), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # يُستدعى عند إغلاق الاستجابة (انتهاء البث أو انقطاع الاتصال) حتى لو لم يبدأ المولد
+    response.call_on_close(_sse_slots.release)
+    return response
+
+@app.route('/events/poll')
+@login_required
+@store_required
+def events_poll():
+    """أحداث المحل الحالي بعد after (وضع الاستطلاع): {events: [...], last_id}"""
+    if LIVE_UPDATES == 'off':
+        return Response(status=204)
+    after = request.args.get('after', type=int)
+    db = get_db()
+    if after is None:
+        return {'events': [], 'last_id': db.execute('SELECT COALESCE(MAX(id), 0) FROM store_events').fetchone()[0]}
+    events = read_events(db, after)
+    return {'events': [dict(event['payload'], id=event['id'], kind=event['kind']) for event in events],
+            'last_id': events[-1]['id'] if events else after}
+
 @app.route('/')
 def index():
     user = get_current_user()
@@ -1209,7 +3200,7 @@ def index():
             </div>
         </section>
         '''
-        return render_template_string(base_html.replace('%%CONTENT%%', page))
+        return render_page(page)
     
     # إذا لم يكن هناك محل محدد
     if not store:
@@ -1224,16 +3215,15 @@ def index():
             </div>
         </section>
         '''
-        return render_template_string(base_html.replace('%%CONTENT%%', page))
+        return render_page(page)
     
     # إذا كان هناك محل محدد، عرض الإحصائيات
     db = get_store_db()
     if db:
-        c = db.cursor()
-        c.execute('SELECT COUNT(*) as cnt FROM items'); items_count = c.fetchone()['cnt']
-        c.execute('SELECT COUNT(*) as cnt FROM sales'); sales_count = c.fetchone()['cnt']
-        c.execute("SELECT COALESCE(SUM(total),0) as sumt FROM sales")
-        total_sales = c.fetchone()['sumt']
+        items_count = cached_query('SELECT COUNT(*) as cnt FROM items')[0]['cnt']
+        sales_count, total_sales = cached_query('SELECT COUNT(*) as cnt, COALESCE(SUM(total),0) as sumt FROM sales')[0]
+        archived_count, archived_total = archived_sales_totals()
+        sales_count, total_sales = sales_count + archived_count, total_sales + archived_total
     else:
         items_count = sales_count = total_sales = 0
 
@@ -1268,7 +3258,7 @@ def index():
         <div class="content">
           <div class="inner">
             <h2>الفواتير</h2>
-            <p>عدد الفواتير: <strong>{sales_count}</strong></p>
+            <p>عدد الفواتير: <strong data-live="sales_count" data-value="{sales_count}">{sales_count}</strong></p>
             <ul class="actions">
               <li><a href="/invoices" class="button">عرض الفواتير</a></li>
             </ul>
@@ -1281,7 +3271,7 @@ def index():
         <div class="content">
           <div class="inner">
             <h2>المبيعات</h2>
-            <p>إجمالي المبيعات: <strong>{total_sales} د.ج</strong></p>
+            <p>إجمالي المبيعات: <strong><span data-live="sales_total" data-value="{total_sales}" data-money="1">{format_money(total_sales)}</span> د.ج</strong></p>
             <ul class="actions">
               <li><a href="/stats" class="button">عرض الإحصائيات</a></li>
               <li><a href="/pos" class="button primary">اذهب لنقطة البيع</a></li>
@@ -1290,57 +3280,94 @@ def index():
         </div>
       </section>
     </section>
-    """
-    return render_template_string(base_html.replace('%%CONTENT%%', page))
+    """ + live_dashboard_script()
+    return render_page(page)
 
 # --------- POS (نقطة البيع) ----- 
 @app.route('/pos', methods=['GET','POST'])
 @login_required
 @store_required
 def pos():
-    db = get_db(); c = db.cursor()
     if request.method == 'POST':
         item_ids = request.form.getlist('item_id')
         qtys = request.form.getlist('qty')
         prices = request.form.getlist('price')
         customer_id = request.form.get('customer_id') or None
         new_customer_name = request.form.get('new_customer_name')
+        cart_token = request.form.get('cart_token') or None
         
-        # إذا تم إدخال اسم زبون جديد، احفظه أولاً
-        if customer_id == 'new' and new_customer_name:
-            c.execute('INSERT INTO customers (name) VALUES (?)', (new_customer_name,))
-            customer_id = c.lastrowid
-            db.commit()
-        
+        lines = [(int(i), int(q), parse_money(p)) for i,q,p in zip(item_ids, qtys, prices)]
+        failures = invalid_line_failures(get_db().cursor(), lines)
+        if failures:
+            for message in stock_failure_messages(failures):
+                flash(message)
+            return redirect(url_for('pos'))
         total = 0
-        for i,q,p in zip(item_ids, qtys, prices):
-            total += int(q) * float(p)
-        date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        c.execute('INSERT INTO sales (customer_id,date,total) VALUES (?,?,?)', (customer_id, date, total))
-        sale_id = c.lastrowid
-        for i,q,p in zip(item_ids, qtys, prices):
-            iid = int(i); qq = int(q); pp = float(p)
-            c.execute('INSERT INTO sale_items (sale_id,item_id,qty,price) VALUES (?,?,?,?)', (sale_id, iid, qq, pp))
-            c.execute('UPDATE items SET qty = qty - ? WHERE id = ?', (qq, iid))
-        db.commit()
+        for iid, qq, pp in lines:
+            total += qq * pp
+        now = datetime.now()
+        date = now.strftime('%Y-%m-%d %H:%M:%S')
+        
+        # عملية كتابة واحدة عبر كاتب المحل: البيع كله أو لا شيء
+        def record_sale(c):
+            sale_customer_id = customer_id
+            # إذا تم إدخال اسم زبون جديد، احفظه أولاً
+            if customer_id == 'new' and new_customer_name:
+                c.execute('INSERT INTO customers (name) VALUES (?)', (new_customer_name,))
+                sale_customer_id = c.lastrowid
+            
+            failures = deduct_stock(c, [(iid, qq) for iid, qq, pp in lines], cart_token)
+            if failures:
+                raise WriteRejected(stock_failure_messages(failures))
+            
+            c.execute('INSERT INTO sales (customer_id,date,date_ts,total) VALUES (?,?,?,?)',
+                      (sale_customer_id, date, date_ts(now), total))
+            sale_id = c.lastrowid
+            c.executemany('INSERT INTO sale_items (sale_id,item_id,qty,price) VALUES (?,?,?,?)',
+                          [(sale_id, iid, qq, pp) for iid, qq, pp in lines])
+            release_reservations(c, cart_token)
+            stock = {}
+            for iid, qq, pp in lines:
+                stock[iid] = stock.get(iid, 0) - qq
+            publish_event(c, 'sale', {'sales_count': 1, 'sales_total': total, 'profit': total,
+                                      'stock_value': -stock_cost(c, [(iid, qq) for iid, qq, pp in lines])},
+                          sale_id=sale_id, stock=stock)
+            return sale_id
+        
+        try:
+            sale_id = run_store_write(record_sale)
+        except WriteRejected as e:
+            for message in e.messages:
+                flash(message)
+            return redirect(url_for('pos'))
+        metric_inc('lekhlef_sales_total', {'store_id': str(session['store_id'])})
+        metric_inc('lekhlef_sales_amount_total', {'store_id': str(session['store_id'])}, total / MONEY_SCALE)
+        prerender_document(session['store_id'], 'sale', sale_id)
         flash('تم تسجيل عملية البيع.')
         return redirect(url_for('invoice', id=sale_id))
-    c.execute('SELECT * FROM items ORDER BY name'); items = c.fetchall()
-    c.execute('SELECT * FROM customers ORDER BY name'); customers = c.fetchall()
+    items = cached_query('SELECT * FROM items ORDER BY name')
+    customers = cached_query('''SELECT cu.*, COALESCE(b.balance, 0) AS balance FROM customers cu
+                                LEFT JOIN entity_balances b ON b.entity_type = 'customer' AND b.entity_id = cu.id
+                                ORDER BY cu.name''')
     page = '''
     <section class="wrapper style1 fade-up"><div class="inner">
     <div class="row">
       <div class="col-8">
         <h3>نقطة البيع</h3>
         <form method="post" id="pos-form">
+          <input type="hidden" name="cart_token" id="cart-token" value="{{cart_token}}">
           <div class="fields">
-            <div class="field">
+            <div class="field half">
+              <label for="barcode-scan">▮▯▮ مسح الباركود:</label>
+              <input type="text" id="barcode-scan" class="form-control" placeholder="امسح رمز المنتج ثم Enter" autocomplete="off" autofocus>
+            </div>
+            <div class="field half">
               <label for="product-search">🔍 البحث عن منتج:</label>
               <input type="text" id="product-search" class="form-control" placeholder="اكتب اسم المنتج أو الكود للبحث...">
             </div>
           </div>
           <div class="fields">
-            <div class="field fourty"><select id="product-select" class="form-select"><option value="">-- اختر صنف --</option>{% for it in items %}<option data-price="{{it['sell_price']}}" data-name="{{it['name']}}" data-code="{{it['code']}}" value="{{it['id']}}">{{it['name']}} ({{it['code']}}) - {{it['qty']}}</option>{% endfor %}</select></div>
+            <div class="field fourty"><select id="product-select" class="form-select"><option value="">-- اختر صنف --</option>{% for it in items %}<option data-price="{{it['sell_price']|money}}" data-name="{{it['name']}}" data-code="{{it['code']}}" value="{{it['id']}}">{{it['name']}} ({{it['code']}}) - {{it['qty']}}</option>{% endfor %}</select></div>
             <div class="field quarter"><input id="product-qty" type="number" class="form-control" value="1" min="1"></div>
             <div class="field"><button id="add-btn" type="button" class="button primary fit">أضف</button></div>
           </div>
@@ -1357,7 +3384,7 @@ def pos():
               <label>زبون (اختياري)</label>
               <select name="customer_id" id="customer-select" class="form-select">
                 <option value="">-- عميل عام --</option>
-                {% for cu in customers %}<option value="{{cu['id']}}">{{cu['name']}}</option>{% endfor %}
+                {% for cu in customers %}<option value="{{cu['id']}}" data-balance="{{cu['balance']|money}}">{{cu['name']}}{% if cu['balance'] > 0 %} (دين: {{ cu['balance']|money }} د.ج){% endif %}</option>{% endfor %}
                 <option value="new">+ إضافة زبون جديد</option>
               </select>
             </div>
@@ -1376,7 +3403,7 @@ def pos():
         <h5>منتجات سريعة</h5>
         <ul class="actions small fit">
           {% for it in items %}
-            <li><button class="button small quick-add fit" data-id="{{it['id']}}" data-price="{{it['sell_price']}}">{{it['name']}} ({{it['qty']}})</button></li>
+            <li><button class="button small quick-add fit" data-id="{{it['id']}}" data-price="{{it['sell_price']|money}}">{{it['name']}} ({{it['qty']}})</button></li>
           {% endfor %}
         </ul>
       </div>
@@ -1436,17 +3463,48 @@ def pos():
         const qty = parseInt(document.getElementById('product-qty').value)||1; const price = itemsData[id].price; const name = itemsData[id].name;
         addRow(id, name, price, qty);
       });
+      // حجز مؤقت للكمية في السلة حتى لا يبيعها صندوق آخر
+      function reserve(id, qty){
+        if(!{{reservation_enabled}}) return Promise.resolve(true);
+        return fetch('/pos/reserve', {method: 'POST', headers: {'Content-Type': 'application/json'},
+          body: JSON.stringify({cart_token: document.getElementById('cart-token').value, item_id: id, qty: qty})})
+          .then(r=>r.json()).then(res=>{
+            if(!res.ok){ alert('الكمية غير كافية، المتاح: ' + res.available); }
+            return res.ok;
+          }).catch(()=>true);
+      }
       function addRow(id,name,price,qty){
         const tbody = document.querySelector('#cart-table tbody');
         let existing = tbody.querySelector('tr[data-id="'+id+'"]');
-        if(existing){ const qinput = existing.querySelector('.c-qty'); qinput.value = parseInt(qinput.value) + qty; recalc(); return; }
-        const tr = document.createElement('tr'); tr.dataset.id = id; tr.dataset.price = price;
-        tr.innerHTML = `<td>${name}</td><td>${price.toFixed(2)}</td><td><input name="qty" class="form-control c-qty" value="${qty}" min="1"></td><td class="c-line">${(price*qty).toFixed(2)}</td><td><button type="button" class="button small secondary remove">❌</button></td>`;
-        tbody.appendChild(tr);
-        tr.querySelector('.remove').addEventListener('click', ()=>{ tr.remove(); recalc(); });
-        tr.querySelector('.c-qty').addEventListener('change', recalc);
-        recalc();
+        if(existing){
+          const qinput = existing.querySelector('.c-qty'); const newQty = parseInt(qinput.value) + qty;
+          reserve(id, newQty).then(ok=>{ if(ok){ qinput.value = newQty; recalc(); } });
+          return;
+        }
+        reserve(id, qty).then(ok=>{
+          if(!ok) return;
+          const tr = document.createElement('tr'); tr.dataset.id = id; tr.dataset.price = price;
+          tr.innerHTML = `<td>${name}</td><td>${price.toFixed(2)}</td><td><input name="qty" class="form-control c-qty" value="${qty}" min="1"></td><td class="c-line">${(price*qty).toFixed(2)}</td><td><button type="button" class="button small secondary remove">❌</button></td>`;
+          tbody.appendChild(tr);
+          tr.querySelector('.remove').addEventListener('click', ()=>{ reserve(id, 0); tr.remove(); recalc(); });
+          tr.querySelector('.c-qty').addEventListener('change', function(){
+            const input = this; reserve(id, parseInt(input.value)||1).then(ok=>{ if(!ok){ input.value = input.dataset.last || 1; } input.dataset.last = input.value; recalc(); });
+          });
+          recalc();
+        });
       }
+      // الماسح يكتب الرمز ثم Enter: البحث في فهرس الخادم وإضافة السطر مباشرة
+      const scanInput = document.getElementById('barcode-scan');
+      scanInput.addEventListener('keydown', function(e){
+        if(e.key !== 'Enter') return;
+        e.preventDefault();
+        const code = scanInput.value.trim(); scanInput.value = '';
+        if(!code) return;
+        fetch('/pos/scan?code=' + encodeURIComponent(code)).then(r=>r.json()).then(res=>{
+          if(!res.ok){ alert('لا يوجد منتج بالرمز: ' + code); return; }
+          addRow(String(res.item.id), res.item.name, parseFloat(res.item.price), 1);
+        }).finally(()=>scanInput.focus());
+      });
       document.querySelectorAll('.quick-add').forEach(btn=>{ btn.addEventListener('click', ()=>{ const id = btn.dataset.id; const price = parseFloat(btn.dataset.price); const name = btn.textContent.trim().split(' (')[0]; addRow(id, name, price, 1); }); });
       
       // التعامل مع إضافة زبون جديد
@@ -1494,7 +3552,523 @@ def pos():
       });
     </script>
     '''
-    return render_template_string(base_html.replace('%%CONTENT%%', page), items=items, customers=customers)
+    return render_page(page, items=items, customers=customers,
+                                  cart_token=os.urandom(8).hex(),
+                                  reservation_enabled='true' if STOCK_RESERVATION_SECONDS > 0 else 'false')
+
+@app.route('/pos/reserve', methods=['POST'])
+@login_required
+@store_required
+def pos_reserve():
+    """حجز (أو تعديل/إلغاء) كمية صنف لسلة نقطة بيع لمدة قصيرة"""
+    data = request.get_json(silent=True) or {}
+    cart_token = str(data.get('cart_token') or '')
+    try:
+        item_id = int(data.get('item_id'))
+        qty = max(int(data.get('qty') or 0), 0)
+    except (TypeError, ValueError):
+        return {'ok': False, 'error': 'invalid request'}, 400
+    if not cart_token or STOCK_RESERVATION_SECONDS <= 0:
+        return {'ok': True, 'available': None}
+    
+    def reserve(c):
+        now = int(time.time())
+        c.execute('DELETE FROM stock_reservations WHERE expires_at <= ?', (now,))
+        c.execute('''SELECT qty - (SELECT COALESCE(SUM(r.qty), 0) FROM stock_reservations r
+                                   WHERE r.item_id = items.id AND r.expires_at > ? AND r.cart_token != ?) AS available
+                     FROM items WHERE id = ?''', (now, cart_token, item_id))
+        row = c.fetchone()
+        available = max(row['available'], 0) if row else 0
+        if qty == 0:
+            c.execute('DELETE FROM stock_reservations WHERE cart_token = ? AND item_id = ?', (cart_token, item_id))
+        elif qty <= available:
+            c.execute('''INSERT INTO stock_reservations (cart_token, item_id, qty, expires_at) VALUES (?, ?, ?, ?)
+                         ON CONFLICT(cart_token, item_id) DO UPDATE SET qty = excluded.qty, expires_at = excluded.expires_at''',
+                      (cart_token, item_id, qty, now + STOCK_RESERVATION_SECONDS))
+        return available
+    
+    # عبر كاتب المحل مثل البيع: الحجز لا ينافس دفعات الكتابة على قفل القاعدة
+    available = run_store_write(reserve)
+    return {'ok': qty <= available, 'available': available}
+
+# --------- Barcode index (scan) ---------
+# رمز الصنف -> (id, name, sell_price) لكل محل في ذاكرة العملية. اتصال دائم يقرأ PRAGMA data_version (لا يقرأ
+# من القرص إن لم يحفظ اتصال آخر شيئاً)، وعند تغيره يقارن catalog_version الذي تزيده triggers جدول items، فلا
+# يُعاد البناء بسبب البيع والتوريد اللذين يغيران الكمية فقط. الكمية تُقرأ بالمفتاح الأساسي عند كل مسح.
+class ItemCodeIndex:
+    """فهرس رموز أصناف محل واحد"""
+    
+    def __init__(self, store_id):
+        self.store_id = store_id
+        self.lock = threading.Lock()
+        self.db = None
+        self.data_version = None
+        self.catalog_version = None
+        self.codes = {}
+    
+    def invalidate(self):
+        with self.lock:
+            self.data_version = self.catalog_version = None
+    
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+            self.data_version = self.catalog_version = None
+    
+    def _refresh(self):
+        if self.db is None:
+            self.db = sqlite3.connect(get_store_db_path(self.store_id), timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False)
+        data_version = self.db.execute('PRAGMA data_version').fetchone()[0]
+        if data_version == self.data_version:
+            return
+        row = self.db.execute("SELECT value FROM store_meta WHERE key = 'catalog_version'").fetchone()
+        catalog_version = row[0] if row else None
+        if catalog_version is None or catalog_version != self.catalog_version:
+            self.codes = {code: (item_id, name, price) for item_id, code, name, price in
+                          self.db.execute("SELECT id, code, name, sell_price FROM items WHERE code IS NOT NULL AND code != ''")}
+            self.catalog_version = catalog_version
+            metric_inc('lekhlef_item_index_rebuilds_total', {'store_id': str(self.store_id)})
+        self.data_version = data_version
+    
+    def lookup(self, code):
+        """الصنف بالرمز كقاموس {id, code, name, price, qty} أو None"""
+        with self.lock:
+            self._refresh()
+            entry = self.codes.get(code)
+            if entry is None:
+                return None
+            row = self.db.execute('SELECT qty FROM items WHERE id = ?', (entry[0],)).fetchone()
+        if row is None:
+            return None
+        return {'id': entry[0], 'code': code, 'name': entry[1], 'price': format_money(entry[2]), 'qty': row[0]}
+
+_item_indexes = {}  # store_id -> ItemCodeIndex
+_item_indexes_lock = threading.Lock()
+
+def item_code_index(store_id):
+    with _item_indexes_lock:
+        index = _item_indexes.get(store_id)
+        if index is None:
+            index = _item_indexes[store_id] = ItemCodeIndex(store_id)
+        return index
+
+def invalidate_item_index(store_id):
+    """إعادة بناء فهرس الباركود عند المسح التالي (بعد إضافة صنف أو تعديله أو حذفه)"""
+    index = _item_indexes.get(store_id)
+    if index is not None:
+        index.invalidate()
+
+def drop_item_index(store_id):
+    """إغلاق فهرس الباركود لمحل واتصاله (قبل حذف قاعدته)"""
+    with _item_indexes_lock:
+        index = _item_indexes.pop(store_id, None)
+    if index is not None:
+        index.close()
+
+@app.route('/pos/scan')
+@login_required
+@store_required
+def pos_scan():
+    """البحث عن صنف برمزه (الباركود) لإضافته إلى سلة نقطة البيع"""
+    code = (request.args.get('code') or '').strip()
+    if not code:
+        return {'ok': False, 'error': 'missing code'}, 400
+    ensure_store_database_exists(session['store_id'])
+    item = item_code_index(session['store_id']).lookup(code)
+    if item is None:
+        return {'ok': False, 'error': 'not found'}, 404
+    return {'ok': True, 'item': item}
+
+# --------- Documents (PDF) ---------
+# الفاتورة وسند التوريد يشتركان في قالب واحد تستعمله صفحة الطباعة وملف PDF. ملفات PDF تُولَّد في مجمع
+# عمليات منفصل وتُخزَّن حسب بصمة HTML: store_<id>/objects/<sha256>.pdf، وملف فهرس لكل مستند يشير
+# إلى آخر بصمة حتى يمكن حذفها عند التعديل أو الحذف. أي تغيير في المحتوى (بما فيه اسم المحل) يغيّر البصمة.
+try:
+    import weasyprint
+except ImportError:  # اختياري: بدونه تبقى الطباعة من المتصفح فقط
+    weasyprint = None
+
+# أزرار PDF وZIP لا تظهر في الصفحات إلا إذا كان التوليد متاحاً
+app.jinja_env.globals['pdf_available'] = weasyprint is not None
+
+# النوع -> (جدول الرؤوس، جدول الطرف، عمود الطرف، جدول السطور، عمود المستند في السطور)
+DOCUMENT_SOURCES = {
+    'sale': ('sales', 'customers', 'customer_id', 'sale_items', 'sale_id'),
+    'purchase': ('purchases', 'suppliers', 'supplier_id', 'purchase_items', 'purchase_id'),
+}
+EXPORT_WINDOW = max(PDF_WORKERS * 2, 2)  # أقصى عدد ملفات PDF قيد التوليد أو الانتظار أثناء التصدير
+
+DOCUMENT_TEMPLATE = """
+<div class="invoice-container" id="invoice-content" style="width: 210mm; margin: 0 auto; background: white; padding: 10mm; box-sizing: border-box; font-family: 'Cairo', Arial, sans-serif;">
+    <!-- ترويسة الفاتورة -->
+    <div class="invoice-header text-center" style="border-bottom: 2px solid #000; padding-bottom: 8px; margin-bottom: 15px;">
+        <h1 style="color: #000; margin: 0; font-size: 26px; font-weight: bold;">{{store['store_name']}}</h1>
+        <h2 style="color: #000; margin: 3px 0 10px 0; font-size: 20px; font-weight: bold;">{{ 'فاتورة بيع' if kind == 'sale' else 'سند توريد' }}</h2>
+        
+        <div style="display: flex; justify-content: space-between; background: #f0f0f0; padding: 8px; border-radius: 4px; font-size: 14px; border: 1px solid #000;">
+            <div style="font-weight: bold;"><strong>{{ 'رقم الفاتورة' if kind == 'sale' else 'رقم السند' }}:</strong> #{{doc['id']}}</div>
+            <div style="font-weight: bold;"><strong>التاريخ:</strong> {{doc['date'][:16]}}</div>
+        </div>
+    </div>
+
+    <!-- معلومات الزبون -->
+    <div style="margin-bottom: 15px; padding: 8px; background: #f8f8f8; border-radius: 4px; border: 1px solid #000;">
+        <h4 style="margin: 0 0 6px 0; color: #000; font-size: 16px; font-weight: bold;">{{ 'معلومات الزبون' if kind == 'sale' else 'معلومات المورد' }}</h4>
+        <p style="margin: 0; font-size: 14px; color: #000;"><strong>الاسم:</strong> {{doc['party_name'] or ('عميل عام' if kind == 'sale' else 'بدون مورد')}}</p>
+    </div>
+
+    <!-- جدول المنتجات -->
+    <div style="margin: 15px 0;">
+        <table style="width: 100%; border-collapse: collapse; font-size: 12px; border: 2px solid #000;">
+            <thead style="background: #e0e0e0; color: #000;">
+                <tr>
+                    <th style="padding: 8px 6px; text-align: right; width: 50%; border: 1px solid #000; font-weight: bold;">الصنف</th>
+                    <th style="padding: 8px 6px; text-align: center; width: 15%; border: 1px solid #000; font-weight: bold;">السعر</th>
+                    <th style="padding: 8px 6px; text-align: center; width: 15%; border: 1px solid #000; font-weight: bold;">الكمية</th>
+                    <th style="padding: 8px 6px; text-align: center; width: 20%; border: 1px solid #000; font-weight: bold;">المجموع</th>
+                </tr>
+            </thead>
+            <tbody>
+                {% for l in lines %}
+                <tr>
+                    <td style="padding: 6px 6px; text-align: right; border: 1px solid #000; color: #000; font-weight: normal;">{{l['name']}}</td>
+                    <td style="padding: 6px 6px; text-align: center; border: 1px solid #000; color: #000; font-weight: normal;">{{ l['price']|money }} د.ج</td>
+                    <td style="padding: 6px 6px; text-align: center; border: 1px solid #000; color: #000; font-weight: normal;">{{l['qty']}}</td>
+                    <td style="padding: 6px 6px; text-align: center; border: 1px solid #000; color: #000; font-weight: normal;">{{ (l['price'] * l['qty'])|money }} د.ج</td>
+                </tr>
+                {% endfor %}
+                
+                <!-- أسطر فارغة أقل -->
+                {% for i in range(8 - lines|length) %}
+                <tr>
+                    <td style="padding: 6px 6px; border: 1px solid #000; color: #000;">&nbsp;</td>
+                    <td style="padding: 6px 6px; border: 1px solid #000; color: #000;">&nbsp;</td>
+                    <td style="padding: 6px 6px; border: 1px solid #000; color: #000;">&nbsp;</td>
+                    <td style="padding: 6px 6px; border: 1px solid #000; color: #000;">&nbsp;</td>
+                </tr>
+                {% endfor %}
+            </tbody>
+        </table>
+    </div>
+
+    <!-- المجموع والتوقيع -->
+    <div style="display: flex; justify-content: space-between; margin-top: 20px; align-items: flex-start;">
+        <!-- المجموع الكلي -->
+        <div style="flex: 1; margin-left: 15px;">
+            <div style="background: #f0f0f0; padding: 15px; border-radius: 4px; text-align: center; border: 2px solid #000;">
+                <h4 style="margin: 0 0 10px 0; color: #000; font-size: 16px; font-weight: bold;">المجموع الكلي</h4>
+                <div style="font-size: 22px; font-weight: bold; color: #000;">{{ doc['total']|money }} د.ج</div>
+            </div>
+        </div>
+
+        <!-- توقيع البائع فقط -->
+        <div style="flex: 1; text-align: center;">
+            <div style="border-top: 2px solid #000; width: 200px; margin: 0 auto; padding-top: 40px;">
+                <p style="margin: 0; font-size: 14px; color: #000; font-weight: bold;">{{ 'توقيع البائع' if kind == 'sale' else 'توقيع المستلم' }}</p>
+            </div>
+        </div>
+    </div>
+
+    {% if kind == 'sale' %}
+    <!-- ملاحظات وإشعارات -->
+    <div style="margin-top: 20px; padding: 12px; background: #f8f8f8; border: 1px solid #000; border-radius: 4px; font-size: 11px;">
+        <h5 style="color: #000; margin: 0 0 8px 0; font-size: 14px; font-weight: bold; text-align: center;">شروط وإشعارات:</h5>
+        <div style="display: flex; justify-content: space-between; gap: 15px;">
+            <div style="flex: 1;">
+                <p style="margin: 4px 0; color: #000; line-height: 1.4;">
+                    • المرتجعات خلال 7 أيام من تاريخ الشراء<br>
+                    • يرجى فحص المنتج قبل المغادرة<br>
+                    • لا يوجد استرداد نقدي
+                </p>
+            </div>
+            <div style="flex: 1; text-align: right;">
+                <p style="margin: 4px 0; color: #000; line-height: 1.4;">
+                    • للاستفسار: <strong style="font-size: 12px;">{{store['phone'] or '0676904111'}}</strong><br>
+                    • الاستبدال بشروط وأحكام<br>
+                    • الفاتورة واجبة الدفع فوراً<br>
+                    • ختم المكتبة ضروري
+                </p>
+            </div>
+        </div>
+    </div>
+
+    {% endif %}
+
+    <!-- تذييل الفاتورة -->
+    <div style="margin-top: 15px; text-align: center; padding-top: 10px; border-top: 1px solid #000; font-size: 11px; color: #000;">
+        <p style="margin: 0; font-weight: bold;">{{store['store_name']}} - جميع المواد التعليمية والقرطاسية - هاتف: {{store['phone'] or '0676904111'}}</p>
+        <p style="margin: 3px 0 0 0; font-size: 10px;">شكراً لثقتكم ونرحب بزيارتكم دائماً</p>
+    </div>
+</div>
+"""
+
+DOCUMENT_PAGE = """<!DOCTYPE html>
+<html lang="ar" dir="rtl">
+<head>
+<meta charset="utf-8">
+<style>
+    @page { size: A4; margin: 0; }
+    body { margin: 0; direction: rtl; }
+    .invoice-container { page-break-inside: avoid; }
+    .invoice-container + .invoice-container { page-break-before: always; }
+</style>
+</head>
+<body>%%DOCUMENT%%</body>
+</html>"""
+
+_document_template = None
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+_pdf_pending = {}  # (store_id, sha256) -> Future قيد التوليد
+
+def _document_queries(kind, where, history=False):
+    """استعلاما الرؤوس والسطور لنوع المستند بشرط على جدول الرؤوس (الاسم المستعار h)؛
+    history للفواتير يقرأ من sales_all وsale_items_all (بعد attach_sales_archives)"""
+    header_table, party_table, party_column, lines_table, lines_column = DOCUMENT_SOURCES[kind]
+    if history:
+        header_table, lines_table = f'{header_table}_all', f'{lines_table}_all'
+    headers = f'''SELECT h.id, h.date, h.total, p.name AS party_name FROM {header_table} h
+                   LEFT JOIN {party_table} p ON p.id = h.{party_column} WHERE {where} ORDER BY h.id'''
+    lines = f'''SELECT l.*, it.name FROM {lines_table} l JOIN {header_table} h ON h.id = l.{lines_column}
+                 LEFT JOIN items it ON it.id = l.item_id WHERE {where} ORDER BY l.{lines_column}, l.id'''
+    return headers, lines
+
+def load_document(c, kind, doc_id):
+    """رأس وسطور الفاتورة (sale) أو سند التوريد (purchase)؛ None إذا لم يوجد"""
+    headers_sql, lines_sql = _document_queries(kind, 'h.id = ?')
+    c.execute(headers_sql, (doc_id,))
+    doc = c.fetchone()
+    if doc is None and kind == 'sale' and attach_sales_archives(c.connection):
+        headers_sql, lines_sql = _document_queries(kind, 'h.id = ?', history=True)
+        c.execute(headers_sql, (doc_id,))
+        doc = c.fetchone()
+    if doc is None:
+        return None
+    c.execute(lines_sql, (doc_id,))
+    return doc, c.fetchall()
+
+def iter_documents(db, kind, date_from, date_to):
+    """مستندات فترة كأزواج (رأس، سطور) باستعلامين فقط؛ النتيجتان مرتبتان برقم المستند وتُدمجان أثناء
+    القراءة فلا يبقى في الذاكرة إلا مستند واحد"""
+    history = kind == 'sale' and bool(attach_sales_archives(db))
+    headers_sql, lines_sql = _document_queries(kind, 'h.date_ts >= ? AND h.date_ts < ?', history)
+    lines_column = DOCUMENT_SOURCES[kind][4]
+    params = day_range_ts(date_from, date_to)
+    headers = db.cursor().execute(headers_sql, params)
+    lines = db.cursor().execute(lines_sql, params)
+    line = lines.fetchone()
+    for doc in headers:
+        doc_lines = []
+        while line is not None and line[lines_column] <= doc['id']:
+            if line[lines_column] == doc['id']:
+                doc_lines.append(line)
+            line = lines.fetchone()
+        yield doc, doc_lines
+
+def render_document(kind, doc, lines, store):
+    """HTML المستند (بدون القالب الأساسي)"""
+    global _document_template
+    if _document_template is None:
+        _document_template = app.jinja_env.from_string(DOCUMENT_TEMPLATE)
+    return _document_template.render(kind=kind, doc=doc, lines=lines, store=store)
+
+def html_to_pdf(html):
+    """تحويل صفحة HTML كاملة إلى PDF (تُنفَّذ داخل عملية من مجمع PDF)"""
+    return weasyprint.HTML(string=html).write_pdf()
+
+def pdf_pool():
+    """مجمع عمليات توليد PDF (spawn حتى لا ترث العمليات اتصالات SQLite والخيوط)"""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            _pdf_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return _pdf_pool
+
+def _pdf_index_path(store_id, kind, doc_id):
+    return os.path.join(PDF_CACHE_DIR, f'store_{store_id}', 'index', f'{kind}_{doc_id}')
+
+def _pdf_object_path(store_id, digest):
+    return os.path.join(PDF_CACHE_DIR, f'store_{store_id}', 'objects', f'{digest}.pdf')
+
+def _write_file_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def _read_pdf_index(store_id, kind, doc_id):
+    try:
+        with open(_pdf_index_path(store_id, kind, doc_id), encoding='ascii') as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def store_document_pdf(store_id, kind, doc_id, digest, pdf):
+    """حفظ ملف PDF وتحديث فهرس المستند (مع حذف النسخة السابقة إن اختلفت)"""
+    _write_file_atomic(_pdf_object_path(store_id, digest), pdf)
+    previous = _read_pdf_index(store_id, kind, doc_id)
+    _write_file_atomic(_pdf_index_path(store_id, kind, doc_id), digest.encode('ascii'))
+    if previous and previous != digest:
+        _remove_file(_pdf_object_path(store_id, previous))
+
+def invalidate_document(store_id, kind, doc_id):
+    """حذف ملف PDF المخزَّن للمستند (بعد تعديل الفاتورة أو حذفها)"""
+    digest = _read_pdf_index(store_id, kind, doc_id)
+    _remove_file(_pdf_index_path(store_id, kind, doc_id))
+    if digest:
+        _remove_file(_pdf_object_path(store_id, digest))
+
+def submit_document_pdf(store_id, kind, doc_id, html):
+    """إرسال المستند إلى مجمع PDF (أو إرجاع التوليد الجاري لنفس المحتوى)؛ يُحفظ الناتج عند الانتهاء"""
+    digest = hashlib.sha256(html.encode('utf-8')).hexdigest()
+    key = (store_id, digest)
+    pool = pdf_pool()  # قبل القفل: pdf_pool تأخذ نفس القفل
+    # الفحص والإرسال والتسجيل تحت قفل واحد حتى لا يرسل طلبان متزامنان نفس المستند مرتين
+    with _pdf_pool_lock:
+        future = _pdf_pending.get(key)
+        if future is not None:
+            return future
+        future = _pdf_pending[key] = pool.submit(html_to_pdf, html)
+
+    def finished(done):
+        try:
+            if done.exception() is None:
+                store_document_pdf(store_id, kind, doc_id, digest, done.result())
+                metric_inc('lekhlef_pdf_rendered_total', {'kind': kind})
+            else:
+                app.logger.error('PDF rendering failed for %s %s: %s', kind, doc_id, done.exception())
+        finally:
+            with _pdf_pool_lock:
+                if _pdf_pending.get(key) is done:
+                    del _pdf_pending[key]
+    future.add_done_callback(finished)  # خارج القفل: إن انتهى التوليد فوراً يُستدعى هنا ويأخذ القفل
+    return future
+
+def document_html(kind, doc, lines, store):
+    """صفحة HTML كاملة لمستند واحد وبصمتها"""
+    html = DOCUMENT_PAGE.replace('%%DOCUMENT%%', render_document(kind, doc, lines, store))
+    return html, hashlib.sha256(html.encode('utf-8')).hexdigest()
+
+def document_pdf_source(store_id, kind, doc_id, store):
+    """HTML الكامل للمستند وبصمته (None إذا لم يوجد المستند)"""
+    loaded = load_document(get_db().cursor(), kind, doc_id)
+    if loaded is None:
+        return None
+    return document_html(kind, loaded[0], loaded[1], store)
+
+def cached_pdf(store_id, digest):
+    try:
+        with open(_pdf_object_path(store_id, digest), 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+def get_document_pdf(store_id, kind, doc_id, store):
+    """ملف PDF للمستند: من الذاكرة المخزنة إن طابقت البصمة، وإلا يُولَّد في مجمع PDF وينتظره الطلب"""
+    source = document_pdf_source(store_id, kind, doc_id, store)
+    if source is None:
+        return None
+    html, digest = source
+    pdf = cached_pdf(store_id, digest)
+    metric_inc('lekhlef_pdf_cache_total', {'result': 'miss' if pdf is None else 'hit'})
+    if pdf is None:
+        pdf = submit_document_pdf(store_id, kind, doc_id, html).result(timeout=PDF_TIMEOUT)
+    return pdf
+
+def prerender_document(store_id, kind, doc_id):
+    """توليد PDF مسبقاً في الخلفية بعد تسجيل البيع/التوريد (لا شيء إذا لم تتوفر weasyprint)"""
+    if weasyprint is None:
+        return
+    source = document_pdf_source(store_id, kind, doc_id, get_current_store())
+    if source is not None and not os.path.exists(_pdf_object_path(store_id, source[1])):
+        submit_document_pdf(store_id, kind, doc_id, source[0])
+
+def document_pdf_response(kind, doc_id):
+    if weasyprint is None:
+        return Response('توليد PDF غير متاح: ثبّت weasyprint (pip install weasyprint).', status=503,
+                        mimetype='text/plain')
+    try:
+        pdf = get_document_pdf(session['store_id'], kind, doc_id, get_current_store())
+    except Exception as e:
+        app.logger.error('PDF rendering failed for %s %s: %s', kind, doc_id, e)
+        return Response('تعذر توليد ملف PDF، حاول مرة أخرى.', status=503, mimetype='text/plain')
+    if pdf is None:
+        return Response('غير موجود', status=404, mimetype='text/plain')
+    name = 'invoice' if kind == 'sale' else 'purchase'
+    return Response(pdf, mimetype='application/pdf',
+                    headers={'Content-Disposition': f'inline; filename="{name}_{doc_id}.pdf"'})
+
+def export_document_pdfs(store_id, kind, documents, store):
+    """(رقم المستند، PDF) بالترتيب لمستندات الفترة؛ ما ليس في الذاكرة المخزنة يُولَّد في مجمع PDF
+    بالتوازي مع بقاء EXPORT_WINDOW مستنداً على الأكثر قيد الانتظار"""
+    window = collections.deque()
+
+    def resolve(doc_id, html, digest, future):
+        if future is None:
+            pdf = cached_pdf(store_id, digest)
+            if pdf is not None:
+                metric_inc('lekhlef_pdf_cache_total', {'result': 'hit'})
+                return doc_id, pdf
+            metric_inc('lekhlef_pdf_cache_total', {'result': 'miss'})
+            future = submit_document_pdf(store_id, kind, doc_id, html)
+        return doc_id, future.result(timeout=PDF_TIMEOUT)
+
+    for doc, lines in documents:
+        html, digest = document_html(kind, doc, lines, store)
+        future = None
+        if not os.path.exists(_pdf_object_path(store_id, digest)):
+            metric_inc('lekhlef_pdf_cache_total', {'result': 'miss'})
+            future = submit_document_pdf(store_id, kind, doc['id'], html)
+        window.append((doc['id'], html, digest, future))
+        if len(window) >= EXPORT_WINDOW:
+            yield resolve(*window.popleft())
+    while window:
+        yield resolve(*window.popleft())
+
+class ZipStream:
+    """ملف للكتابة فقط يجمع ما يكتبه zipfile ليُرسل قطعة قطعة (بدون seek يكتب zipfile واصفات البيانات بعد كل ملف)"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def stream_documents_zip(store_id, kind, documents, store):
+    """أرشيف ZIP لملفات PDF يُبث أثناء توليدها"""
+    name = 'invoice' if kind == 'sale' else 'purchase'
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_STORED) as archive:
+        for doc_id, pdf in export_document_pdfs(store_id, kind, documents, store):
+            archive.writestr(f'{name}_{doc_id}.pdf', pdf)
+            yield stream.take()
+    yield stream.take()
+
+def stream_documents_print(kind, documents, store):
+    """صفحة HTML واحدة فيها كل مستندات الفترة، كل مستند في صفحة A4 للطباعة من المتصفح"""
+    head, tail = DOCUMENT_PAGE.split('%%DOCUMENT%%')
+    yield head
+    for doc, lines in documents:
+        yield render_document(kind, doc, lines, store)
+    yield tail
 
 # --------- Invoice view/print ---------
 @app.route('/invoice/<int:id>')
@@ -1502,117 +4076,20 @@ def pos():
 @store_required
 def invoice(id):
     db = get_db(); c = db.cursor()
-    c.execute('SELECT s.*, c.name as cust_name FROM sales s LEFT JOIN customers c ON c.id=s.customer_id WHERE s.id=?', (id,))
-    s = c.fetchone()
-    if not s: return 'غير موجود'
-    c.execute('SELECT si.*, it.name FROM sale_items si LEFT JOIN items it ON it.id=si.item_id WHERE si.sale_id=?', (id,))
-    lines = c.fetchall()
+    loaded = load_document(c, 'sale', id)
+    if not loaded: return 'غير موجود'
+    s, lines = loaded
+    store = get_current_store()
     
     page = '''
     <section class="wrapper style1 fade-up">
         <div class="inner">
-            <div class="invoice-container" id="invoice-content" style="width: 210mm; margin: 0 auto; background: white; padding: 10mm; box-sizing: border-box; font-family: 'Cairo', Arial, sans-serif;">
-                <!-- ترويسة الفاتورة -->
-                <div class="invoice-header text-center" style="border-bottom: 2px solid #000; padding-bottom: 8px; margin-bottom: 15px;">
-                    <h1 style="color: #000; margin: 0; font-size: 26px; font-weight: bold;">{{store['store_name']}}</h1>
-                    <h2 style="color: #000; margin: 3px 0 10px 0; font-size: 20px; font-weight: bold;">فاتورة بيع</h2>
-                    
-                    <div style="display: flex; justify-content: space-between; background: #f0f0f0; padding: 8px; border-radius: 4px; font-size: 14px; border: 1px solid #000;">
-                        <div style="font-weight: bold;"><strong>رقم الفاتورة:</strong> #{{s['id']}}</div>
-                        <div style="font-weight: bold;"><strong>التاريخ:</strong> {{s['date'][:16]}}</div>
-                    </div>
-                </div>
-
-                <!-- معلومات الزبون -->
-                <div style="margin-bottom: 15px; padding: 8px; background: #f8f8f8; border-radius: 4px; border: 1px solid #000;">
-                    <h4 style="margin: 0 0 6px 0; color: #000; font-size: 16px; font-weight: bold;">معلومات الزبون</h4>
-                    <p style="margin: 0; font-size: 14px; color: #000;"><strong>الاسم:</strong> {{s['cust_name'] or 'عميل عام'}}</p>
-                </div>
-
-                <!-- جدول المنتجات -->
-                <div style="margin: 15px 0;">
-                    <table style="width: 100%; border-collapse: collapse; font-size: 12px; border: 2px solid #000;">
-                        <thead style="background: #e0e0e0; color: #000;">
-                            <tr>
-                                <th style="padding: 8px 6px; text-align: right; width: 50%; border: 1px solid #000; font-weight: bold;">الصنف</th>
-                                <th style="padding: 8px 6px; text-align: center; width: 15%; border: 1px solid #000; font-weight: bold;">السعر</th>
-                                <th style="padding: 8px 6px; text-align: center; width: 15%; border: 1px solid #000; font-weight: bold;">الكمية</th>
-                                <th style="padding: 8px 6px; text-align: center; width: 20%; border: 1px solid #000; font-weight: bold;">المجموع</th>
-                            </tr>
-                        </thead>
-                        <tbody>
-                            {% for l in lines %}
-                            <tr>
-                                <td style="padding: 6px 6px; text-align: right; border: 1px solid #000; color: #000; font-weight: normal;">{{l['name']}}</td>
-                                <td style="padding: 6px 6px; text-align: center; border: 1px solid #000; color: #000; font-weight: normal;">{{ '%.2f' % l['price'] }} د.ج</td>
-                                <td style="padding: 6px 6px; text-align: center; border: 1px solid #000; color: #000; font-weight: normal;">{{l['qty']}}</td>
-                                <td style="padding: 6px 6px; text-align: center; border: 1px solid #000; color: #000; font-weight: normal;">{{ '%.2f' % (l['price'] * l['qty']) }} د.ج</td>
-                            </tr>
-                            {% endfor %}
-                            
-                            <!-- أسطر فارغة أقل -->
-                            {% for i in range(8 - lines|length) %}
-                            <tr>
-                                <td style="padding: 6px 6px; border: 1px solid #000; color: #000;">&nbsp;</td>
-                                <td style="padding: 6px 6px; border: 1px solid #000; color: #000;">&nbsp;</td>
-                                <td style="padding: 6px 6px; border: 1px solid #000; color: #000;">&nbsp;</td>
-                                <td style="padding: 6px 6px; border: 1px solid #000; color: #000;">&nbsp;</td>
-                            </tr>
-                            {% endfor %}
-                        </tbody>
-                    </table>
-                </div>
-
-                <!-- المجموع والتوقيع -->
-                <div style="display: flex; justify-content: space-between; margin-top: 20px; align-items: flex-start;">
-                    <!-- المجموع الكلي -->
-                    <div style="flex: 1; margin-left: 15px;">
-                        <div style="background: #f0f0f0; padding: 15px; border-radius: 4px; text-align: center; border: 2px solid #000;">
-                            <h4 style="margin: 0 0 10px 0; color: #000; font-size: 16px; font-weight: bold;">المجموع الكلي</h4>
-                            <div style="font-size: 22px; font-weight: bold; color: #000;">{{ '%.2f' % s['total'] }} د.ج</div>
-                        </div>
-                    </div>
-
-                    <!-- توقيع البائع فقط -->
-                    <div style="flex: 1; text-align: center;">
-                        <div style="border-top: 2px solid #000; width: 200px; margin: 0 auto; padding-top: 40px;">
-                            <p style="margin: 0; font-size: 14px; color: #000; font-weight: bold;">توقيع البائع</p>
-                        </div>
-                    </div>
-                </div>
-
-                <!-- ملاحظات وإشعارات -->
-                <div style="margin-top: 20px; padding: 12px; background: #f8f8f8; border: 1px solid #000; border-radius: 4px; font-size: 11px;">
-                    <h5 style="color: #000; margin: 0 0 8px 0; font-size: 14px; font-weight: bold; text-align: center;">شروط وإشعارات:</h5>
-                    <div style="display: flex; justify-content: space-between; gap: 15px;">
-                        <div style="flex: 1;">
-                            <p style="margin: 4px 0; color: #000; line-height: 1.4;">
-                                • المرتجعات خلال 7 أيام من تاريخ الشراء<br>
-                                • يرجى فحص المنتج قبل المغادرة<br>
-                                • لا يوجد استرداد نقدي
-                            </p>
-                        </div>
-                        <div style="flex: 1; text-align: right;">
-                            <p style="margin: 4px 0; color: #000; line-height: 1.4;">
-                                • للاستفسار: <strong style="font-size: 12px;">{{store['phone'] or '0676904111'}}</strong><br>
-                                • الاستبدال بشروط وأحكام<br>
-                                • الفاتورة واجبة الدفع فوراً<br>
-                                • ختم المكتبة ضروري
-                            </p>
-                        </div>
-                    </div>
-                </div>
-
-                <!-- تذييل الفاتورة -->
-                <div style="margin-top: 15px; text-align: center; padding-top: 10px; border-top: 1px solid #000; font-size: 11px; color: #000;">
-                    <p style="margin: 0; font-weight: bold;">{{store['store_name']}} - جميع المواد التعليمية والقرطاسية - هاتف: {{store['phone'] or '0676904111'}}</p>
-                    <p style="margin: 3px 0 0 0; font-size: 10px;">شكراً لثقتكم ونرحب بزيارتكم دائماً</p>
-                </div>
-            </div>
+            {{ document|safe }}
 
             <!-- أزرار التحكم -->
             <div class="text-center mt-3 actions" style="margin-top: 20px;">
                 <button class="button primary" onclick="printInvoice()">🖨️ طباعة الفاتورة</button>
+                {% if pdf_available %}<a class="button" href="/invoice/{{s['id']}}/pdf" target="_blank">📄 PDF</a>{% endif %}
                 <a class="button secondary" href="/pos">رجوع لنقطة البيع</a>
                 <a class="button" href="/invoices">عرض جميع الفواتير</a>
             </div>
@@ -1730,8 +4207,13 @@ def invoice(id):
         }
     </script>
     '''
-    store = get_current_store()
-    return render_template_string(base_html.replace('%%CONTENT%%', page), s=s, lines=lines, store=store)
+    return render_page(page, s=s, lines=lines, store=store, document=render_document('sale', s, lines, store))
+
+@app.route('/invoice/<int:id>/pdf')
+@login_required
+@store_required
+def invoice_pdf(id):
+    return document_pdf_response('sale', id)
 
 # --------- Invoices list ---------
 @app.route('/invoices')
@@ -1739,14 +4221,41 @@ def invoice(id):
 @store_required
 def invoices():
     db = get_db(); c = db.cursor()
-    c.execute('SELECT s.*, c.name as cust_name FROM sales s LEFT JOIN customers c ON c.id=s.customer_id ORDER BY date DESC')
+    archive_years = [row['year'] for row in cached_query('SELECT year FROM sales_archives ORDER BY year DESC')]
+    year = request.args.get('year', type=int)
+    if year in archive_years:
+        # سنة مؤرشفة: القراءة عبر sales_all (يحوّل مبالغ الأرشيفات القديمة إلى سنتيم)، والفواتير للعرض فقط
+        attach_sales_archives(db)
+        c.execute('''SELECT s.*, c.name as cust_name FROM sales_all s LEFT JOIN customers c ON c.id=s.customer_id
+                     WHERE s.date_ts >= ? AND s.date_ts < ? ORDER BY s.date_ts DESC, s.id DESC''',
+                  (date_ts(f'{year}-01-01'), date_ts(f'{year + 1}-01-01')))
+    else:
+        year = None
+        c.execute('''SELECT s.*, c.name as cust_name FROM sales s LEFT JOIN customers c ON c.id=s.customer_id
+                     ORDER BY s.date_ts DESC, s.id DESC''')
     rows = c.fetchall()
     page = '''
     <section class="wrapper style3 fade-up">
         <div class="inner">
             <div class="d-flex justify-content-between mb-2">
-                <h3>الفواتير السابقة</h3>
+                <h3>الفواتير السابقة{% if year %} ({{year}}){% endif %}</h3>
             </div>
+            {% if archive_years %}
+            <p>الأرشيف:
+                <a href="/invoices" class="button small{% if not year %} primary{% endif %}">الحالية</a>
+                {% for y in archive_years %}<a href="/invoices?year={{y}}" class="button small{% if y == year %} primary{% endif %}">{{y}}</a> {% endfor %}
+            </p>
+            {% endif %}
+            <form method="get" action="/invoices/export" class="form" target="_blank">
+                <div class="fields">
+                    <div class="field quarter"><label>من</label><input type="date" name="from" class="form-control" required></div>
+                    <div class="field quarter"><label>إلى</label><input type="date" name="to" class="form-control" required></div>
+                    <div class="field half"><label>&nbsp;</label>
+                        <button class="button small" name="format" value="print">🖨️ طباعة الفترة</button>
+                        {% if pdf_available %}<button class="button small primary" name="format" value="zip">📦 ZIP لملفات PDF</button>{% endif %}
+                    </div>
+                </div>
+            </form>
             <div class="table-wrapper">
                 <table class="alt">
                     <thead>
@@ -1764,11 +4273,13 @@ def invoices():
                             <td>{{r['id']}}</td>
                             <td>{{r['date']}}</td>
                             <td>{{r['cust_name'] or 'عام'}}</td>
-                            <td>{{r['total']}}</td>
+                            <td>{{r['total']|money}}</td>
                             <td>
                                 <a class="button small" href="/invoice/{{r['id']}}" target="_blank">عرض/طباعة</a>
+                                {% if not year %}
                                 <a class="button small primary" href="/invoices/edit/{{r['id']}}">تعديل</a>
                                 <a class="button small secondary" href="/invoices/delete/{{r['id']}}" onclick="return confirm('هل أنت متأكد من حذف هذه الفاتورة؟')">حذف</a>
+                                {% endif %}
                             </td>
                         </tr>
                         {% endfor %}
@@ -1778,7 +4289,34 @@ def invoices():
         </div>
     </section>
     '''
-    return render_template_string(base_html.replace('%%CONTENT%%', page), rows=rows)
+    return render_page(page, rows=rows, year=year, archive_years=archive_years)
+
+@app.route('/invoices/export')
+@login_required
+@store_required
+def invoices_export():
+    """كل فواتير فترة: ZIP لملفات PDF (format=zip) أو صفحة طباعة واحدة (format=print)"""
+    date_from = request.args.get('from', '')
+    date_to = request.args.get('to', '')
+    export_format = request.args.get('format', 'print')
+    if not date_from or not date_to:
+        flash('❌ حدد بداية ونهاية الفترة.')
+        return redirect(url_for('invoices'))
+    try:
+        day_range_ts(date_from, date_to)
+    except ValueError:
+        flash('❌ تاريخ غير صالح للفترة.')
+        return redirect(url_for('invoices'))
+    store_id, store = session['store_id'], get_current_store()
+    documents = iter_documents(get_db(), 'sale', date_from, date_to)
+    if export_format == 'zip':
+        if weasyprint is None:
+            flash('❌ تصدير PDF غير متاح: ثبّت weasyprint أو استخدم صفحة الطباعة.')
+            return redirect(url_for('invoices'))
+        return Response(stream_with_context(stream_documents_zip(store_id, 'sale', documents, store)),
+                        mimetype='application/zip',
+                        headers={'Content-Disposition': f'attachment; filename="invoices_{date_from}_{date_to}.zip"'})
+    return Response(stream_with_context(stream_documents_print('sale', documents, store)), mimetype='text/html')
 
 # --------- Edit Invoice ---------
 @app.route('/invoices/edit/<int:id>', methods=['GET', 'POST'])
@@ -1801,54 +4339,70 @@ def edit_invoice(id):
     if request.method == 'POST':
         # تحديث بيانات الفاتورة الأساسية
         customer_id = request.form.get('customer_id') or None
-        date = request.form.get('date')
-        
-        # جلب العناصر القديمة لتحديث المخزون
-        c.execute('SELECT item_id, qty FROM sale_items WHERE sale_id=?', (id,))
-        old_items = c.fetchall()
-        
-        # إرجاع الكميات القديمة للمخزون
-        for old_item in old_items:
-            c.execute('UPDATE items SET qty = qty + ? WHERE id = ?', (old_item['qty'], old_item['item_id']))
-        
-        # تحديث الفاتورة
-        c.execute('UPDATE sales SET customer_id=?, date=? WHERE id=?', (customer_id, date, id))
-        
-        # حذف العناصر القديمة
-        c.execute('DELETE FROM sale_items WHERE sale_id=?', (id,))
+        try:
+            date, timestamp = parse_form_date(request.form.get('date'))
+        except ValueError:
+            flash('❌ تاريخ الفاتورة غير صالح.')
+            return redirect(url_for('edit_invoice', id=id))
         
-        # إضافة العناصر الجديدة
+        # قراءة الأسطر الجديدة قبل بدء المعاملة
         item_ids = request.form.getlist('item_id')
         qtys = request.form.getlist('qty')
         prices = request.form.getlist('price')
-        
+        new_lines = [(int(i), int(q), parse_money(p)) for i, q, p in zip(item_ids, qtys, prices) if i and q and p]
+        failures = invalid_line_failures(c, new_lines)
+        if failures:
+            for message in stock_failure_messages(failures):
+                flash(message)
+            return redirect(url_for('edit_invoice', id=id))
         total = 0
-        for i, q, p in zip(item_ids, qtys, prices):
-            if i and q and p:  # التأكد من وجود القيم
-                item_id = int(i)
-                qty = int(q)
-                price = float(p)
-                total += qty * price
-                
-                # إضافة العنصر
-                c.execute('INSERT INTO sale_items (sale_id, item_id, qty, price) VALUES (?, ?, ?, ?)', 
-                         (id, item_id, qty, price))
-                
-                # خصم الكمية الجديدة من المخزون
-                c.execute('UPDATE items SET qty = qty - ? WHERE id = ?', (qty, item_id))
+        for item_id, qty, price in new_lines:
+            total += qty * price
         
-        # تحديث المجموع الكلي
-        c.execute('UPDATE sales SET total=? WHERE id=?', (total, id))
+        # تطبيق الفرق فقط (إضافة/تعديل/حذف الأسطر وصافي تغير المخزون) في عملية كتابة واحدة عبر كاتب المحل
+        def apply_edit(c):
+            # الأسطر والمجموع الحاليان يُقرآن داخل المعاملة: تعديل متزامن قبلها لا يُفسد الفروقات
+            row = c.execute('SELECT total FROM sales WHERE id=?', (id,)).fetchone()
+            if row is None:
+                return False
+            old_total = row[0]
+            c.execute('SELECT id, item_id, qty, price FROM sale_items WHERE sale_id=? ORDER BY id', (id,))
+            inserts, updates, deletes, stock_deltas = diff_sale_lines(c.fetchall(), new_lines)
+            
+            # خصم الزيادات بشرط توفرها وإرجاع النقصان إلى المخزون
+            failures = deduct_stock(c, [(item_id, delta) for item_id, delta in stock_deltas.items() if delta > 0])
+            if failures:
+                raise WriteRejected(stock_failure_messages(failures))
+            restore_stock(c, [(item_id, -delta) for item_id, delta in stock_deltas.items() if delta < 0])
+            
+            c.executemany('DELETE FROM sale_items WHERE id=?', [(line_id,) for line_id in deletes])
+            c.executemany('UPDATE sale_items SET qty=?, price=? WHERE id=?',
+                          [(qty, price, line_id) for line_id, qty, price in updates])
+            c.executemany('INSERT INTO sale_items (sale_id, item_id, qty, price) VALUES (?, ?, ?, ?)',
+                          [(id, item_id, qty, price) for item_id, qty, price in inserts])
+            c.execute('UPDATE sales SET customer_id=?, date=?, date_ts=?, total=? WHERE id=?',
+                      (customer_id, date, timestamp, total, id))
+            publish_event(c, 'invoice_edit', {'sales_total': total - old_total, 'profit': total - old_total,
+                                              'stock_value': -stock_cost(c, stock_deltas.items())},
+                          sale_id=id, stock={item_id: -delta for item_id, delta in stock_deltas.items() if delta})
+            return True
         
-        db.commit()
+        try:
+            edited = run_store_write(apply_edit)
+        except WriteRejected as e:
+            for message in e.messages:
+                flash(message)
+            return redirect(url_for('edit_invoice', id=id))
+        if not edited:  # حُذفت أثناء التعديل
+            flash('❌ الفاتورة غير موجودة.')
+            return redirect(url_for('invoices'))
+        invalidate_document(session['store_id'], 'sale', id)
         flash('✅ تم تعديل الفاتورة بنجاح.')
         return redirect(url_for('invoice', id=id))
     
     # جلب البيانات المطلوبة للنموذج
-    c.execute('SELECT * FROM customers ORDER BY name')
-    customers = c.fetchall()
-    c.execute('SELECT * FROM items ORDER BY name')
-    items = c.fetchall()
+    customers = cached_query('SELECT * FROM customers ORDER BY name')
+    items = cached_query('SELECT * FROM items ORDER BY name')
     
     page = '''
     <section class="wrapper style1 fade-up">
@@ -1869,7 +4423,7 @@ def edit_invoice(id):
                     <div class="field half">
                         <label for="date">التاريخ</label>
                         <input type="datetime-local" name="date" id="date" class="form-control" 
-                               value="{{invoice['date'][:16]}}" required>
+                               value="{{invoice['date'][:16].replace(' ', 'T')}}" required>
                     </div>
                 </div>
                 
@@ -1898,7 +4452,7 @@ def edit_invoice(id):
                                     <select name="item_id" class="form-select item-select" required>
                                         <option value="">-- اختر صنف --</option>
                                         {% for it in items %}
-                                        <option value="{{it['id']}}" data-price="{{it['sell_price']}}" 
+                                        <option value="{{it['id']}}" data-price="{{it['sell_price']|money}}" 
                                                 {% if it['id'] == item['item_id'] %}selected{% endif %}>
                                             {{it['name']}} ({{it['code']}})
                                         </option>
@@ -1907,13 +4461,13 @@ def edit_invoice(id):
                                 </td>
                                 <td>
                                     <input type="number" step="0.01" name="price" class="form-control price-input" 
-                                           value="{{item['price']}}" required>
+                                           value="{{item['price']|money}}" required>
                                 </td>
                                 <td>
                                     <input type="number" name="qty" class="form-control qty-input" 
                                            value="{{item['qty']}}" min="1" required>
                                 </td>
-                                <td class="line-total">{{item['price'] * item['qty']}}</td>
+                                <td class="line-total">{{(item['price'] * item['qty'])|money}}</td>
                                 <td>
                                     <button type="button" class="button small secondary remove-item">حذف</button>
                                 </td>
@@ -1928,7 +4482,7 @@ def edit_invoice(id):
                         <button type="button" class="button primary" id="add-item">إضافة صنف</button>
                     </div>
                     <div class="field">
-                        <h4>المجموع الكلي: <span id="total-amount">{{invoice['total']}}</span> د.ج</h4>
+                        <h4>المجموع الكلي: <span id="total-amount">{{invoice['total']|money}}</span> د.ج</h4>
                     </div>
                 </div>
                 
@@ -1973,7 +4527,7 @@ def edit_invoice(id):
                     <select name="item_id" class="form-select item-select" required>
                         <option value="">-- اختر صنف --</option>
                         {% for it in items %}
-                        <option value="{{it['id']}}" data-price="{{it['sell_price']}}">
+                        <option value="{{it['id']}}" data-price="{{it['sell_price']|money}}">
                             {{it['name']}} ({{it['code']}})
                         </option>
                         {% endfor %}
@@ -2040,7 +4594,7 @@ def edit_invoice(id):
     </script>
     '''
     
-    return render_template_string(base_html.replace('%%CONTENT%%', page), 
+    return render_page(page, 
                                 invoice=invoice, invoice_items=invoice_items, 
                                 customers=customers, items=items)
 
@@ -2049,23 +4603,32 @@ def edit_invoice(id):
 @login_required
 @store_required
 def delete_invoice(id):
-    db = get_db(); c = db.cursor()
-    
-    # جلب عناصر الفاتورة لإرجاع الكميات للمخزون
-    c.execute('SELECT item_id, qty FROM sale_items WHERE sale_id=?', (id,))
-    items = c.fetchall()
-    
-    # إرجاع الكميات للمخزون
-    for item in items:
-        c.execute('UPDATE items SET qty = qty + ? WHERE id = ?', (item['qty'], item['item_id']))
-    
-    # حذف عناصر الفاتورة
-    c.execute('DELETE FROM sale_items WHERE sale_id=?', (id,))
-    
-    # حذف الفاتورة
-    c.execute('DELETE FROM sales WHERE id=?', (id,))
+    def remove_invoice(c):
+        # جلب عناصر الفاتورة لإرجاع الكميات للمخزون
+        c.execute('SELECT item_id, qty FROM sale_items WHERE sale_id=?', (id,))
+        items = c.fetchall()
+        
+        # إرجاع الكميات للمخزون
+        restore_stock(c, [(item['item_id'], item['qty']) for item in items])
+        
+        # حذف عناصر الفاتورة
+        c.execute('DELETE FROM sale_items WHERE sale_id=?', (id,))
+        
+        # حذف الفاتورة
+        c.execute('SELECT total FROM sales WHERE id=?', (id,))
+        sale = c.fetchone()
+        c.execute('DELETE FROM sales WHERE id=?', (id,))
+        if sale:
+            lines = [(item['item_id'], item['qty']) for item in items]
+            stock = {}
+            for item_id, qty in lines:
+                stock[item_id] = stock.get(item_id, 0) + qty
+            publish_event(c, 'invoice_delete', {'sales_count': -1, 'sales_total': -(sale['total'] or 0), 'profit': -(sale['total'] or 0),
+                                                'stock_value': stock_cost(c, lines)},
+                          sale_id=id, stock=stock)
     
-    db.commit()
+    run_store_write(remove_invoice)
+    invalidate_document(session['store_id'], 'sale', id)
     flash('✅ تم حذف الفاتورة بنجاح وإرجاع الكميات للمخزون.')
     return redirect(url_for('invoices'))
 
@@ -2074,9 +4637,9 @@ def delete_invoice(id):
 @login_required
 @store_required
 def items():
-    db = get_db(); c = db.cursor(); c.execute('SELECT * FROM items ORDER BY name'); rows = c.fetchall()
-    page = '''<section class="wrapper style1 fade-up"><div class="inner"><div class="d-flex justify-content-between mb-2"><h3>المخزون</h3><a class="button primary" href="/items/add">أضف صنف</a></div><div class="table-wrapper"><table class="alt"><thead><tr><th>كود</th><th>اسم</th><th>سعر شراء</th><th>سعر بيع</th><th>كمية</th><th>اجراء</th></tr></thead><tbody>{% for r in rows %}<tr><td>{{r['code']}}</td><td>{{r['name']}}</td><td>{{r['buy_price']}}</td><td>{{r['sell_price']}}</td><td>{{r['qty']}}</td><td><a class="button small" href="/items/edit/{{r['id']}}">تعديل</a> <a class="button small secondary" href="/items/delete/{{r['id']}}" onclick="return confirm('هل أنت متأكد من حذف هذا الصنف؟')">حذف</a></td></tr>{% endfor %}</tbody></table></div></div></section>'''
-    return render_template_string(base_html.replace('%%CONTENT%%', page), rows=rows)
+    rows = cached_query('SELECT * FROM items ORDER BY name')
+    page = '''<section class="wrapper style1 fade-up"><div class="inner"><div class="d-flex justify-content-between mb-2"><h3>المخزون</h3><a class="button primary" href="/items/add">أضف صنف</a></div><div class="table-wrapper"><table class="alt"><thead><tr><th>كود</th><th>اسم</th><th>سعر شراء</th><th>سعر بيع</th><th>كمية</th><th>اجراء</th></tr></thead><tbody>{% for r in rows %}<tr><td>{{r['code']}}</td><td>{{r['name']}}</td><td>{{r['buy_price']|money}}</td><td>{{r['sell_price']|money}}</td><td>{{r['qty']}}</td><td><a class="button small" href="/items/edit/{{r['id']}}">تعديل</a> <a class="button small secondary" href="/items/delete/{{r['id']}}" onclick="return confirm('هل أنت متأكد من حذف هذا الصنف؟')">حذف</a></td></tr>{% endfor %}</tbody></table></div></div></section>'''
+    return render_page(page, rows=rows)
 
 @app.route('/items/add', methods=['GET','POST'])
 @login_required
@@ -2084,13 +4647,16 @@ def items():
 def items_add():
     if request.method=='POST':
         code = request.form.get('code'); name = request.form.get('name')
-        buy = float(request.form.get('buy_price') or 0); sell = float(request.form.get('sell_price') or 0);
+        buy = parse_money(request.form.get('buy_price')); sell = parse_money(request.form.get('sell_price'));
         qty = int(request.form.get('qty') or 0)
         db = get_db(); c = db.cursor()
         try:
             c.execute('INSERT INTO items (code,name,buy_price,sell_price,qty) VALUES (?,?,?,?,?)', (code,name,buy,sell,qty))
+            record_stock_adjustment(c, c.lastrowid, qty, 'opening')
             db.commit()
+            invalidate_item_index(session['store_id'])
         except Exception as e:
+            db.rollback()
             if 'UNIQUE constraint failed' in str(e):
                 flash(f'❌ خطأ: الكود "{code}" موجود مسبقاً.')
             else:
@@ -2132,7 +4698,7 @@ def items_add():
         </form>
     </div></section>
     '''
-    return render_template_string(base_html.replace('%%CONTENT%%', page))
+    return render_page(page)
 
 @app.route('/items/edit/<int:id>', methods=['GET','POST'])
 @login_required
@@ -2142,9 +4708,14 @@ def items_edit(id):
     if not r: return 'غير موجود'
     if request.method=='POST':
         code = request.form.get('code'); name = request.form.get('name')
-        buy = float(request.form.get('buy_price') or 0); sell = float(request.form.get('sell_price') or 0); qty = int(request.form.get('qty') or 0)
+        buy = parse_money(request.form.get('buy_price')); sell = parse_money(request.form.get('sell_price')); qty = int(request.form.get('qty') or 0)
+        def save_item(c):
+            c.execute('SELECT qty FROM items WHERE id=?', (id,)); old_qty = c.fetchone()['qty'] or 0
+            c.execute('UPDATE items SET code=?,name=?,buy_price=?,sell_price=?,qty=? WHERE id=?', (code,name,buy,sell,qty,id))
+            record_stock_adjustment(c, id, qty - old_qty, 'manual')
         try:
-            c.execute('UPDATE items SET code=?,name=?,buy_price=?,sell_price=?,qty=? WHERE id=?', (code,name,buy,sell,qty,id)); db.commit();
+            run_store_write(save_item)
+            invalidate_item_index(session['store_id'])
         except Exception as e:
             if 'UNIQUE constraint failed' in str(e):
                 flash(f'❌ خطأ: الكود "{code}" موجود مسبقاً لصنف آخر.')
@@ -2169,11 +4740,11 @@ def items_edit(id):
                 </div>
                 <div class="field half">
                     <label for="buy_price">سعر الشراء</label>
-                    <input type="number" step="0.01" name="buy_price" id="buy_price" class="form-control" value="{r['buy_price']}">
+                    <input type="number" step="0.01" name="buy_price" id="buy_price" class="form-control" value="{format_money(r['buy_price'])}">
                 </div>
                 <div class="field half">
                     <label for="sell_price">سعر البيع</label>
-                    <input type="number" step="0.01" name="sell_price" id="sell_price" class="form-control" value="{r['sell_price']}">
+                    <input type="number" step="0.01" name="sell_price" id="sell_price" class="form-control" value="{format_money(r['sell_price'])}">
                 </div>
                 <div class="field">
                     <label for="qty">الكمية المتوفرة</label>
@@ -2187,12 +4758,13 @@ def items_edit(id):
         </form>
     </div></section>
     """
-    return render_template_string(base_html.replace('%%CONTENT%%', page))
+    return render_page(page)
 
 # --------- Delete Item ---------
 @app.route('/items/delete/<int:id>')
 @login_required
 @store_required
+@store_writes
 def delete_item(id):
     db = get_db(); c = db.cursor()
     
@@ -2212,6 +4784,7 @@ def delete_item(id):
     # حذف الصنف حتى لو كان مستخدم في فواتير أو مشتريات
     c.execute('DELETE FROM items WHERE id=?', (id,))
     db.commit()
+    invalidate_item_index(session['store_id'])
     
     if sales_count > 0 or purchases_count > 0:
         flash(f'✅ تم حذف الصنف "{item["name"]}" بنجاح. (كان مستخدم في {sales_count + purchases_count} عملية بيع أو شراء)')
@@ -2228,7 +4801,9 @@ def customers():
     if request.method=='POST':
         name = request.form.get('name'); phone = request.form.get('phone')
         c.execute('INSERT INTO customers (name,phone) VALUES (?,?)', (name,phone)); db.commit(); flash('✅ تم إضافة الزبون.'); return redirect(url_for('customers'))
-    c.execute('SELECT * FROM customers ORDER BY name'); rows = c.fetchall()
+    rows = cached_query('''SELECT t.*, COALESCE(b.balance, 0) AS balance FROM customers t
+                           LEFT JOIN entity_balances b ON b.entity_type = 'customer' AND b.entity_id = t.id
+                           ORDER BY t.name''')
     page = '''
     <section class="wrapper style1 fade-up"><div class="inner">
     <h3>إدارة الزبائن</h3>
@@ -2242,13 +4817,14 @@ def customers():
     <hr/>
     <div class="table-wrapper">
     <table class="alt">
-        <thead><tr><th>الاسم</th><th>الهاتف</th><th>إجراء</th></tr></thead>
+        <thead><tr><th>الاسم</th><th>الهاتف</th><th>الرصيد</th><th>إجراء</th></tr></thead>
         <tbody>
         {% for r in rows %}
         <tr>
             <td>{{r['name']}}</td>
             <td>{{r['phone']}}</td>
-            <td><a class="button small" href="#">تعديل</a></td>
+            <td>{{ r['balance']|money }}</td>
+            <td><a class="button small" href="#">تعديل</a> <a class="button small" href="{{ url_for('statement', entity_type='customer', entity_id=r['id']) }}">كشف حساب</a></td>
         </tr>
         {% endfor %}
         </tbody>
@@ -2256,7 +4832,7 @@ def customers():
     </div>
     </div></section>
     '''
-    return render_template_string(base_html.replace('%%CONTENT%%', page), rows=rows)
+    return render_page(page, rows=rows)
 
 @app.route('/suppliers', methods=['GET','POST'])
 @login_required
@@ -2266,7 +4842,9 @@ def suppliers():
     if request.method=='POST':
         name = request.form.get('name'); phone = request.form.get('phone')
         c.execute('INSERT INTO suppliers (name,phone) VALUES (?,?)', (name,phone)); db.commit(); flash('✅ تم إضافة المورد.'); return redirect(url_for('suppliers'))
-    c.execute('SELECT * FROM suppliers ORDER BY name'); rows = c.fetchall()
+    rows = cached_query('''SELECT t.*, COALESCE(b.balance, 0) AS balance FROM suppliers t
+                           LEFT JOIN entity_balances b ON b.entity_type = 'supplier' AND b.entity_id = t.id
+                           ORDER BY t.name''')
     page = '''
     <section class="wrapper style1 fade-up"><div class="inner">
     <h3>إدارة الموردين</h3>
@@ -2280,13 +4858,14 @@ def suppliers():
     <hr/>
     <div class="table-wrapper">
     <table class="alt">
-        <thead><tr><th>الاسم</th><th>الهاتف</th><th>إجراء</th></tr></thead>
+        <thead><tr><th>الاسم</th><th>الهاتف</th><th>الرصيد</th><th>إجراء</th></tr></thead>
         <tbody>
         {% for r in rows %}
         <tr>
             <td>{{r['name']}}</td>
             <td>{{r['phone']}}</td>
-            <td><a class="button small" href="#">تعديل</a></td>
+            <td>{{ r['balance']|money }}</td>
+            <td><a class="button small" href="#">تعديل</a> <a class="button small" href="{{ url_for('statement', entity_type='supplier', entity_id=r['id']) }}">كشف حساب</a></td>
         </tr>
         {% endfor %}
         </tbody>
@@ -2294,29 +4873,42 @@ def suppliers():
     </div>
     </div></section>
     '''
-    return render_template_string(base_html.replace('%%CONTENT%%', page), rows=rows)
+    return render_page(page, rows=rows)
 
 # --------- Purchases ---------
 @app.route('/purchases', methods=['GET','POST'])
 @login_required
 @store_required
 def purchases():
-    db = get_db(); c = db.cursor()
     if request.method=='POST':
         supplier_id = request.form.get('supplier_id') or None
         item_ids = request.form.getlist('item_id')
         qtys = request.form.getlist('qty')
         prices = request.form.getlist('price')
-        total = 0
-        for i,q,p in zip(item_ids,qtys,prices): total += int(q)*float(p)
-        date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        c.execute('INSERT INTO purchases (supplier_id,date,total) VALUES (?,?,?)', (supplier_id,date,total))
-        pid = c.lastrowid
-        for i,q,p in zip(item_ids,qtys,prices):
-            c.execute('INSERT INTO purchase_items (purchase_id,item_id,qty,price) VALUES (?,?,?,?)', (pid,int(i),int(q),float(p)))
-            c.execute('UPDATE items SET qty = qty + ? WHERE id = ?', (int(q), int(i)))
-        db.commit(); flash('✅ تم تسجيل سند التوريد.'); return redirect(url_for('purchases'))
-    c.execute('SELECT * FROM items ORDER BY name'); items = c.fetchall(); c.execute('SELECT * FROM suppliers ORDER BY name'); suppliers = c.fetchall()
+        lines = [(int(i), int(q), parse_money(p)) for i, q, p in zip(item_ids, qtys, prices)]
+        total = sum(qty * price for _item_id, qty, price in lines)
+        now = datetime.now()
+        date = now.strftime('%Y-%m-%d %H:%M:%S')
+        
+        def record_purchase(c):
+            c.execute('INSERT INTO purchases (supplier_id,date,date_ts,total) VALUES (?,?,?,?)',
+                      (supplier_id, date, date_ts(now), total))
+            pid = c.lastrowid
+            for item_id, qty, price in lines:
+                c.execute('INSERT INTO purchase_items (purchase_id,item_id,qty,price) VALUES (?,?,?,?)', (pid, item_id, qty, price))
+                c.execute('UPDATE items SET qty = qty + ? WHERE id = ?', (qty, item_id))
+            stock = {}
+            for item_id, qty, _price in lines:
+                stock[item_id] = stock.get(item_id, 0) + qty
+            publish_event(c, 'purchase', {'purchases_total': total, 'profit': -total,
+                                          'stock_value': stock_cost(c, [(item_id, qty) for item_id, qty, _price in lines])},
+                          purchase_id=pid, stock=stock)
+            return pid
+        
+        purchase_id = run_store_write(record_purchase)
+        prerender_document(session['store_id'], 'purchase', purchase_id)
+        flash('✅ تم تسجيل سند التوريد.'); return redirect(url_for('purchases'))
+    items = cached_query('SELECT * FROM items ORDER BY name'); suppliers = cached_query('SELECT * FROM suppliers ORDER BY name')
     
     # تم تعديل HTML صفحة التوريد لتكون أكثر تناسقاً
     page = '''
@@ -2355,7 +4947,7 @@ def purchases():
                 <tr>
                     <td><input type='checkbox' id='chk-{{it["id"]}}' onchange='toggleRow(this,{{it["id"]}})'></td>
                     <td>{{it['name']}}</td>
-                    <td><input name='price' value='{{it["buy_price"]}}' class='form-control price-{{it["id"]}}' disabled></td>
+                    <td><input name='price' value='{{it["buy_price"]|money}}' class='form-control price-{{it["id"]}}' disabled></td>
                     <td><input name='qty' value='1' class='form-control qty-{{it["id"]}}' disabled></td>
                     <input type='hidden' name='item_id' value='{{it["id"]}}'>
                 </tr>
@@ -2409,7 +5001,13 @@ def purchases():
     });
     </script>
     '''
-    return render_template_string(base_html.replace('%%CONTENT%%', page), items=items, suppliers=suppliers)
+    return render_page(page, items=items, suppliers=suppliers)
+
+@app.route('/purchases/<int:id>/pdf')
+@login_required
+@store_required
+def purchase_pdf(id):
+    return document_pdf_response('purchase', id)
 
 
 # --------- Debts Management (NEW) ---------
@@ -2425,20 +5023,28 @@ def debts():
         if 'action' in request.form and request.form['action'] == 'add_debt':
             entity_type = request.form.get('entity_type')
             entity_id = request.form.get('entity_id')
-            amount = float(request.form.get('amount') or 0)
+            amount = parse_money(request.form.get('amount'))
             notes = request.form.get('notes')
-            date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            now = datetime.now()
+            date = now.strftime('%Y-%m-%d %H:%M:%S')
 
             if amount <= 0 or not entity_id or not entity_type:
                 flash('❌ خطأ: يجب تحديد الطرف وقيمة الدين موجبة.')
                 return redirect(url_for('debts'))
 
             try:
-                c.execute('INSERT INTO debts (entity_type, entity_id, original_amount, date_created, notes) VALUES (?, ?, ?, ?, ?)',
-                          (entity_type, entity_id, amount, date, notes))
+                c.execute('''INSERT INTO debts (entity_type, entity_id, original_amount, remaining_amount, date_created, created_ts,
+                                                notes, aging_bucket)
+                             VALUES (?, ?, ?, ?, ?, ?, ?, 0)''', (entity_type, entity_id, amount, amount, date, date_ts(now), notes))
+                debt_id = c.lastrowid
+                adjust_debt_aging(c, entity_type, int(entity_id), 0, amount, 1)
+                post_ledger_entry(c, entity_type, int(entity_id), 'charge', amount, date, debt_id=debt_id, note=notes)
+                publish_event(c, 'debt_add', debt_deltas(entity_type, amount), debt_id=debt_id)
                 db.commit()
+                store_events.notify(session['store_id'])
                 flash(f'✅ تم تسجيل دين جديد بنجاح.')
             except Exception as e:
+                db.rollback()
                 flash(f"❌ خطأ في قاعدة البيانات: {e}")
             return redirect(url_for('debts'))
 
@@ -2450,7 +5056,7 @@ def debts():
         FROM debts d 
         LEFT JOIN customers c ON c.id = d.entity_id 
         WHERE d.entity_type = 'customer' AND d.status = 'open' 
-        ORDER BY d.date_created DESC
+        ORDER BY d.created_ts DESC
     ''')
     customer_debts = c.fetchall()
 
@@ -2460,19 +5066,38 @@ def debts():
         FROM debts d 
         LEFT JOIN suppliers s ON s.id = d.entity_id 
         WHERE d.entity_type = 'supplier' AND d.status = 'open' 
-        ORDER BY d.date_created DESC
+        ORDER BY d.created_ts DESC
     ''')
     supplier_debts = c.fetchall()
     
     # 3. Fetch entities for the "Add Debt" form
-    c.execute('SELECT id, name FROM customers ORDER BY name')
-    customers = c.fetchall()
-    c.execute('SELECT id, name FROM suppliers ORDER BY name')
-    suppliers = c.fetchall()
+    customers = cached_query('SELECT id, name FROM customers ORDER BY name')
+    suppliers = cached_query('SELECT id, name FROM suppliers ORDER BY name')
 
     page = '''
     <section class="wrapper style1 fade-up"><div class="inner">
         <h3>💰 إدارة الديون</h3>
+        <ul class="actions"><li><a href="/debts/aging" class="button small">⏳ تقرير أعمار الديون</a></li></ul>
+
+        <h4>تسديد جماعي (توزيع مبلغ على أقدم الديون)</h4>
+        <form method="post" action="{{ url_for('pay_debts_bulk') }}" class="form">
+            <div class="fields">
+                <div class="field half">
+                    <select name="entity" class="form-select" required>
+                        <option value="">-- اختر الطرف --</option>
+                        <optgroup label="الزبائن">{% for c in customers %}<option value="customer:{{ c['id'] }}">{{ c['name'] }}</option>{% endfor %}</optgroup>
+                        <optgroup label="الموردون">{% for s in suppliers %}<option value="supplier:{{ s['id'] }}">{{ s['name'] }}</option>{% endfor %}</optgroup>
+                    </select>
+                </div>
+                <div class="field quarter">
+                    <input type="number" step="0.01" name="amount" class="form-control" placeholder="المبلغ المدفوع" required min="0.01">
+                </div>
+                <div class="field quarter">
+                    <button type="submit" class="button primary small">💵 توزيع التسديد</button>
+                </div>
+            </div>
+        </form>
+        <hr />
 
         <h4 style="margin-top: 2em;">إضافة دين جديد (دين يدوي/سلفة)</h4>
         <form method="post" class="form">
@@ -2518,9 +5143,9 @@ def debts():
                     <tr>
                         <td>{{ d['id'] }}</td>
                         <td>{{ d['name'] }}</td>
-                        <td>{{ '%.2f' % d['original_amount'] }}</td>
-                        <td>{{ '%.2f' % d['paid_amount'] }}</td>
-                        <td><strong>{{ '%.2f' % remaining }}</strong></td>
+                        <td>{{ d['original_amount']|money }}</td>
+                        <td>{{ d['paid_amount']|money }}</td>
+                        <td><strong>{{ remaining|money }}</strong></td>
                         <td>{{ d['date_created'].split(' ')[0] }}</td>
                         <td>{{ d['notes'] or '' }}</td>
                         <td>
@@ -2532,7 +5157,7 @@ def debts():
                             <form method="post" action="{{ url_for('pay_debt', id=d['id']) }}" style="margin: 0;">
                                 <div class="fields" style="padding-top: 0.5em;">
                                     <div class="field quarter">
-                                        <input type="number" step="0.01" name="payment_amount" class="form-control" placeholder="قيمة التسديد (بحد أقصى {{ '%.2f' % remaining }})" required max="{{ '%.2f' % remaining }}" min="0.01">
+                                        <input type="number" step="0.01" name="payment_amount" class="form-control" placeholder="قيمة التسديد (بحد أقصى {{ remaining|money }})" required max="{{ remaining|money }}" min="0.01">
                                     </div>
                                     <div class="field quarter">
                                         <button type="submit" class="button small primary">إتمام التسديد</button>
@@ -2562,9 +5187,9 @@ def debts():
                     <tr>
                         <td>{{ d['id'] }}</td>
                         <td>{{ d['name'] }}</td>
-                        <td>{{ '%.2f' % d['original_amount'] }}</td>
-                        <td>{{ '%.2f' % d['paid_amount'] }}</td>
-                        <td><strong>{{ '%.2f' % remaining }}</strong></td>
+                        <td>{{ d['original_amount']|money }}</td>
+                        <td>{{ d['paid_amount']|money }}</td>
+                        <td><strong>{{ remaining|money }}</strong></td>
                         <td>{{ d['date_created'].split(' ')[0] }}</td>
                         <td>{{ d['notes'] or '' }}</td>
                         <td>
@@ -2576,7 +5201,7 @@ def debts():
                             <form method="post" action="{{ url_for('pay_debt', id=d['id']) }}" style="margin: 0;">
                                 <div class="fields" style="padding-top: 0.5em;">
                                     <div class="field quarter">
-                                        <input type="number" step="0.01" name="payment_amount" class="form-control" placeholder="قيمة التسديد (بحد أقصى {{ '%.2f' % remaining }})" required max="{{ '%.2f' % remaining }}" min="0.01">
+                                        <input type="number" step="0.01" name="payment_amount" class="form-control" placeholder="قيمة التسديد (بحد أقصى {{ remaining|money }})" required max="{{ remaining|money }}" min="0.01">
                                     </div>
                                     <div class="field quarter">
                                         <button type="submit" class="button small primary">إتمام التسديد</button>
@@ -2627,7 +5252,7 @@ def debts():
     });
     </script>
     '''
-    return render_template_string(base_html.replace('%%CONTENT%%', page), 
+    return render_page(page, 
                                   customer_debts=customer_debts, 
                                   supplier_debts=supplier_debts,
                                   customers=customers,
@@ -2637,71 +5262,240 @@ def debts():
 @login_required
 @store_required
 def pay_debt(id):
-    db = get_db(); c = db.cursor()
-    payment_amount = float(request.form.get('payment_amount') or 0)
+    payment_amount = parse_money(request.form.get('payment_amount'))
     
     if payment_amount <= 0:
         flash('❌ خطأ: يجب أن تكون قيمة التسديد موجبة.')
         return redirect(url_for('debts'))
 
-    c.execute('SELECT original_amount, paid_amount FROM debts WHERE id = ?', (id,))
-    debt = c.fetchone()
+    def record_payment(c):
+        payment = apply_debt_payment(c, id, payment_amount, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        publish_event(c, 'debt_payment', debt_deltas(payment['entity_type'], -payment_amount), debt_id=id, amount=payment_amount)
+        return payment
 
-    if not debt:
-        flash('❌ خطأ: الدين غير موجود.')
+    try:
+        payment = run_store_write(record_payment)
+    except WriteRejected as e:
+        for message in e.messages:
+            flash(message)
         return redirect(url_for('debts'))
 
-    remaining = debt['original_amount'] - debt['paid_amount']
+    if payment['status'] == 'paid':
+        flash(f'✅ تم تسديد الدين رقم {id} بالكامل ({format_money(payment_amount)} د.ج).')
+    else:
+        flash(f'✅ تم تسجيل تسديد جزئي للدين رقم {id} بقيمة {format_money(payment_amount)} د.ج. المتبقي: {format_money(payment["remaining"])} د.ج.')
+        
+    return redirect(url_for('debts'))
+
+@app.route('/debts/pay_bulk', methods=['POST'])
+@login_required
+@store_required
+def pay_debts_bulk():
+    """توزيع مبلغ واحد على ديون طرف مفتوحة (الأقدم أولاً أو حسب debt_ids بالترتيب) في معاملة واحدة.
+    يقبل JSON {entity_type, entity_id, amount, debt_ids?} ويرجع التوزيع، أو نموذجاً عادياً مع رسالة."""
+    data = request.get_json(silent=True) if request.is_json else None
+    wants_json = data is not None
+    data = data or request.form.to_dict(flat=True)
+    if 'entity' in data:  # قيمة قائمة الاختيار في صفحة الديون: customer:12
+        data['entity_type'], _, data['entity_id'] = data['entity'].partition(':')
+    debt_ids = data.get('debt_ids') if wants_json else request.form.getlist('debt_ids')
+    try:
+        entity_type = data.get('entity_type')
+        entity_id = int(data.get('entity_id'))
+        amount = parse_money(data.get('amount'))
+        debt_ids = [int(debt_id) for debt_id in debt_ids or []]
+    except (TypeError, ValueError):
+        entity_type = None
     
-    if payment_amount > remaining:
-        flash(f'❌ خطأ: لا يمكن تسديد مبلغ أكبر من المتبقي. المبلغ المتبقي هو: {remaining:.2f} د.ج')
+    def reject(messages, status_code=400):
+        if wants_json:
+            return {'ok': False, 'errors': messages}, status_code
+        for message in messages:
+            flash(message)
         return redirect(url_for('debts'))
+    
+    if entity_type not in ('customer', 'supplier') or amount <= 0:
+        return reject(['❌ خطأ: يجب تحديد الطرف وقيمة تسديد موجبة.'])
+    
+    def record_bulk_payment(c):
+        allocations = allocate_debt_payment(c, entity_type, entity_id, amount, debt_ids,
+                                            datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        publish_event(c, 'debt_payment', debt_deltas(entity_type, -amount),
+                      debt_ids=[allocation['debt_id'] for allocation in allocations], amount=amount)
+        return allocations, entity_balance(c, entity_type, entity_id)
+    
+    try:
+        allocations, balance = run_store_write(record_bulk_payment)
+    except WriteRejected as e:
+        return reject(e.messages, 409)
+    
+    if wants_json:
+        return {'ok': True, 'amount': format_money(amount), 'balance': format_money(balance),
+                'allocations': [dict(allocation, paid=format_money(allocation['paid']), remaining=format_money(allocation['remaining']))
+                                for allocation in allocations]}
+    settled = sum(1 for allocation in allocations if allocation['status'] == 'paid')
+    flash(f'✅ تم توزيع {format_money(amount)} د.ج على {len(allocations)} دين (منها {settled} مسددة بالكامل). الرصيد المتبقي: {format_money(balance)} د.ج.')
+    return redirect(url_for('debts'))
 
-    new_paid = debt['paid_amount'] + payment_amount
-    status = 'paid' if new_paid >= debt['original_amount'] else 'open'
-
-    c.execute('UPDATE debts SET paid_amount = ?, status = ? WHERE id = ?', (new_paid, status, id))
-    db.commit()
+# --------- Debt aging report ---------
+@app.route('/debts/aging')
+@login_required
+@store_required
+def debts_aging():
+    """تقرير أعمار الديون لكل زبون ومورد من المجاميع المحسوبة مسبقاً"""
+    ensure_debt_aging_current(session['store_id'])
+    db = get_db(); c = db.cursor()
+    c.execute('''SELECT a.entity_type, a.entity_id, COALESCE(cu.name, su.name) AS name,
+                        SUM(CASE WHEN a.bucket = 0 THEN a.amount ELSE 0 END) AS b0,
+                        SUM(CASE WHEN a.bucket = 1 THEN a.amount ELSE 0 END) AS b1,
+                        SUM(CASE WHEN a.bucket = 2 THEN a.amount ELSE 0 END) AS b2,
+                        SUM(CASE WHEN a.bucket = 3 THEN a.amount ELSE 0 END) AS b3,
+                        SUM(a.amount) AS total, SUM(a.debt_count) AS debt_count
+                 FROM debt_aging a
+                 LEFT JOIN customers cu ON a.entity_type = 'customer' AND cu.id = a.entity_id
+                 LEFT JOIN suppliers su ON a.entity_type = 'supplier' AND su.id = a.entity_id
+                 GROUP BY a.entity_type, a.entity_id
+                 HAVING SUM(a.amount) > 0
+                 ORDER BY b3 DESC, b2 DESC, total DESC''')
+    rows = c.fetchall()
+    sections = {'customer': [r for r in rows if r['entity_type'] == 'customer'],
+                'supplier': [r for r in rows if r['entity_type'] == 'supplier']}
+    totals = {kind: [sum(r[f'b{i}'] for r in section) for i in range(len(AGING_BUCKETS))] + [sum(r['total'] for r in section)]
+              for kind, section in sections.items()}
+    
+    if request.args.get('format') == 'json':
+        money_keys = [f'b{i}' for i in range(len(AGING_BUCKETS))] + ['total']
+        return {kind: [dict(dict(r), **{key: format_money(r[key]) for key in money_keys}) for r in section]
+                for kind, section in sections.items()}
+    
+    page = '''
+    <section class="wrapper style1 fade-up"><div class="inner">
+    <h3>⏳ أعمار الديون</h3>
+    <ul class="actions"><li><a href="/debts" class="button small secondary">رجوع إلى الديون</a></li></ul>
+    {% for kind, title in [('customer', 'ديون لنا (الزبائن)'), ('supplier', 'ديون علينا (الموردون)')] %}
+    <h4>{{ title }}</h4>
+    <div class="table-wrapper">
+    <table class="alt">
+        <thead><tr><th>الطرف</th>{% for label in buckets %}<th>{{ label }} يوم</th>{% endfor %}<th>المجموع</th><th>عدد الديون</th></tr></thead>
+        <tbody>
+        {% for r in sections[kind] %}
+        <tr>
+            <td><a href="{{ url_for('statement', entity_type=kind, entity_id=r['entity_id']) }}">{{ r['name'] or ('#' ~ r['entity_id']) }}</a></td>
+            <td>{{ r['b0']|money }}</td><td>{{ r['b1']|money }}</td><td>{{ r['b2']|money }}</td><td><strong>{{ r['b3']|money }}</strong></td>
+            <td><strong>{{ r['total']|money }}</strong></td><td>{{ r['debt_count'] }}</td>
+        </tr>
+        {% endfor %}
+        {% if sections[kind] %}
+        <tr><td><strong>المجموع</strong></td>{% for value in totals[kind] %}<td><strong>{{ value|money }}</strong></td>{% endfor %}<td></td></tr>
+        {% else %}
+        <tr><td colspan="7">لا توجد ديون مفتوحة.</td></tr>
+        {% endif %}
+        </tbody>
+    </table>
+    </div>
+    {% endfor %}
+    </div></section>
+    '''
+    return render_page(page, sections=sections, totals=totals, buckets=AGING_BUCKETS)
 
-    if status == 'paid':
-        flash(f'✅ تم تسديد الدين رقم {id} بالكامل ({payment_amount:.2f} د.ج).')
-    else:
-        flash(f'✅ تم تسجيل تسديد جزئي للدين رقم {id} بقيمة {payment_amount:.2f} د.ج. المتبقي: {(debt['original_amount'] - new_paid):.2f} د.ج.')
-        
-    return redirect(url_for('debts'))
+# --------- Statement (كشف حساب) ---------
+@app.route('/statement/<entity_type>/<int:entity_id>')
+@login_required
+@store_required
+def statement(entity_type, entity_id):
+    """كشف حساب زبون أو مورد لفترة: الرصيد الافتتاحي، القيود بأرصدتها الجارية، والرصيد الختامي"""
+    if entity_type not in ('customer', 'supplier'):
+        flash('❌ نوع الطرف غير صالح.')
+        return redirect(url_for('debts'))
+    db = get_db(); c = db.cursor()
+    c.execute(f"SELECT name FROM {'customers' if entity_type == 'customer' else 'suppliers'} WHERE id = ?", (entity_id,))
+    entity = c.fetchone()
+    if not entity:
+        flash('❌ الطرف غير موجود.')
+        return redirect(url_for('debts'))
+    
+    date_from = request.args.get('from') or '0000-00-00'
+    date_to = request.args.get('to') or '9999-12-31'
+    # الرصيد الافتتاحي هو الرصيد الجاري لآخر قيد قبل بداية الفترة
+    c.execute('''SELECT balance FROM ledger_entries WHERE entity_type = ? AND entity_id = ? AND entry_date < ?
+                 ORDER BY entry_date DESC, id DESC LIMIT 1''', (entity_type, entity_id, date_from))
+    row = c.fetchone()
+    opening = row['balance'] if row else 0
+    c.execute('''SELECT entry_date, kind, amount, balance, debt_id, note FROM ledger_entries
+                 WHERE entity_type = ? AND entity_id = ? AND entry_date >= ? AND entry_date < ?
+                 ORDER BY entry_date, id''', (entity_type, entity_id, date_from, date_to + '~'))
+    entries = c.fetchall()
+    closing = entries[-1]['balance'] if entries else opening
+    
+    if request.args.get('format') == 'json':
+        return {'entity_type': entity_type, 'entity_id': entity_id, 'name': entity['name'],
+                'from': request.args.get('from'), 'to': request.args.get('to'),
+                'opening_balance': format_money(opening), 'closing_balance': format_money(closing),
+                'entries': [dict(dict(e), amount=format_money(e['amount']), balance=format_money(e['balance'])) for e in entries]}
+    
+    page = '''
+    <section class="wrapper style1 fade-up"><div class="inner">
+    <h3>📄 كشف حساب: {{name}}</h3>
+    <form method="get" class="form">
+        <div class="fields">
+            <div class="field quarter"><label>من</label><input type="date" name="from" value="{{request.args.get('from', '')}}" class="form-control"></div>
+            <div class="field quarter"><label>إلى</label><input type="date" name="to" value="{{request.args.get('to', '')}}" class="form-control"></div>
+            <div class="field quarter"><label>&nbsp;</label><button class="button primary small">عرض</button></div>
+        </div>
+    </form>
+    <p>الرصيد الافتتاحي: <strong>{{ opening|money }} د.ج</strong></p>
+    <div class="table-wrapper">
+    <table class="alt">
+        <thead><tr><th>التاريخ</th><th>البيان</th><th>مدين</th><th>دائن</th><th>الرصيد</th><th>ملاحظات</th></tr></thead>
+        <tbody>
+        {% for e in entries %}
+        <tr>
+            <td>{{ e['entry_date'] }}</td>
+            <td>{{ 'دين' if e['kind'] == 'charge' else 'تسديد' }}{% if e['debt_id'] %} #{{ e['debt_id'] }}{% endif %}</td>
+            <td>{{ e['amount']|money if e['amount'] > 0 else '' }}</td>
+            <td>{{ (-e['amount'])|money if e['amount'] < 0 else '' }}</td>
+            <td>{{ e['balance']|money }}</td>
+            <td>{{ e['note'] or '' }}</td>
+        </tr>
+        {% endfor %}
+        {% if not entries %}<tr><td colspan="6">لا توجد حركات في هذه الفترة.</td></tr>{% endif %}
+        </tbody>
+    </table>
+    </div>
+    <p>الرصيد الختامي: <strong>{{ closing|money }} د.ج</strong></p>
+    </div></section>
+    '''
+    return render_page(page, name=entity['name'], opening=opening, closing=closing, entries=entries)
 
 # --------- Stats ---------
 @app.route('/stats')
 @login_required
 @store_required
 def stats():
-    db = get_store_db(); c = db.cursor()
-    c.execute("SELECT COALESCE(SUM(total),0) as ssum FROM sales"); ssum = c.fetchone()['ssum']
-    c.execute("SELECT COALESCE(SUM(total),0) as psum FROM purchases"); psum = c.fetchone()['psum']
-    c.execute('SELECT COALESCE(SUM(qty*buy_price),0) as stock_value FROM items'); stock_value = c.fetchone()['stock_value']
+    ssum = cached_query("SELECT COALESCE(SUM(total),0) as ssum FROM sales")[0]['ssum'] + archived_sales_totals()[1]
+    psum = cached_query("SELECT COALESCE(SUM(total),0) as psum FROM purchases")[0]['psum']
+    stock_value = cached_query('SELECT COALESCE(SUM(qty*buy_price),0) as stock_value FROM items')[0]['stock_value']
     
     # Calculate Net Debts (Receivables - Payables)
-    c.execute("SELECT COALESCE(SUM(original_amount - paid_amount), 0) FROM debts WHERE entity_type = 'customer' AND status = 'open'")
-    receivables = c.fetchone()[0]
-    c.execute("SELECT COALESCE(SUM(original_amount - paid_amount), 0) FROM debts WHERE entity_type = 'supplier' AND status = 'open'")
-    payables = c.fetchone()[0]
+    receivables = cached_query("SELECT COALESCE(SUM(original_amount - paid_amount), 0) FROM debts WHERE entity_type = 'customer' AND status = 'open'")[0][0]
+    payables = cached_query("SELECT COALESCE(SUM(original_amount - paid_amount), 0) FROM debts WHERE entity_type = 'supplier' AND status = 'open'")[0][0]
     net_debts = receivables - payables # Positive means money is owed to you
 
     page = f'''
     <section class="wrapper style3 fade-up"><div class="inner">
     <h3>الإحصائيات والتقارير</h3>
     <ul class="actions">
-        <li class="button primary fit">مجموع المبيعات: {ssum} د.ج</li>
-        <li class="button secondary fit">مجموع المشتريات: {psum} د.ج</li>
-        <li class="button fit">الربح التقريبي (مبيعات - مشتريات): {ssum - psum} د.ج</li>
-        <li class="button fit">قيمة المخزون (سعر الشراء * الكمية): {stock_value} د.ج</li>
-        <li class="button fit" style="background-color: #6c757d;">صافي الديون (لك - عليك): {net_debts:.2f} د.ج</li>
+        <li class="button primary fit">مجموع المبيعات: <span data-live="sales_total" data-value="{ssum}" data-money="1">{format_money(ssum)}</span> د.ج</li>
+        <li class="button secondary fit">مجموع المشتريات: <span data-live="purchases_total" data-value="{psum}" data-money="1">{format_money(psum)}</span> د.ج</li>
+        <li class="button fit">الربح التقريبي (مبيعات - مشتريات): <span data-live="profit" data-value="{ssum - psum}" data-money="1">{format_money(ssum - psum)}</span> د.ج</li>
+        <li class="button fit">قيمة المخزون (سعر الشراء * الكمية): <span data-live="stock_value" data-value="{stock_value}" data-money="1">{format_money(stock_value)}</span> د.ج</li>
+        <li class="button fit" style="background-color: #6c757d;">صافي الديون (لك - عليك): <span data-live="net_debts" data-value="{net_debts}" data-money="1">{format_money(net_debts)}</span> د.ج</li>
     </ul>
     <p style="text-align: center; margin-top: 1em;">
-        (ديون لك: {receivables:.2f} د.ج) - (ديون عليك: {payables:.2f} د.ج)
+        (ديون لك: <span data-live="receivables" data-value="{receivables}" data-money="1">{format_money(receivables)}</span> د.ج) - (ديون عليك: <span data-live="payables" data-value="{payables}" data-money="1">{format_money(payables)}</span> د.ج)
     </p>
-    </div></section>'''
-    return render_template_string(base_html.replace('%%CONTENT%%', page))
+    </div></section>''' + live_dashboard_script()
+    return render_page(page)
 
 # --------- Admin Routes ---------
 @app.route('/admin/users')
@@ -2747,6 +5541,10 @@ def admin_users():
         stores_count = user['stores_count'] if user['stores_count'] else 0
         last_login = user['last_login'] if user['last_login'] else 'لم يسجل دخول'
         created_at = user['created_at'][:10] if user['created_at'] else 'غير محدد'
+        if user['username'] != 'admin':
+            delete_link = '<a href="/admin/users/delete/' + str(user['id']) + '" class="button small" style="background-color: #ff6b6b;" onclick="return confirm(\'هل أنت متأكد من حذف هذا المستخدم؟\')">🗑️ حذف</a>'
+        else:
+            delete_link = '<span style="color: #999;">لا يمكن حذف المدير</span>'
         
         page += f'''
                         <tr>
@@ -2763,7 +5561,7 @@ def admin_users():
                             <td>{last_login}</td>
                             <td>
                                 <a href="/admin/users/edit/{user['id']}" class="button small primary">✏️ تعديل</a>
-                                {'<a href="/admin/users/delete/' + str(user['id']) + '" class="button small" style="background-color: #ff6b6b;" onclick="return confirm(\'هل أنت متأكد من حذف هذا المستخدم؟\')">🗑️ حذف</a>' if user['username'] != 'admin' else '<span style="color: #999;">لا يمكن حذف المدير</span>'}
+                                {delete_link}
                             </td>
                         </tr>
         '''
@@ -2781,7 +5579,7 @@ def admin_users():
     </section>
     '''
     
-    return render_template_string(base_html.replace('%%CONTENT%%', page))
+    return render_page(page)
 
 @app.route('/admin/users/add', methods=['GET', 'POST'])
 @admin_required
@@ -2863,7 +5661,7 @@ def admin_add_user():
     </section>
     '''
     
-    return render_template_string(base_html.replace('%%CONTENT%%', page))
+    return render_page(page)
 
 @app.route('/admin/users/edit/<int:user_id>', methods=['GET', 'POST'])
 @admin_required
@@ -2959,7 +5757,81 @@ def admin_edit_user(user_id):
     </section>
     '''
     
-    return render_template_string(base_html.replace('%%CONTENT%%', page))
+    return render_page(page)
+
+@app.route('/admin/profiling')
+@admin_required
+def admin_profiling():
+    """أبطأ الاستعلامات والمسارات المجمعة في هذه العملية (يتطلب LEKHLEF_PROFILE=1)"""
+    with _profile_lock:
+        statements = [dict(stat, sql=sql, avg_ms=stat['total_ms'] / stat['count']) for sql, stat in _profile_statements.items()]
+        routes = [dict(stat, endpoint=endpoint, avg_ms=stat['total_ms'] / stat['count']) for endpoint, stat in _profile_routes.items()]
+    statements.sort(key=lambda stat: stat['total_ms'], reverse=True)
+    routes.sort(key=lambda stat: stat['total_ms'], reverse=True)
+    if request.args.get('format') == 'json':
+        return {'pid': os.getpid(), 'enabled': PROFILE_ENABLED, 'statements': statements[:100], 'routes': routes,
+                'query_cache': query_cache.snapshot(), 'maintenance': recent_maintenance_runs()}
+    
+    page = '''
+    <section class="wrapper style1 fade-up">
+        <div class="inner">
+            <h2>⏱️ قياس الأداء</h2>
+            {% if not enabled %}
+            <p>القياس غير مفعل. شغّل التطبيق مع <code>LEKHLEF_PROFILE=1</code>.</p>
+            {% endif %}
+            <p>إحصاءات العملية رقم {{pid}} منذ تشغيلها (<a href="/admin/profiling?format=json">JSON</a>)</p>
+            <p>ذاكرة الاستعلامات: {{cache['hits']}} إصابة، {{cache['misses']}} إخفاق، {{cache['evictions']}} حذف،
+               {{cache['entries']}} نتيجة ({{'%.1f' % (cache['bytes'] / 1048576)}} / {{'%.0f' % (cache['max_bytes'] / 1048576)}} MB)</p>
+            
+            <h3>الصيانة</h3>
+            <p>{% if maintenance['enabled'] %}ساعات الهدوء: {{maintenance['quiet_hours'] or 'كل اليوم'}}،
+               المصروف في الساعة الأخيرة {{'%.1f' % (maintenance['spent_bytes'] / 1048576)}} / {{'%.0f' % (maintenance['budget_bytes'] / 1048576)}} MB
+               {% else %}الصيانة معطلة (<code>LEKHLEF_MAINTENANCE=0</code>).{% endif %}</p>
+            {% if maintenance['runs'] %}
+            <div class="table-wrapper">
+                <table class="alt">
+                    <thead><tr><th>الوقت</th><th>المحل</th><th>العمل</th><th>المدة (ms)</th><th>IO (MB)</th><th>النتيجة</th></tr></thead>
+                    <tbody>
+                    {% for run in maintenance['runs'] %}
+                    <tr><td>{{run['started']}}</td><td>{{run['store_id']}}</td><td>{{run['job']}}</td>
+                        <td>{{'%.1f' % (run['seconds'] * 1000)}}</td><td>{{'%.2f' % (run['io_bytes'] / 1048576)}}</td><td>{{run['result']}}</td></tr>
+                    {% endfor %}
+                    </tbody>
+                </table>
+            </div>
+            {% endif %}
+            
+            <h3>المسارات</h3>
+            <div class="table-wrapper">
+                <table class="alt">
+                    <thead><tr><th>المسار</th><th>الطلبات</th><th>المتوسط (ms)</th><th>الأقصى (ms)</th><th>الاستعلامات (ms)</th><th>القوالب (ms)</th></tr></thead>
+                    <tbody>
+                    {% for r in routes %}
+                    <tr><td>{{r['endpoint']}}</td><td>{{r['count']}}</td><td>{{'%.2f' % r['avg_ms']}}</td><td>{{'%.2f' % r['max_ms']}}</td>
+                        <td>{{'%.2f' % (r['sql_ms'] / r['count'])}}</td><td>{{'%.2f' % (r['template_ms'] / r['count'])}}</td></tr>
+                    {% endfor %}
+                    </tbody>
+                </table>
+            </div>
+            
+            <h3>أبطأ الاستعلامات (حسب الزمن الكلي)</h3>
+            <div class="table-wrapper">
+                <table class="alt">
+                    <thead><tr><th>الاستعلام</th><th>المرات</th><th>المتوسط (ms)</th><th>الأقصى (ms)</th><th>الصفوف</th><th>خطة التنفيذ</th></tr></thead>
+                    <tbody>
+                    {% for st in statements[:50] %}
+                    <tr><td dir="ltr" style="text-align: left;"><code>{{st['sql']}}</code></td><td>{{st['count']}}</td>
+                        <td>{{'%.2f' % st['avg_ms']}}</td><td>{{'%.2f' % st['max_ms']}}</td><td>{{st['rows']}}</td>
+                        <td dir="ltr" style="text-align: left; white-space: pre;">{{st['plan']}}</td></tr>
+                    {% endfor %}
+                    </tbody>
+                </table>
+            </div>
+        </div>
+    </section>
+    '''
+    return render_page(page, statements=statements, routes=routes, enabled=PROFILE_ENABLED, pid=os.getpid(),
+                       cache=query_cache.snapshot(), maintenance=recent_maintenance_runs())
 
 @app.route('/admin/users/delete/<int:user_id>')
 @admin_required
@@ -2995,13 +5867,13 @@ def admin_delete_user(user_id):
     return redirect(url_for('admin_users'))
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()  # عمليات مجمع PDF داخل نسخة exe
     print('Lekhlef Library - Starting Application')
     print('=' * 50)
     
     # فتح المتصفح تلقائياً
     import threading
     import webbrowser
-    import time
     
     def open_browser():
         time.sleep(2)
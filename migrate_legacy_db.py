@@ -0,0 +1,238 @@
+"""نقل قاعدة النسخة القديمة (maktaba_lekhlef.db، محل واحد) إلى النظام متعدد المحلات
+
+- المستخدمون يُضافون إلى main_system.db (من له نفس اسم المستخدم يُربط بالحساب الموجود دون تغيير كلمة مروره)
+- بيانات المحل تُنقل إلى stores_data/store_<id>.db بنفس أرقام الصفوف، على دفعات، كل دفعة في معاملة
+  مع تقدمها في جدول legacy_import داخل قاعدة المحل: عند انقطاع النقل يكفي تشغيل نفس الأمر ليكمل
+- مبالغ النسخة القديمة (REAL بالدينار) تُحوَّل إلى سنتيم صحيح أثناء القراءة
+- القراءة بالمفتاح الأساسي دفعة دفعة فلا يتجاوز استهلاك الذاكرة حجم دفعة واحدة مهما كان حجم الملف
+- بعد النسخ يُقارَن عدد الصفوف وبصمة SHA-256 لكل جدول بين القاعدتين، ثم يُعاد بناء دفتر القيود وأعمار الديون
+
+مثال:
+    python migrate_legacy_db.py maktaba_lekhlef.db
+    python migrate_legacy_db.py old.db --store-name "مكتبة النور" --owner admin --chunk 20000
+"""
+import argparse
+import hashlib
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+# بترتيب النقل (الجداول المرجعية أولاً)
+LEGACY_TABLES = ('items', 'customers', 'suppliers', 'sales', 'sale_items', 'purchases', 'purchase_items', 'debts')
+
+
+def table_columns(db, table):
+    return [row[1] for row in db.execute(f'PRAGMA table_info({table})')]
+
+
+def common_columns(legacy, target, table):
+    """أعمدة الجدول الموجودة في القاعدتين (بترتيب القاعدة القديمة)"""
+    target_columns = set(table_columns(target, table))
+    return [column for column in table_columns(legacy, table) if column in target_columns]
+
+
+def source_columns(lekhleftest, table, columns):
+    """تعابير القراءة من القاعدة القديمة: أعمدة المبالغ محوّلة إلى سنتيم بنفس أسماء الأعمدة"""
+    money = lekhleftest.STORE_MONEY_COLUMNS.get(table, ())
+    return [f'{lekhleftest.centimes_sql(column)} AS {column}' if column in money else column for column in columns]
+
+
+def import_users(legacy, main_db):
+    """إضافة مستخدمي النسخة القديمة إلى القاعدة الرئيسية؛ تُرجع {id قديم: (id جديد، الدور)}"""
+    if 'users' not in {row[0] for row in legacy.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}:
+        return {}
+    columns = [c for c in common_columns(legacy, main_db, 'users') if c != 'id']
+    mapping = {}
+    main_db.execute('BEGIN IMMEDIATE')
+    try:
+        for row in legacy.execute(f'SELECT id, {", ".join(columns)} FROM users ORDER BY id'):
+            values = dict(zip(columns, row[1:]))
+            existing = main_db.execute('SELECT id FROM users WHERE username = ?', (values['username'],)).fetchone()
+            if existing is None and main_db.execute('SELECT 1 FROM users WHERE email = ?', (values['email'],)).fetchone():
+                print(f'  skipped user {values["username"]}: email {values["email"]} belongs to another account')
+                continue
+            if existing is None:
+                free_id = not main_db.execute('SELECT 1 FROM users WHERE id = ?', (row[0],)).fetchone()
+                insert_columns = (['id'] if free_id else []) + columns
+                insert_values = ([row[0]] if free_id else []) + [values[c] for c in columns]
+                cursor = main_db.execute(f'INSERT INTO users ({", ".join(insert_columns)}) VALUES ({", ".join("?" * len(insert_columns))})',
+                                         insert_values)
+                existing = (cursor.lastrowid,)
+            mapping[row[0]] = (existing[0], values.get('role'))
+        main_db.commit()
+    except Exception:
+        main_db.rollback()
+        raise
+    return mapping
+
+
+def resolve_store(main_db, store_id, store_name, owner_username, users):
+    """المحل الهدف: المحدد بـ --store-id، أو محل المالك بنفس الاسم، أو محل جديد؛ مع صلاحيات المستخدمين القدامى"""
+    owner = main_db.execute('SELECT id FROM users WHERE username = ?', (owner_username,)).fetchone()
+    if owner is None:
+        raise SystemExit(f'Unknown owner "{owner_username}"')
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    main_db.execute('BEGIN IMMEDIATE')
+    try:
+        if store_id is not None:
+            if not main_db.execute('SELECT 1 FROM stores WHERE id = ?', (store_id,)).fetchone():
+                raise SystemExit(f'Store {store_id} does not exist')
+        else:
+            row = main_db.execute('SELECT id FROM stores WHERE store_name = ? AND owner_id = ?', (store_name, owner[0])).fetchone()
+            if row is None:
+                row = (main_db.execute('INSERT INTO stores (store_name, owner_id, store_type, created_at) VALUES (?, ?, ?, ?)',
+                                       (store_name, owner[0], 'library', now)).lastrowid,)
+            store_id = row[0]
+        grants = [(owner[0], 'owner')] + [(user_id, 'owner' if role == 'admin' else 'manager') for user_id, role in users.values()]
+        main_db.executemany('''INSERT OR IGNORE INTO store_permissions (user_id, store_id, permission_level, granted_at)
+                               VALUES (?, ?, ?, ?)''', [(user_id, store_id, level, now) for user_id, level in grants])
+        main_db.commit()
+    except BaseException:
+        main_db.rollback()
+        raise
+    return store_id
+
+
+def prepare_target(target):
+    """جدول التقدم؛ يرفض قاعدة محل فيها بيانات لم تأتِ من نقل سابق"""
+    target.execute('''CREATE TABLE IF NOT EXISTS legacy_import (
+                        table_name TEXT PRIMARY KEY,
+                        last_id INTEGER NOT NULL DEFAULT 0,
+                        rows INTEGER NOT NULL DEFAULT 0,
+                        checksum TEXT,
+                        finished_at TEXT
+                    )''')
+    target.commit()
+    started = {row[0] for row in target.execute('SELECT table_name FROM legacy_import')}
+    for table in LEGACY_TABLES:
+        if table not in started and target.execute(f'SELECT 1 FROM {table} LIMIT 1').fetchone():
+            raise SystemExit(f'Target store already has rows in {table}; choose an empty store')
+
+
+def copy_table(lekhleftest, legacy, target, table, chunk):
+    """نسخ جدول دفعة دفعة بالمفتاح الأساسي مع حفظ التقدم في نفس معاملة كل دفعة"""
+    columns = common_columns(legacy, target, table)
+    if 'id' not in columns:  # الجدول غير موجود في النسخة القديمة
+        return 0
+    row = target.execute('SELECT last_id, rows, finished_at FROM legacy_import WHERE table_name = ?', (table,)).fetchone()
+    last_id, copied, finished = row if row else (0, 0, None)
+    if finished:
+        return copied
+    select = f'SELECT {", ".join(source_columns(lekhleftest, table, columns))} FROM {table} WHERE id > ? ORDER BY id LIMIT ?'
+    insert = f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})'
+    id_index = columns.index('id')
+    while True:
+        rows = legacy.execute(select, (last_id, chunk)).fetchall()
+        target.execute('BEGIN IMMEDIATE')
+        try:
+            if rows:
+                target.executemany(insert, rows)
+                last_id, copied = rows[-1][id_index], copied + len(rows)
+            target.execute('''INSERT INTO legacy_import (table_name, last_id, rows, finished_at) VALUES (?, ?, ?, ?)
+                              ON CONFLICT(table_name) DO UPDATE SET last_id = excluded.last_id, rows = excluded.rows,
+                                                                    finished_at = excluded.finished_at''',
+                           (table, last_id, copied, None if len(rows) == chunk else datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+            target.commit()
+        except BaseException:
+            target.rollback()
+            raise
+        print(f'\r  {table:<15}{copied:>12}', end='', flush=True)
+        if len(rows) < chunk:
+            print()
+            return copied
+
+
+def table_checksum(db, table, columns):
+    """(عدد الصفوف، SHA-256) لأعمدة الجدول بترتيب المفتاح الأساسي، بقراءة متتابعة"""
+    digest, count = hashlib.sha256(), 0
+    for row in db.execute(f'SELECT {", ".join(columns)} FROM {table} ORDER BY id'):
+        digest.update(repr(row).encode('utf-8'))
+        count += 1
+    return count, digest.hexdigest()
+
+
+def verify(lekhleftest, legacy, target):
+    """مقارنة العدد والبصمة لكل جدول؛ تُرجع قائمة الجداول المختلفة"""
+    mismatches = []
+    for table in LEGACY_TABLES:
+        columns = common_columns(legacy, target, table)
+        if 'id' not in columns:
+            continue
+        source = table_checksum(legacy, table, source_columns(lekhleftest, table, columns))
+        copied = table_checksum(target, table, columns)
+        status = 'ok' if source == copied else 'MISMATCH'
+        print(f'  {table:<15}{source[0]:>12}{copied[0]:>12}  {copied[1][:16]}  {status}')
+        if source != copied:
+            mismatches.append(table)
+        target.execute('UPDATE legacy_import SET checksum = ? WHERE table_name = ?', (copied[1], table))
+    target.commit()
+    return mismatches
+
+
+def finalize(target, lekhleftest):
+    """حالة الديون والرصيد الافتتاحي للمخزون والتواريخ بالثواني ودفتر القيود وأعمار الديون من الجداول المنقولة (مرة واحدة)"""
+    if target.execute("SELECT 1 FROM legacy_import WHERE table_name = '_finalize'").fetchone():
+        return
+    target.execute('BEGIN IMMEDIATE')
+    try:
+        c = target.cursor()
+        c.execute('''UPDATE debts SET notes = COALESCE(notes, note), remaining_amount = original_amount - paid_amount,
+                     status = CASE WHEN paid_amount >= original_amount THEN 'paid' ELSE 'open' END''')
+        lekhleftest.baseline_stock_adjustments(c)
+        lekhleftest.backfill_date_timestamps(c)
+        lekhleftest.rebuild_ledger(c)
+        lekhleftest.rebuild_debt_aging(c, datetime.now().date())
+        c.execute("INSERT INTO legacy_import (table_name, finished_at) VALUES ('_finalize', ?)",
+                  (datetime.now().strftime('%Y-%m-%d %H:%M:%S'),))
+        target.commit()
+    except BaseException:
+        target.rollback()
+        raise
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Move a single-store maktaba_lekhlef.db into the multi-store layout')
+    parser.add_argument('legacy_db', nargs='?', default=os.path.join(APP_DIR, 'maktaba_lekhlef.db'))
+    parser.add_argument('--store-id', type=int, default=None, help='import into this existing (empty) store')
+    parser.add_argument('--store-name', default='مكتبة لخلف', help='store to create or resume (default: مكتبة لخلف)')
+    parser.add_argument('--owner', default='admin', help='username of the store owner')
+    parser.add_argument('--chunk', type=int, default=10000, help='rows per transaction')
+    args = parser.parse_args()
+
+    sys.path.insert(0, APP_DIR)
+    import lekhleftest  # ينشئ القاعدة الرئيسية إن لم تكن موجودة
+    legacy = sqlite3.connect(f'file:{os.path.abspath(args.legacy_db)}?mode=ro', uri=True)
+    main_db = sqlite3.connect(lekhleftest.MAIN_DB_PATH, timeout=30)
+    started = time.perf_counter()
+
+    users = import_users(legacy, main_db)
+    print(f'{len(users)} users linked in {lekhleftest.MAIN_DB_PATH}')
+    store_id = resolve_store(main_db, args.store_id, args.store_name, args.owner, users)
+    main_db.close()
+
+    lekhleftest.ensure_stores_directory()
+    path = lekhleftest.get_store_db_path(store_id)
+    lekhleftest.initialize_store_database(path)
+    target = sqlite3.connect(path, timeout=30, isolation_level=None)
+    target.execute('PRAGMA synchronous = NORMAL')
+    prepare_target(target)
+    print(f'Copying into store {store_id}: {path}')
+    for table in LEGACY_TABLES:
+        copy_table(lekhleftest, legacy, target, table, args.chunk)
+
+    if not target.execute("SELECT 1 FROM legacy_import WHERE table_name = '_finalize'").fetchone():
+        print(f'  {"table":<15}{"legacy":>12}{"store":>12}  checksum')
+        mismatches = verify(lekhleftest, legacy, target)
+        if mismatches:
+            raise SystemExit(f'Verification failed for: {", ".join(mismatches)}')
+        finalize(target, lekhleftest)
+    target.close()
+    legacy.close()
+    print(f'Done in {time.perf_counter() - started:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""إنشاء محلات كثيرة دفعة واحدة من ملف CSV (فتح فروع جديدة)
+
+كل سطر محل: store_name,owner,store_type,address,phone,email,description,permissions
+- owner: اسم مستخدم المالك (موجود مسبقاً في main_system.db)
+- permissions (اختياري): مستخدمون آخرون بصيغة "user1:manager;user2:viewer"
+
+تُضاف كل المحلات وصلاحياتها في معاملة واحدة على القاعدة الرئيسية: أي خطأ في أي سطر يلغي الكل.
+بعد الحفظ تُنسخ قاعدة كل محل من القاعدة النموذجية (reflink إن أمكن).
+
+مثال:
+    python provision_stores.py branches.csv
+    python provision_stores.py branches.csv --dry-run
+"""
+import argparse
+import csv
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+PERMISSION_LEVELS = ('viewer', 'editor', 'manager', 'owner')
+
+
+def read_rows(path):
+    """سطور CSV كقواميس بعد حذف المسافات الزائدة"""
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        return [{key: (value or '').strip() for key, value in row.items()} for row in csv.DictReader(f)]
+
+
+def parse_permissions(text):
+    """"user1:manager;user2:viewer" -> [(user1, manager), (user2, viewer)]"""
+    permissions = []
+    for part in filter(None, (p.strip() for p in text.split(';'))):
+        username, _, level = part.partition(':')
+        permissions.append((username.strip(), level.strip() or 'viewer'))
+    return permissions
+
+
+def provision(main_db_path, rows, dry_run=False):
+    """إضافة المحلات وصلاحياتها في معاملة واحدة؛ تُرجع [(store_id, store_name)] أو ترفع ValueError بكل الأخطاء.
+    مع dry_run يُلغى كل شيء بعد التحقق"""
+    db = sqlite3.connect(main_db_path, timeout=30)
+    try:
+        db.execute('BEGIN IMMEDIATE')
+        users = dict(db.execute('SELECT username, id FROM users'))
+        existing = set(db.execute('SELECT owner_id, store_name FROM stores'))
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        created, errors = [], []
+        for line, row in enumerate(rows, start=2):
+            name, owner = row.get('store_name', ''), row.get('owner', '')
+            if not name:
+                errors.append(f'line {line}: store_name is required')
+                continue
+            if owner not in users:
+                errors.append(f'line {line}: unknown owner "{owner}"')
+                continue
+            if (users[owner], name) in existing:
+                errors.append(f'line {line}: "{owner}" already has a store named "{name}"')
+                continue
+            permissions = parse_permissions(row.get('permissions', ''))
+            bad = [f'{u}:{level}' for u, level in permissions if u not in users or level not in PERMISSION_LEVELS]
+            if bad:
+                errors.append(f'line {line}: invalid permissions {", ".join(bad)}')
+                continue
+            existing.add((users[owner], name))
+            c = db.execute('''INSERT INTO stores (store_name, owner_id, store_type, address, phone, email, description, created_at)
+                              VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                           (name, users[owner], row.get('store_type') or 'library', row.get('address') or None,
+                            row.get('phone') or None, row.get('email') or None, row.get('description') or None, now))
+            store_id = c.lastrowid
+            grants = {users[owner]: 'owner'}
+            for username, level in permissions:
+                grants.setdefault(users[username], level)
+            db.executemany('''INSERT INTO store_permissions (user_id, store_id, permission_level, granted_at)
+                              VALUES (?, ?, ?, ?)''', [(user_id, store_id, level, now) for user_id, level in grants.items()])
+            created.append((store_id, name))
+        if errors:
+            raise ValueError('\n'.join(errors))
+        if dry_run:
+            db.rollback()
+        else:
+            db.commit()
+        return created
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create many Lekhlef stores from a CSV file')
+    parser.add_argument('csv_file')
+    parser.add_argument('--dry-run', action='store_true', help='validate the file without saving anything')
+    args = parser.parse_args()
+
+    sys.path.insert(0, APP_DIR)
+    import lekhleftest  # ينشئ القاعدة الرئيسية إن لم تكن موجودة
+    rows = read_rows(args.csv_file)
+    started = time.perf_counter()
+    try:
+        created = provision(lekhleftest.MAIN_DB_PATH, rows, dry_run=args.dry_run)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    if args.dry_run:
+        print(f'{len(created)} stores are valid')
+        return
+    lekhleftest.ensure_stores_directory()
+    for store_id, _name in created:
+        lekhleftest.ensure_store_database_exists(store_id)
+    print(f'{len(created)} stores created in {time.perf_counter() - started:.1f}s')
+    for store_id, name in created:
+        print(f'  {store_id:>6}  {name}')
+
+
+if __name__ == '__main__':
+    main()